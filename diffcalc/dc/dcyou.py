@@ -59,6 +59,30 @@ class DiffractometerYouCalculator(object):
         return angle_tuple, params
     
     
+    def hkl_to_all_angles(self, h, k, l, energy=None):
+        """Find all solutions for an hkl vector within the axis limits
+
+        return list of (angle tuple, params dictionary, internal position)
+        """
+        if energy is None:
+            energy = self.diffhw.get_energy()  # @UndefinedVariable
+
+        pairs = hklcalc.hklToAngles(h, k, l, energy_to_wavelength(energy), True)
+        result = []
+        for pos, params in pairs:
+            angle_tuple = self.geometry.internal_position_to_physical_angles(pos)  # @UndefinedVariable
+            result.append((self.diffhw.cut_angles(angle_tuple), params, pos))  # @UndefinedVariable
+        return result
+
+    def choose_solution(self, solutions, reference):
+        """Return the index of the solution from hkl_to_all_angles() that
+        hkl_to_angles() picks with the diffractometer at the reference angles
+        """
+        pairs = [(pos, params) for _, params, pos in solutions]
+        chosen, _ = hklcalc._choose_single_solution(pairs, reference)
+        return [pos for pos, _ in pairs].index(chosen)
+
+
     def angles_to_hkl(self, angleTuple, energy=None):
         """Converts a set of diffractometer angles to an hkl position
         
@@ -79,6 +103,14 @@ def hkl_list_to_angles(hkl, energy=None):
     _dcyou = DiffractometerYouCalculator(settings.hardware, settings.geometry)
     return _dcyou.hkl_list_to_angles(hkl, energy)
 
+def hkl_to_all_angles(h, k, l, energy=None):
+    _dcyou = DiffractometerYouCalculator(settings.hardware, settings.geometry)
+    return _dcyou.hkl_to_all_angles(h, k, l, energy)
+
+def choose_solution(solutions, reference):
+    _dcyou = DiffractometerYouCalculator(settings.hardware, settings.geometry)
+    return _dcyou.choose_solution(solutions, reference)
+
 def angles_to_hkl(angleTuple, energy=None):
     _dcyou = DiffractometerYouCalculator(settings.hardware, settings.geometry)
     return _dcyou.angles_to_hkl(angleTuple, energy)
@@ -0,0 +1,395 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""
+Dry runs of scans.
+
+DryRun works out the diffractometer position at every point of a scan
+without moving anything, and estimates how long the scan will take from
+the axis speeds and accelerations held by the hardware adapter and the
+detector exposure times.
+
+Solving every point of a long scan would take minutes, so hkl targets are
+split into straight runs of equal steps. Along a run the axes are solved
+at both ends, the middle and the quarter points, and interpolated in
+between if the quarter points lie within the tolerance of the parabola
+through the others and the interpolated positions stay within the axis
+limits. Otherwise the run is halved until the interpolation holds or
+neighbouring points are reached. Branch switches, unreachable points and
+limit crossings are so located exactly, at the cost of a few solutions
+each.
+"""
+
+from diffcalc.gdasupport.scannable.diffractometer import DiffractometerScannableGroup
+from diffcalc.gdasupport.scannable.hkl import Hkl
+from diffcalc.hardware import move_time
+from diffcalc.util import DiffcalcException
+
+# Scannables at this level or above given a number in a scan are taken to be
+# detectors counting for that many seconds
+DETECTOR_LEVEL = 10
+
+
+def _ranges(indices, limit=10):
+    """Format sorted point indices as a list of ranges"""
+    ranges = []
+    for i in indices:
+        if ranges and ranges[-1][1] == i - 1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    parts = [str(a) if a == b else '%d-%d' % (a, b) for a, b in ranges[:limit]]
+    if len(ranges) > limit:
+        parts.append('...')
+    return ', '.join(parts)
+
+
+def _linear_runs(hkls):
+    """Return (first, last) indices of the runs of equal steps in hkls.
+    Neighbouring runs share their end points."""
+    import numpy as np
+    steps = np.diff(hkls, axis=0)
+    if not len(steps):
+        return [(0, 0)]
+    change = np.flatnonzero(abs(np.diff(steps, axis=0)).max(axis=1) > 1e-12) + 1
+    bounds = [0] + change.tolist() + [len(steps)]
+    return zip(bounds[:-1], bounds[1:])
+
+
+def solve_path(hkls, solve, choose, start, tolerance=1e-3, max_jump=5., angles=None,
+               limits=None):
+    """Find the axis positions at a sequence of hkl targets.
+
+    Parameters
+    ----------
+    hkls: array_like
+        (N, 3) hkl targets in scan order.
+    solve: callable
+        solve(hkl) returns the list of solutions for hkl, raising
+        DiffcalcException if there are none.
+    choose: callable
+        choose(solutions, reference) returns the index of the solution
+        chosen with the diffractometer at the reference position.
+    start: array_like
+        Diffractometer position before the first point.
+    tolerance: float, optional
+        Largest interpolation error in degrees.
+    max_jump: float, optional
+        Largest difference in degrees between the position at a point of a
+        run and its extrapolation from the previous two points not taken as
+        a change of solution branch.
+    angles: callable, optional
+        Returns the axis positions of a solution. By default solutions are
+        axis positions.
+    limits: list, optional
+        (lower, upper) limits of every axis, None where there is none. Runs
+        are only interpolated where the positions stay within the limits.
+
+    Returns
+    -------
+    positions: ndarray
+        (N, naxes) positions, nan for unreachable points.
+    failures: dict
+        Error messages of unreachable points by index.
+    switches: list
+        Indices of points where the chosen solution is not the continuation
+        of the solutions at the previous points.
+    nsolved: int
+        Number of points solved exactly.
+    """
+    import numpy as np
+    hkls = np.asarray(hkls, dtype=float)
+    start = np.asarray(start, dtype=float)
+    positions = np.full((len(hkls), len(start)), np.nan)
+    failures = {}
+    switches = []
+    cache = {}
+    raw = {}
+    last = [start]
+    angles = angles or (lambda sol: sol)
+    low = np.array([-np.inf if lim is None or lim[0] is None else lim[0]
+                    for lim in limits or [None] * len(start)], dtype=float)
+    high = np.array([np.inf if lim is None or lim[1] is None else lim[1]
+                     for lim in limits or [None] * len(start)], dtype=float)
+
+    def exact(i):
+        if i not in cache:
+            try:
+                raw[i] = solve(hkls[i])
+                cache[i] = [np.asarray(angles(sol), dtype=float) for sol in raw[i]]
+            except DiffcalcException, e:
+                cache[i] = e.message
+        return cache[i]
+
+    def select(i, reference):
+        return 0 if len(raw[i]) == 1 else choose(raw[i], reference)
+
+    def pick(i, reference):
+        solutions = exact(i)
+        if isinstance(solutions, basestring):
+            return None
+        return solutions[select(i, reference)]
+
+    def finalise(i, first):
+        solutions = exact(i)
+        if isinstance(solutions, basestring):
+            failures[i] = solutions
+            return
+        chosen = solutions[select(i, last[0])]
+        # Along a run the axes move smoothly, so a solution far from the
+        # extrapolation of the previous two points is on another branch
+        if (i - 2 >= first and not np.isnan(positions[i - 2:i]).any() and
+                (not switches or switches[-1] != i - 1)):
+            predicted = 2 * positions[i - 1] - positions[i - 2]
+            if abs(chosen - predicted).max() > max_jump:
+                switches.append(i)
+        positions[i] = last[0] = chosen
+
+    def quadratic(a, m, b, pa, pm, pb, x):
+        x = np.asarray(x, dtype=float)[:, None]
+        return (pa * (x - m) * (x - b) / float((a - m) * (a - b)) +
+                pm * (x - a) * (x - b) / float((m - a) * (m - b)) +
+                pb * (x - a) * (x - m) / float((b - a) * (b - m)))
+
+    def fill(a, b, first):
+        """Fill points a+1 to b of the run starting at first, with point a
+        done"""
+        if b <= a + 3:
+            for i in range(a + 1, b + 1):
+                finalise(i, first)
+            return
+        m = (a + b) // 2
+        if a not in failures:
+            pa = positions[a]
+            pm = pick(m, pa)
+            pb = pick(b, pm) if pm is not None else None
+            q = [(a + m) // 2, (m + b) // 2]
+            pq = [pick(q[0], pa), pick(q[1], pm)] if pb is not None else [None]
+            if all(p is not None for p in pq):
+                # Interpolate if the quarter points lie on the parabola
+                # through the end and middle points, and the run does not
+                # cross a limit the solver would reject points beyond
+                if abs(quadratic(a, m, b, pa, pm, pb, q) - pq).max() <= tolerance:
+                    x = np.arange(a + 1, b + 1)
+                    interpolated = quadratic(a, m, b, pa, pm, pb, x)
+                    if not ((interpolated < low) | (interpolated > high)).any():
+                        positions[a + 1:b + 1] = interpolated
+                        positions[b] = last[0] = pb
+                        return
+        elif isinstance(exact(m), basestring) and isinstance(exact(b), basestring):
+            for i in range(a + 1, b + 1):
+                failures[i] = exact(m)
+            return
+        fill(a, m, first)
+        fill(m, b, first)
+
+    for first, final in _linear_runs(hkls):
+        if first == 0:
+            finalise(0, 0)
+        if final > first:
+            fill(first, final, first)
+    return positions, failures, sorted(switches), len(cache)
+
+
+class DryRunReport(object):
+    """Result of a dry run.
+
+    Attributes
+    ----------
+    names: list of str
+        Axis names.
+    positions: ndarray
+        (N, naxes) axis positions at every point, nan where unreachable.
+    exposures: ndarray
+        (N,) detector exposure times.
+    move_times: ndarray
+        (N,) estimated time to move to every point.
+    limit_violations: list
+        (index, axis, position) of axis positions beyond their limits.
+    unreachable: dict
+        Error messages of points with no solution within the limits.
+    branch_switches: list
+        Indices of points where the solution changes branch.
+    ignored: list of str
+        Names of scanned scannables the dry run can not simulate.
+    nsolved: int
+        Number of points solved exactly.
+    """
+
+    def __init__(self, names, positions, exposures, move_times, limit_violations,
+                 unreachable, branch_switches, ignored, nsolved):
+        self.names = names
+        self.positions = positions
+        self.exposures = exposures
+        self.move_times = move_times
+        self.limit_violations = limit_violations
+        self.unreachable = unreachable
+        self.branch_switches = branch_switches
+        self.ignored = ignored
+        self.nsolved = nsolved
+
+    @property
+    def duration(self):
+        return float(self.move_times.sum() + self.exposures.sum())
+
+    def max_steps(self):
+        """Return (step, point index) of the largest move of every axis
+        between neighbouring points"""
+        import numpy as np
+        steps = abs(np.diff(self.positions, axis=0))
+        result = []
+        for col in steps.T:
+            if len(col) == 0 or np.all(np.isnan(col)):
+                result.append((0., None))
+            else:
+                i = int(np.nanargmax(col))
+                result.append((float(col[i]), i + 1))
+        return result
+
+    def __str__(self):
+        lines = ['Dry run of %d points (%d solved, others interpolated):' %
+                 (len(self.positions), self.nsolved)]
+        lines.append('  estimated time : %.1f s (moves %.1f s, exposures %.1f s)' %
+                     (self.duration, self.move_times.sum(), self.exposures.sum()))
+        lines.append('  largest steps  :')
+        for name, (step, i) in zip(self.names, self.max_steps()):
+            if i is not None:
+                lines.append('    %5s % 9.4f  (point %d)' % (name, step, i))
+        if self.limit_violations:
+            lines.append('  beyond limits  : %s' % ', '.join(
+                '%s=%.4f (point %d)' % (name, pos, i)
+                for i, name, pos in self.limit_violations[:10]))
+        if self.unreachable:
+            indices = sorted(self.unreachable)
+            lines.append('  unreachable    : points %s' % _ranges(indices))
+            lines.append('                   %s' % self.unreachable[indices[0]].strip())
+        if self.branch_switches:
+            lines.append('  branch switches: points %s' % _ranges(self.branch_switches))
+        if self.ignored:
+            lines.append('  not simulated  : %s' % ', '.join(self.ignored))
+        return '\n'.join(lines)
+
+
+class DryRun(object):
+    """Simulates a scan without moving anything.
+
+    Parameters
+    ----------
+    scan: Scan
+        Scan command whose arguments and point order are simulated.
+    hardware: HardwareAdapter
+        Source of axis names, positions, limits, speeds and accelerations.
+    hkl_to_all_angles: callable
+        Returns all (angles, params, internal position) solutions for h, k, l.
+    choose_solution: callable
+        Returns the index of the solution chosen at a reference position.
+    tolerance, max_jump: float, optional
+        See solve_path().
+    """
+
+    def __init__(self, scan, hardware, hkl_to_all_angles, choose_solution,
+                 tolerance=1e-3, max_jump=5.):
+        self.scan = scan
+        self.hardware = hardware
+        self.hkl_to_all_angles = hkl_to_all_angles
+        self.choose_solution = choose_solution
+        self.tolerance = tolerance
+        self.max_jump = max_jump
+
+    def _points(self, groups, names):
+        """Return hkl targets (or None), axis targets and exposure times at
+        every scan point and the names of scannables not simulated"""
+        import numpy as np
+        hkl, hkls = None, []
+        axes = [np.nan] * len(names)
+        axis_targets, exposures, ignored = [], [], []
+        for moves in self.scan._iterPointMoves(groups):
+            exposure = 0.
+            for scn, target in moves:
+                parent = getattr(scn, 'getParent', lambda: None)()
+                if isinstance(scn, Hkl) or isinstance(parent, Hkl):
+                    if hkl is None:
+                        hkl = list((parent or scn).getPosition()[:3])
+                    if parent is None:
+                        hkl = [old if new is None else new for old, new in zip(hkl, target)]
+                    else:
+                        hkl = list(hkl)
+                        hkl[scn.index] = target
+                elif isinstance(scn, DiffractometerScannableGroup):
+                    axes = [old if new is None else new for old, new in zip(axes, target)]
+                elif scn.getName() in names:
+                    axes = list(axes)
+                    axes[names.index(scn.getName())] = target
+                elif scn.getLevel() >= DETECTOR_LEVEL and isinstance(target, (int, float)):
+                    exposure = target
+                elif scn.getName() not in ignored:
+                    ignored.append(scn.getName())
+            hkls.append(hkl)
+            axis_targets.append(axes)
+            exposures.append(exposure)
+        if hkl is None:
+            hkls = None
+        else:
+            # Points before the first hkl move keep the starting hkl
+            first = next(i for i, v in enumerate(hkls) if v is not None)
+            hkls[:first] = [hkls[first]] * first
+        return hkls, np.array(axis_targets, dtype=float), np.array(exposures), ignored
+
+    def __call__(self, *scanargs):
+        import numpy as np
+        groups = self.scan._parseScanArgsIntoScannableArgGroups(scanargs)
+        groups = self.scan._reorderInnerGroupsAccordingToLevel(groups)
+        hw = self.hardware
+        names = list(hw.get_axes_names())
+        start = np.array(hw.get_position(), dtype=float)
+        hkls, axis_targets, exposures, ignored = self._points(groups, names)
+
+        limits = [(hw.get_lower_limit(name), hw.get_upper_limit(name)) for name in names]
+        unreachable, switches, nsolved = {}, [], 0
+        if hkls is None:
+            positions = np.tile(start, (len(axis_targets), 1))
+        else:
+            positions, unreachable, switches, nsolved = solve_path(
+                hkls, lambda hkl: self.hkl_to_all_angles(*hkl), self.choose_solution,
+                start, self.tolerance, self.max_jump, lambda sol: sol[0], limits)
+        targeted = ~np.isnan(axis_targets)
+        positions[targeted] = axis_targets[targeted]
+
+        # Unreachable points are nan and never beyond a limit
+        violations = []
+        for j, (name, (low, high)) in enumerate(zip(names, limits)):
+            col = positions[:, j]
+            bad = np.zeros(len(col), dtype=bool)
+            with np.errstate(invalid='ignore'):
+                if low is not None:
+                    bad |= col < low
+                if high is not None:
+                    bad |= col > high
+            violations.extend((int(i), name, float(col[i])) for i in np.flatnonzero(bad))
+        violations.sort()
+
+        # Unreachable points are skipped when estimating the move times
+        path = np.vstack([start, positions])
+        for i in range(1, len(path)):
+            if np.isnan(path[i]).any():
+                path[i] = path[i - 1]
+        steps = np.diff(path, axis=0)
+        move_times = move_time(steps, np.array(hw.get_velocities()),
+                               np.array(hw.get_accelerations())).max(axis=1)
+        return DryRunReport(names, positions, exposures, move_times, violations,
+                            unreachable, switches, ignored, nsolved)
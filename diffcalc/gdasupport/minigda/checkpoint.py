@@ -0,0 +1,196 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""
+Checkpointing of scans.
+
+A Scan given a ScanCheckpoint with a path set saves the scan arguments,
+the number of points completed, the state the scan depends on (like the
+UB matrix and constraints) and the points recorded so far. The file is
+rewritten at most every interval seconds while the scan runs, and
+whenever the scan stops with an error, so each point only costs a time
+check. The file is removed when the scan completes. Files are written to
+a temporary name and renamed, so an interrupted write leaves the previous
+checkpoint intact:
+
+    DIFFCALC-CHECKPOINT 1
+    {"args": [...], "completed": ..., ...}     json header on one line
+    rows of little endian float64 values, one per recorded column
+
+Scan.resume() continues from the point after the last one completed.
+"""
+
+import os
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from diffcalc.gdasupport.minigda.scannable import Scannable
+from diffcalc.util import DiffcalcException
+
+MAGIC = 'DIFFCALC-CHECKPOINT 1\n'
+
+
+def _encode_arg(arg):
+    if isinstance(arg, Scannable):
+        return {'scannable': arg.getName()}
+    if isinstance(arg, (int, long, float)):
+        return arg
+    try:
+        return [float(v) for v in arg]
+    except (TypeError, ValueError):
+        raise DiffcalcException("Scan argument %r can not be checkpointed" % (arg,))
+
+
+def _find_scannable(name, namespace):
+    scn = namespace.get(name)
+    if isinstance(scn, Scannable) and scn.getName() == name:
+        return scn
+    for scn in namespace.values():
+        if isinstance(scn, Scannable) and scn.getName() == name:
+            return scn
+    raise DiffcalcException("Scannable %s of the checkpointed scan not found" % name)
+
+
+def _normalised(state):
+    # Compare states as they read back from the file
+    return json.loads(json.dumps(state))
+
+
+class ScanCheckpoint(object):
+    """Saves the progress of scans so they can be resumed.
+
+    Parameters
+    ----------
+    recorder: ScanDataRecorder, optional
+        Recorder whose points are saved with the checkpoint and restored
+        when resuming.
+    state: callable, optional
+        Returns a json serialisable dictionary describing the state the scan
+        depends on. Scans resume only if it is unchanged.
+    path: str, optional
+        Checkpoint file. Nothing is saved if not set.
+    interval: float, optional
+        Shortest time in seconds between saves while scanning.
+    """
+
+    def __init__(self, recorder=None, state=None, path=None, interval=10.):
+        self.recorder = recorder
+        self.state = state
+        self.path = path
+        self.interval = interval
+        self._header = None
+        self._last_save = 0.
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def start(self, scan, scanargs, completed=0, data=None):
+        """Begin checkpointing a scan, resumed after completed points with
+        their recorded data if given"""
+        if not self.enabled:
+            self._header = None
+            return
+        self._header = {
+            'scan': scan.__class__.__name__,
+            'options': scan._checkpointOptions(),
+            'args': [_encode_arg(arg) for arg in scanargs],
+            'state': self.state() if self.state is not None else None,
+            'completed': completed,
+            'columns': list(self.recorder.names) if self.recorder is not None else []}
+        if data is not None and self.recorder is not None:
+            if data.shape[1] != len(self.recorder.names):
+                raise DiffcalcException("Recorded columns changed since the scan was interrupted")
+            self.recorder.restore(data)
+        self.save()
+
+    def point_done(self, completed):
+        """Note that the first completed points are done, saving the
+        checkpoint if the interval has passed"""
+        if self._header is None:
+            return
+        self._header['completed'] = completed
+        if time.time() - self._last_save >= self.interval:
+            self.save()
+
+    def save(self):
+        """Write the checkpoint file"""
+        if self._header is None:
+            return
+        self._header['saved'] = time.time()
+        data = self.recorder.data if self.recorder is not None else None
+        if data is not None:
+            data = data[:self._header['completed']]
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(MAGIC + json.dumps(self._header) + '\n')
+            if data is not None:
+                f.write(data.astype('<f8').tostring())
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.rename(tmp, self.path)
+        except OSError:
+            # Renaming does not replace existing files on Windows
+            os.remove(self.path)
+            os.rename(tmp, self.path)
+        self._last_save = time.time()
+
+    def finish(self):
+        """Remove the checkpoint of a completed scan"""
+        if self._header is not None and os.path.exists(self.path):
+            os.remove(self.path)
+        self._header = None
+
+    def load(self):
+        """Return the header and recorded data of the saved scan"""
+        import numpy as np
+        if not self.enabled or not os.path.exists(self.path):
+            raise DiffcalcException("No interrupted scan to resume")
+        with open(self.path, 'rb') as f:
+            if f.readline() != MAGIC:
+                raise DiffcalcException("%s is not a scan checkpoint file" % self.path)
+            header = json.loads(f.readline())
+            raw = f.read()
+        data = None
+        if header['columns']:
+            data = np.frombuffer(raw, dtype='<f8').reshape(-1, len(header['columns']))
+        return header, data
+
+    def resume_args(self, scan, header, namespace):
+        """Return the scan arguments of a saved scan after checking it can
+        be resumed by scan"""
+        if header['scan'] != scan.__class__.__name__:
+            raise DiffcalcException("The interrupted scan was a %s, not a %s" %
+                                    (header['scan'], scan.__class__.__name__))
+        if header['options'] != _normalised(scan._checkpointOptions()):
+            raise DiffcalcException("Scan options changed since the scan was interrupted: "
+                                    "%s, now %s" % (header['options'], scan._checkpointOptions()))
+        if self.state is not None:
+            current = _normalised(self.state())
+            changed = sorted(key for key in set(current) | set(header['state'] or {})
+                             if current.get(key) != (header['state'] or {}).get(key))
+            if changed:
+                raise DiffcalcException(
+                    "Can not resume the scan as its %s changed" % ', '.join(changed))
+        return [_find_scannable(arg['scannable'], namespace) if isinstance(arg, dict) else arg
+                for arg in header['args']]
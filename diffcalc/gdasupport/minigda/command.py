@@ -19,10 +19,15 @@
 #try:
 #    from gda.device import Scannable
 #except ImportError:
-#    from diffcalc.gdasupport.minigda.scannable import Scannable
-from diffcalc.gdasupport.minigda.scannable import Scannable
-from diffcalc.util import getMessageFromException, allnum, bold
+#    from diffcalc.gdasupport.minigda.scannable import Scannable, run_concurrently
+from diffcalc.gdasupport.minigda.scannable import Scannable, run_concurrently
+from diffcalc.util import getMessageFromException, allnum, bold, \
+    DiffcalcException
 import math
+import time
+import Queue
+import threading
+from operator import methodcaller
 
 
 ROOT_NAMESPACE_DICT = {}
@@ -116,15 +121,28 @@ class ScanDataHandler:
 
 
 class ScanDataPrinter(ScanDataHandler):
+    """Prints scan points as a table.
 
-    def __init__(self):
+    With min_interval set, rows are printed at most once per min_interval
+    seconds and the last row is always printed, so that long fast scans are
+    not held up by the terminal. Printing is switched off by enabled.
+    """
+
+    def __init__(self, min_interval=0, enabled=True):
         self.first_point_printed = False
         self.widths = []
         self.scannables = []
+        self.min_interval = min_interval
+        self.enabled = enabled
+        self._last_print = 0
+        self._held = None
+        self._skipped = 0
 
     def callAtScanStart(self, scannables):
         self.first_point_printed = False
         self.scannables = scannables
+        self._held = None
+        self._skipped = 0
 
     def print_first_point(self, position_dict):
         # also sets self.widths
@@ -165,28 +183,67 @@ class ScanDataPrinter(ScanDataHandler):
         print '\n'.join(lines)
 
     def callWithScanPoint(self, position_dict):
+        if not self.enabled:
+            return
         if not self.first_point_printed:
             self.print_first_point(position_dict)
             self.first_point_printed = True
+            self._last_print = time.time()
+        elif self.min_interval and time.time() - self._last_print < self.min_interval:
+            if self._held is not None:
+                self._skipped += 1
+            self._held = position_dict
         else:
-            row_strings = []
-            for scn in self.scannables:
-                pos = position_dict[scn]
-                row_strings.extend(scn.formatPositionFields(pos))
+            self._skipped += self._held is not None
+            self._held = None
+            self.print_point(position_dict)
+            self._last_print = time.time()
+
+    def print_point(self, position_dict):
+        row_strings = []
+        for scn in self.scannables:
+            pos = position_dict[scn]
+            row_strings.extend(scn.formatPositionFields(pos))
 
-            row_cells = []
-            for pos, width in zip(row_strings, self.widths):
-                row_cells.append(pos.rjust(width))
+        row_cells = []
+        for pos, width in zip(row_strings, self.widths):
+            row_cells.append(pos.rjust(width))
 
-            print '  '.join(row_cells)
+        print '  '.join(row_cells)
 
     def callAtScanEnd(self):
         #table_width = sum(self.widths) + len(self.widths * 2) - 2
         #print '=' * table_width
-        pass
+        if self._held is not None:
+            self.print_point(self._held)
+            self._held = None
+        if self._skipped:
+            print "(%d points not printed)" % self._skipped
 
 
 class Scan(object):
+    """Scan command running nested loops over scannables.
+
+    With lookahead set, a background thread prepares the targets of up to
+    lookahead upcoming points while the scan moves to and reads out the
+    current one. Scannables computing their motor positions, like hkl, do
+    so in prepareMoveTo(), so solver time overlaps with motion and
+    exposure. A point which cannot be prepared (no solution, out of limits)
+    stops the scan as soon as it is found rather than when it is reached.
+
+    At every point scannables are moved in order of their level. Moves at
+    the same level are started together, each in its own thread when
+    concurrent is set, and waited for with the scannables' waitWhileBusy()
+    or, with poll_interval set, by polling isBusy(). Between polls the scan
+    sleeps on the clock of a busy scannable if it has one, like simulated
+    motors, and in real time otherwise. A multi-axis move then takes as
+    long as its slowest axis. All scannables are read out
+    concurrently.
+
+    With a checkpoint set, the progress of the scan is saved so an
+    interrupted scan can be continued with resume(), see ScanCheckpoint.
+    """
+
     class Group:
         def __init__(self, scannable):
             self.scannable = scannable
@@ -201,20 +258,61 @@ class Scan(object):
         def shouldTriggerLoop(self):
             return len(self.args) == 3
 
-    def __init__(self, scanDataHandlers):
+    def __init__(self, scanDataHandlers, lookahead=0, poll_interval=None,
+                 concurrent=True, checkpoint=None):
         # scanDataHandlers should be list
         if type(scanDataHandlers) not in (tuple, list):
             scanDataHandlers = (scanDataHandlers,)
         self.dataHandlers = scanDataHandlers
+        self.lookahead = lookahead
+        self.poll_interval = poll_interval
+        self.concurrent = concurrent
+        self.checkpoint = checkpoint
+        self._completed = 0
+        self._skipped = 0
 
     def __call__(self, *scanargs):
+        self._run(scanargs)
+
+    def resume(self, namespace=None):
+        """Continue the scan saved by the checkpoint from the point after
+        the last one completed. Scannables are looked up by name in
+        namespace, by default ROOT_NAMESPACE_DICT."""
+        if self.checkpoint is None:
+            raise DiffcalcException("Scan has no checkpoint to resume from")
+        header, data = self.checkpoint.load()
+        scanargs = self.checkpoint.resume_args(
+            self, header, ROOT_NAMESPACE_DICT if namespace is None else namespace)
+        print "Resuming scan after point %d" % header['completed']
+        self._run(scanargs, header['completed'], data)
+
+    def _checkpointOptions(self):
+        """Return the settings changing the points of a scan, which must be
+        unchanged to resume it"""
+        return {}
+
+    def _run(self, scanargs, completed=0, data=None):
         groups = self._parseScanArgsIntoScannableArgGroups(scanargs)
         groups = self._reorderInnerGroupsAccordingToLevel(groups)
         # Configure data handlers for a new scan
         for handler in self.dataHandlers: handler.callAtScanStart(
             [grp.scannable for grp in groups])
+        self._completed = self._skipped = completed
+        checkpoint = self.checkpoint
+        if checkpoint is not None:
+            checkpoint.start(self, scanargs, completed, data)
         # Perform the scan
-        self._performScan(groups, currentRecursionLevel=0)
+        try:
+            if self.lookahead > 0:
+                self._performPipelinedScan(groups)
+            else:
+                self._performScan(groups, currentRecursionLevel=0)
+        except:
+            if checkpoint is not None:
+                checkpoint.save()
+            raise
+        if checkpoint is not None:
+            checkpoint.finish()
         # Inform data handlers of scan completion
         for handler in self.dataHandlers: handler.callAtScanEnd()
 
@@ -243,51 +341,180 @@ class Scan(object):
         latter = groups[idx:]; latter.sort() # Horrible hack not needed in python 3!
         return groups[:idx] + latter
 
-    def _performScan(self, groups, currentRecursionLevel):
-        # groups[currentRecursionLevel:] will start with either:
-        #  a) A loop triggering group
-        #  b) A number (possibly 0) of non-loop triggering groups
-        unprocessedGroups = groups[currentRecursionLevel:]
-
-        # 1) If first remaining group should trigger a loop, perform this loop,
-        #    recursively calling this method on the remaining groups
-        if len(unprocessedGroups) > 0:
-            first = unprocessedGroups[0]
-            # If groups starts with a request to loop:
-            if first.shouldTriggerLoop():
-                posList = self._frange(first.args[0], first.args[1], first.args[2])
-                for pos in posList:
-                    first.scannable.asynchronousMoveTo(pos)
-                    # TODO: Should wait. minigda assumes all moves complete immediately
-                    self._performScan(groups, currentRecursionLevel + 1)
-                return
-
-        # 2) Move all non-loop triggering groups (may be zero)
-        self._moveNonLoopTriggeringGroups(unprocessedGroups)
+    def _performScan(self, groups, currentRecursionLevel=0):
+        for moves in self._skipCompletedPoints(
+                self._iterPointMoves(groups, currentRecursionLevel)):
+            self._moveToPoint([(scn.asynchronousMoveTo, scn, target)
+                               for scn, target in moves])
+            self._recordPoint(groups)
 
-        # 3) Sample position of all scannables
+    def _recordPoint(self, groups):
+        # Sample position of all scannables and inform the data handlers
+        # that this point has been recorded
         posDict = self._samplePositionsOfAllScannables(groups)
-
-        # 4) Inform the data handlers that this point has been recorded
         for handler in self.dataHandlers: handler.callWithScanPoint(posDict)
-
-    def _moveNonLoopTriggeringGroups(self, groups):
-        # TODO: Should wait. minigda assumes all moves complete immediately. groups could be zero lengthed.
+        self._completed += 1
+        if self.checkpoint is not None:
+            self.checkpoint.point_done(self._completed)
+
+    def _skipCompletedPoints(self, points):
+        """Skip the moves of the points completed before the scan was
+        resumed. Their last targets are moved to with the first point made,
+        as outer loops only move at the start of inner ones."""
+        points = iter(points)
+        if not self._skipped:
+            return points
+        targets, order = {}, []
+        for _ in range(self._skipped):
+            for scn, target in next(points, ()):
+                if id(scn) not in targets:
+                    order.append(scn)
+                targets[id(scn)] = target
+
+        def resumed():
+            first = next(points, None)
+            if first is None:
+                return
+            moved = set(id(scn) for scn, _ in first)
+            yield [(scn, targets[id(scn)]) for scn in order if id(scn) not in moved] + first
+            for moves in points:
+                yield moves
+        return resumed()
+
+    def _moveToPoint(self, moves):
+        """Make (move function, scannable, target) moves level by level.
+
+        The moves of scannables at one level are started together and
+        finished before the next level is started, so detectors at high
+        levels count once the motors have arrived."""
+        levels = {}
+        for move in moves:
+            levels.setdefault(move[1].getLevel(), []).append(move)
+        for level in sorted(levels):
+            self._runConcurrently([(move, target) for move, _, target in levels[level]])
+            self._waitWhileBusy([scn for _, scn, _ in levels[level]])
+
+    def _waitWhileBusy(self, scannables):
+        if self.poll_interval is None:
+            for scn in scannables:
+                scn.waitWhileBusy()
+            return
+        busy = list(scannables)
+        while True:
+            busy = [scn for scn in busy if scn.isBusy()]
+            if not busy:
+                return
+            # Simulated hardware waits on its own clock, which may only
+            # move on when waited on
+            clock = getattr(busy[0], 'clock', None) or time
+            clock.sleep(self.poll_interval)
+
+    def _runConcurrently(self, calls):
+        if not self.concurrent or len(calls) < 2:
+            return [f(arg) for f, arg in calls]
+        return run_concurrently(calls)
+
+    def _nonLoopTriggeringMoves(self, groups):
+        moves = []
         for grp in groups:
             if len(grp.args) == 0:
                 pass
             elif len(grp.args) == 1:
-                grp.scannable.asynchronousMoveTo(grp.args[0])
+                moves.append((grp.scannable, grp.args[0]))
             elif len(grp.args) == 2:
                 raise Exception("Scannables followed by two args not supported by minigda's scan command ")
             else:
                 raise Exception("Scannable: %s args%s" % (grp.scannable, str(grp.args)))
+        return moves
 
-    def _samplePositionsOfAllScannables(self, groups):
-        posDict = {}
+    def _iterPointMoves(self, groups, currentRecursionLevel=0, outerMoves=()):
+        """Yield the (scannable, target) moves made before each scan point,
+        in the order _performScan makes them"""
+        unprocessedGroups = groups[currentRecursionLevel:]
+        if len(unprocessedGroups) > 0 and unprocessedGroups[0].shouldTriggerLoop():
+            first = unprocessedGroups[0]
+            posList = self._frange(first.args[0], first.args[1], first.args[2])
+            for pos in posList:
+                moves = tuple(outerMoves) + ((first.scannable, pos),)
+                for point in self._iterPointMoves(groups, currentRecursionLevel + 1, moves):
+                    yield point
+                # Outer loops only move before the first point of this loop
+                outerMoves = ()
+            return
+        yield list(outerMoves) + self._nonLoopTriggeringMoves(unprocessedGroups)
+
+    def _prepareMove(self, scn, target):
+        prepare = getattr(scn, 'prepareMoveTo', None)
+        if prepare is None:
+            return scn.asynchronousMoveTo, scn, target
+        return scn.asynchronousMoveToPrepared, scn, prepare(target)
+
+    def _scanStartScannables(self, groups):
+        result = []
         for grp in groups:
-            posDict[grp.scannable] = grp.scannable.getPosition()
-        return posDict
+            scn = grp.scannable
+            for s in (scn, getattr(scn, 'getParent', lambda: None)()):
+                if s is not None and s not in result and hasattr(s, 'atScanStart'):
+                    result.append(s)
+        return result
+
+    def _performPipelinedScan(self, groups):
+        points = Queue.Queue(self.lookahead)
+        failure = []
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.isSet():
+                try:
+                    points.put(item, timeout=.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def produce():
+            index = self._skipped
+            try:
+                for moves in self._skipCompletedPoints(self._iterPointMoves(groups)):
+                    index += 1
+                    prepared = [self._prepareMove(scn, target) for scn, target in moves]
+                    if not put(prepared):
+                        return
+            except Exception, e:
+                failure.append("Scan point %d can not be reached: %s" %
+                               (index, getMessageFromException(e)))
+            put(None)
+
+        # Partially specified targets are completed from the positions at
+        # the scan start, as points are prepared before previous moves end
+        scannables = self._scanStartScannables(groups)
+        for scn in scannables:
+            scn.atScanStart()
+        producer = threading.Thread(target=produce, name='scan-lookahead')
+        producer.setDaemon(True)
+        producer.start()
+        try:
+            while True:
+                if failure:
+                    raise DiffcalcException(failure[0])
+                prepared = points.get()
+                if prepared is None:
+                    if failure:
+                        raise DiffcalcException(failure[0])
+                    break
+                self._moveToPoint(prepared)
+                self._recordPoint(groups)
+        finally:
+            stop.set()
+            producer.join()
+            for scn in scannables:
+                scn.atScanEnd()
+
+    def _samplePositionsOfAllScannables(self, groups):
+        scannables = [grp.scannable for grp in groups]
+        positions = self._runConcurrently([(methodcaller('getPosition'), scn)
+                                           for scn in scannables])
+        return dict(zip(scannables, positions))
 
     def _frange(self, limit1, limit2, increment):
         """Range function that accepts scalers or lists of floats (and integers).
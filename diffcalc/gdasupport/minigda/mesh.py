@@ -0,0 +1,191 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""
+Mesh scans over two or more dimensions.
+
+MeshScan takes the arguments of the minigda scan command, with every leading
+'scn start stop step' group spanning one dimension of the mesh. Points are
+generated lazily one row of the innermost dimension at a time, so the
+memory used does not grow with the number of points. Rows can be traversed
+in snake order, reversing direction on alternate rows (and planes) so the
+axes never retrace the mesh, and restricted to a region. A region is a
+callable taking the mesh scannables and an array of positions with one row
+per point and returning an array of flags for the points to keep, e.g.
+QShell to scan only points within a range of |Q|.
+"""
+
+from itertools import product
+
+from diffcalc.gdasupport.minigda.command import Scan
+from diffcalc.util import DiffcalcException
+
+
+class QShell(object):
+    """Region of hkl points with scattering vector length between qmin and
+    qmax (1/Angstrom).
+
+    Parameters
+    ----------
+    qmin, qmax: float
+        Limits of |Q| = |UB * hkl|.
+    ub: matrix or callable
+        UB matrix, or a function returning the current UB matrix.
+    hkl: Scannable, optional
+        Scannable whose position at the scan start supplies the hkl indices
+        not spanned by the mesh.
+    """
+
+    def __init__(self, qmin, qmax, ub, hkl=None):
+        if qmin > qmax:
+            raise DiffcalcException("Shell minimum |Q| %g exceeds maximum %g" % (qmin, qmax))
+        self.qmin = qmin
+        self.qmax = qmax
+        self.ub = ub
+        self.hkl = hkl
+        self._fixed = None
+
+    def atScanStart(self):
+        self._fixed = None if self.hkl is None else list(self.hkl.getPosition())[:3]
+
+    def __call__(self, scannables, points):
+        import numpy as np
+        fixed = self._fixed or [0., 0., 0.]
+        hkl = np.empty((len(points), 3))
+        hkl[:] = fixed
+        for i, scn in enumerate(scannables):
+            name = scn.getName()
+            if name not in ('h', 'k', 'l'):
+                raise DiffcalcException("|Q| shell regions need h, k or l mesh axes, not %s" % name)
+            hkl[:, 'hkl'.index(name)] = points[:, i]
+        ub = self.ub() if callable(self.ub) else self.ub
+        q = np.sqrt((np.dot(hkl, np.asarray(ub, dtype=float).T) ** 2).sum(axis=1))
+        return (q >= self.qmin) & (q <= self.qmax)
+
+    def __str__(self):
+        return "%g <= |Q| <= %g" % (self.qmin, self.qmax)
+
+
+class MeshScan(Scan):
+    """Scan over a mesh spanned by the leading 'scn start stop step' groups.
+
+    With snake set, the inner dimensions alternate direction so consecutive
+    points are always neighbours. With region set, only mesh points flagged
+    by region(scannables, points) are visited. Moves of fields of the same
+    scannable, like hkl.h and hkl.k, are combined into one move of the
+    parent. By default the points are prepared lookahead points ahead of
+    the motion, see Scan.
+    """
+
+    def __init__(self, scanDataHandlers, snake=True, region=None, lookahead=100,
+                 poll_interval=None, concurrent=True, checkpoint=None):
+        Scan.__init__(self, scanDataHandlers, lookahead, poll_interval, concurrent,
+                      checkpoint)
+        self.snake = snake
+        self.region = region
+
+    def _run(self, scanargs, completed=0, data=None):
+        if self.region is not None and hasattr(self.region, 'atScanStart'):
+            self.region.atScanStart()
+        Scan._run(self, scanargs, completed, data)
+
+    def _checkpointOptions(self):
+        return {'snake': self.snake,
+                'region': None if self.region is None else str(self.region)}
+
+    def _meshGroups(self, groups):
+        mesh = []
+        for grp in groups:
+            if not grp.shouldTriggerLoop():
+                break
+            mesh.append(grp)
+        if len(mesh) < 2:
+            raise DiffcalcException("A mesh scan needs at least two 'scn start stop step' groups")
+        for grp in mesh:
+            try:
+                [float(v) for v in grp.args]
+            except TypeError:
+                raise DiffcalcException("Mesh scan range of %s must be single values" %
+                                        grp.scannable.getName())
+        return mesh
+
+    def _iterRows(self, values):
+        """Yield the mesh indices of the outer dimensions and the index order
+        of the innermost dimension along every row"""
+        import numpy as np
+        inner = np.arange(len(values[-1]))
+        if not self.snake:
+            for outer in product(*[range(len(v)) for v in values[:-1]]):
+                yield outer, inner
+            return
+        # A dimension runs backwards on every other pass, so counting the
+        # passes made by the enclosing dimensions gives its direction
+        for raw in product(*[range(len(v)) for v in values[:-1]]):
+            passes = 0
+            outer = []
+            for idx, n in zip(raw, [len(v) for v in values[:-1]]):
+                outer.append(n - 1 - idx if passes % 2 else idx)
+                passes = passes * n + idx
+            yield tuple(outer), inner[::-1] if passes % 2 else inner
+
+    def iterPoints(self, groups):
+        """Yield the positions of the mesh scannables at every point in scan
+        order"""
+        import numpy as np
+        mesh = self._meshGroups(groups)
+        values = [np.asarray(self._frange(*grp.args), dtype=float) for grp in mesh]
+        scannables = [grp.scannable for grp in mesh]
+        for outer, order in self._iterRows(values):
+            row = np.empty((len(order), len(values)))
+            for i, idx in enumerate(outer):
+                row[:, i] = values[i][idx]
+            row[:, -1] = values[-1][order]
+            if self.region is not None:
+                row = row[np.asarray(self.region(scannables, row), dtype=bool)]
+            for point in row:
+                yield tuple(point)
+
+    def _iterPointMoves(self, groups, currentRecursionLevel=0, outerMoves=()):
+        mesh = self._meshGroups(groups)
+        others = self._nonLoopTriggeringMoves(groups[len(mesh):])
+        scannables = [grp.scannable for grp in mesh]
+        previous = [None] * len(mesh)
+        targets = {}
+        for point in self.iterPoints(groups):
+            moves = [(scn, pos) for scn, pos, last in zip(scannables, point, previous)
+                     if pos != last]
+            previous = point
+            yield self._combineParts(moves, targets) + others
+
+    def _combineParts(self, moves, targets):
+        """Replace moves of scannable parts by one move of their parent.
+
+        Fields not moved keep the parent's last target, so points prepared
+        ahead do not depend on where the parent is when they are prepared."""
+        result, parents = [], []
+        for scn, pos in moves:
+            parent = getattr(scn, 'getParent', lambda: None)()
+            if parent is None:
+                result.append((scn, pos))
+                continue
+            target = list(targets.get(parent) or [None] * len(parent.getInputNames()))
+            target[scn.index] = pos
+            targets[parent] = target
+            if parent not in parents:
+                parents.append(parent)
+        return result + [(parent, targets[parent]) for parent in parents]
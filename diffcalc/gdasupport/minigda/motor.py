@@ -0,0 +1,187 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""
+Simulated motors.
+
+SimulatedMotor moves like a real motor: each move starts after a command
+latency, accelerates to the motor speed and decelerates again (see
+hardware.move_time), and the motor stays busy for a settle time after
+arriving. Moves against the backlash direction overshoot the target and
+approach it from the backlash side. Read back positions can carry random
+noise from a seeded generator.
+
+Motors run on a VirtualClock. A virtual clock without a rate only moves on
+when waited on, so scans of simulated motors finish as fast as the code
+runs and take the same simulated time on every run, which makes them
+usable as benchmarks. With a rate, simulated time runs that many times
+faster than real time.
+"""
+
+import random
+import threading
+import time
+from math import sqrt
+
+from diffcalc.gdasupport.minigda.scannable import SingleFieldDummyScannable
+from diffcalc.hardware import move_time
+from diffcalc.util import DiffcalcException
+
+
+class VirtualClock(object):
+    """Clock of simulated hardware.
+
+    Parameters
+    ----------
+    rate: float, optional
+        Simulated seconds per real second, 1 for real time. By default time
+        only passes when callers wait.
+    """
+
+    def __init__(self, rate=None):
+        if rate is not None and rate <= 0:
+            raise DiffcalcException("Clock rate must be positive, not %g" % rate)
+        self.rate = rate
+        self._now = 0.
+        self._start = time.time()
+        self._lock = threading.Lock()
+
+    def time(self):
+        """Return the simulated time in seconds"""
+        if self.rate is None:
+            return self._now
+        return (time.time() - self._start) * self.rate
+
+    def sleep_until(self, when):
+        """Wait until simulated time when"""
+        if self.rate is None:
+            # Concurrent waits overlap, so the clock ends at the latest one
+            with self._lock:
+                self._now = max(self._now, when)
+            return
+        remaining = (when - self.time()) / self.rate
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def sleep(self, duration):
+        self.sleep_until(self.time() + duration)
+
+
+def _travel(distance, velocity, acceleration, t):
+    """Distance covered t seconds into a move from rest to rest"""
+    span = abs(distance)
+    ramp = min(velocity / acceleration, sqrt(span / acceleration))
+    if ramp == 0:
+        return distance
+    peak = acceleration * ramp
+    duration = span / peak + ramp
+    if t <= 0:
+        covered = 0.
+    elif t < ramp:
+        covered = .5 * acceleration * t * t
+    elif t < duration - ramp:
+        covered = .5 * acceleration * ramp * ramp + peak * (t - ramp)
+    elif t < duration:
+        covered = span - .5 * acceleration * (duration - t) ** 2
+    else:
+        covered = span
+    return covered if distance >= 0 else -covered
+
+
+class SimulatedMotor(SingleFieldDummyScannable):
+    """Single axis motor simulated on a clock.
+
+    Parameters
+    ----------
+    name: str
+    clock: VirtualClock
+    velocity, acceleration: float, optional
+        Top speed (units/s) and acceleration (units/s^2).
+    settle: float, optional
+        Time the motor stays busy after arriving.
+    latency: float, optional
+        Time between a move command and the start of motion.
+    backlash: float, optional
+        Overshoot of moves in the negative direction for positive values,
+        or in the positive direction for negative values, so targets are
+        always approached the same way.
+    noise: float, optional
+        Standard deviation of the read back position.
+    seed: int, optional
+        Seed of the read back noise.
+
+    A move commanded while the motor is moving starts from rest at the
+    position reached.
+    """
+
+    def __init__(self, name, clock, velocity=1., acceleration=2., settle=0.,
+                 latency=0., backlash=0., noise=0., seed=None, initial_position=0.):
+        SingleFieldDummyScannable.__init__(self, name, initial_position)
+        if velocity <= 0 or acceleration <= 0:
+            raise DiffcalcException("Motor %s needs a positive velocity and acceleration" % name)
+        self.clock = clock
+        self.velocity = float(velocity)
+        self.acceleration = float(acceleration)
+        self.settle = settle
+        self.latency = latency
+        self.backlash = backlash
+        self.noise = noise
+        self._random = random.Random(seed)
+        # (start time, start position, target) of the moves commanded
+        self._segments = []
+        self._done = clock.time()
+
+    def _truePosition(self, now):
+        position = self._current_position
+        for start, origin, target in self._segments:
+            if now <= start:
+                break
+            position = origin + _travel(target - origin, self.velocity,
+                                        self.acceleration, now - start)
+        return position
+
+    def asynchronousMoveTo(self, new_position):
+        report = self.checkPositionValid([new_position, ])
+        if report:
+            raise DiffcalcException(report)
+        now = self.clock.time()
+        position = self._truePosition(now)
+        target = float(new_position)
+        waypoints = [target]
+        if self.backlash and (target - position) * self.backlash < 0:
+            waypoints.insert(0, target - self.backlash)
+        start = now + self.latency
+        self._current_position = position
+        self._segments = []
+        for waypoint in waypoints:
+            self._segments.append((start, position, waypoint))
+            start += float(move_time(waypoint - position, self.velocity, self.acceleration))
+            position = waypoint
+        self._done = start + self.settle
+
+    def isBusy(self):
+        return self.clock.time() < self._done
+
+    def waitWhileBusy(self):
+        self.clock.sleep_until(self._done)
+
+    def getPosition(self):
+        position = self._truePosition(self.clock.time())
+        if self.noise:
+            position += self._random.gauss(0, self.noise)
+        return position
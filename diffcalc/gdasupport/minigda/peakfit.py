@@ -0,0 +1,230 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""
+Peak fitting of one dimensional scan data.
+
+The fit functions work on plain arrays, so saved scans can be analysed
+offline. PeakFitter collects the scanned axis and detector values from the
+minigda scan command and fits them once a scan has finished.
+"""
+
+from collections import namedtuple
+from math import log, sqrt
+
+from diffcalc.gdasupport.minigda.command import ScanDataHandler
+from diffcalc.util import DiffcalcException
+
+PEAK_SHAPES = ('gaussian', 'lorentzian', 'pseudovoigt', 'centroid')
+
+_FWHM_TO_SIGMA = 1. / (2 * sqrt(2 * log(2)))
+
+PeakFit = namedtuple('PeakFit', ('shape', 'centre', 'height', 'fwhm',
+                                 'background', 'centre_err'))
+
+
+def gaussian(x, height, centre, fwhm):
+    import numpy as np
+    sigma = fwhm * _FWHM_TO_SIGMA
+    return height * np.exp(-0.5 * ((x - centre) / sigma) ** 2)
+
+
+def lorentzian(x, height, centre, fwhm):
+    return height / (1 + (2 * (x - centre) / fwhm) ** 2)
+
+
+def pseudovoigt(x, height, centre, fwhm, eta):
+    """Linear combination of Lorentzian (weight eta) and Gaussian profiles"""
+    return (eta * lorentzian(x, height, centre, fwhm) +
+            (1 - eta) * gaussian(x, height, centre, fwhm))
+
+
+_PROFILES = {'gaussian': gaussian,
+             'lorentzian': lorentzian,
+             'pseudovoigt': pseudovoigt}
+
+
+def _as_arrays(x, y):
+    import numpy as np
+    x = np.asarray(x, dtype=float).ravel()
+    y = np.asarray(y, dtype=float).ravel()
+    if x.shape != y.shape:
+        raise DiffcalcException("Scan positions and counts have different lengths")
+    finite = np.isfinite(x) & np.isfinite(y)
+    x, y = x[finite], y[finite]
+    if len(x) < 3:
+        raise DiffcalcException("At least 3 scan points are required to find a peak")
+    order = np.argsort(x)
+    return x[order], y[order]
+
+
+def _estimate_background(y):
+    import numpy as np
+    n_edge = max(1, len(y) // 10)
+    return min(np.median(y[:n_edge]), np.median(y[-n_edge:]))
+
+
+def centroid(x, y):
+    """Find peak centre as the background subtracted centre of mass.
+
+    The width is estimated from the interpolated half maximum crossings.
+    """
+    import numpy as np
+    x, y = _as_arrays(x, y)
+    background = _estimate_background(y)
+    signal = np.clip(y - background, 0, None)
+    total = signal.sum()
+    if total <= 0:
+        raise DiffcalcException("No peak found in the scan data")
+    centre = (signal * x).sum() / total
+    height = signal.max()
+    half = height / 2.
+    above = np.flatnonzero(signal >= half)
+    # Interpolate half maximum crossings on both sides of the peak
+    i, j = above[0], above[-1]
+    left = x[i] if i == 0 else x[i - 1] + (x[i] - x[i - 1]) * (half - signal[i - 1]) / (signal[i] - signal[i - 1])
+    right = x[j] if j == len(x) - 1 else x[j] + (x[j + 1] - x[j]) * (signal[j] - half) / (signal[j] - signal[j + 1])
+    fwhm = right - left if right > left else abs(x[1] - x[0])
+    variance = (signal * (x - centre) ** 2).sum() / total
+    centre_err = sqrt(variance * (signal ** 2).sum()) / total
+    return PeakFit('centroid', centre, height, fwhm, background, centre_err)
+
+
+def fit_peak(x, y, shape='gaussian'):
+    """Fit a single peak with a constant background to scan data.
+
+    Parameters
+    ----------
+    x: array_like
+        Scanned axis positions.
+    y: array_like
+        Detector values.
+    shape: str, optional
+        One of 'gaussian', 'lorentzian', 'pseudovoigt' or 'centroid'.
+
+    Returns
+    -------
+    PeakFit:
+        Fitted profile name, peak centre, height above background, full
+        width at half maximum, background level and centre standard error.
+        The centroid result is returned if the profile could not be fitted.
+    """
+    if shape not in PEAK_SHAPES:
+        raise DiffcalcException("Unknown peak shape '%s'. Try one of: %s" %
+                                (shape, ', '.join(PEAK_SHAPES)))
+    x, y = _as_arrays(x, y)
+    guess = centroid(x, y)
+    if shape == 'centroid':
+        return guess
+    try:
+        from scipy.optimize import curve_fit
+    except ImportError:
+        return guess
+
+    import numpy as np
+    profile = _PROFILES[shape]
+    fwhm = max(guess.fwhm, np.min(np.diff(x)))
+    p0 = [guess.height, guess.centre, fwhm, guess.background]
+    if shape == 'pseudovoigt':
+        p0.insert(3, 0.5)
+    if len(x) <= len(p0):
+        return guess
+    model = lambda xx, *p: profile(xx, *p[:-1]) + p[-1]
+    try:
+        popt, pcov = curve_fit(model, x, y, p0=p0, maxfev=2000)
+    except (RuntimeError, ValueError):
+        return guess
+    height, centre, fwhm = popt[0], popt[1], abs(popt[2])
+    centre_err = sqrt(abs(pcov[1, 1])) if np.all(np.isfinite(pcov)) else float('nan')
+    if height <= 0 or not x[0] <= centre <= x[-1] or not np.isfinite(centre_err):
+        return guess
+    return PeakFit(shape, centre, height, fwhm, popt[-1], centre_err)
+
+
+class PeakFitter(ScanDataHandler):
+    """Scan data handler collecting scanned axis and detector values for
+    peak fitting.
+
+    The first field of the first scannable in a scan is used as the scanned
+    axis and the first field of the detector (the last scannable by default)
+    as the signal. With auto set, a peak is fitted and reported when every
+    scan ends.
+    """
+
+    def __init__(self, shape='gaussian', detector=None, auto=False):
+        self.shape = shape
+        self.detector = detector
+        self.auto = auto
+        self.scannables = []
+        self.axis = None
+        self.x = []
+        self.y = []
+        self.last_fit = None
+
+    def callAtScanStart(self, scannables):
+        self.scannables = scannables
+        self.axis = scannables[0]
+        self.x = []
+        self.y = []
+        self.last_fit = None
+
+    def _first_field(self, pos):
+        try:
+            return float(pos[0])
+        except (TypeError, IndexError):
+            return float(pos)
+
+    def callWithScanPoint(self, position_dict):
+        detector = self.detector if self.detector is not None else self.scannables[-1]
+        if detector is self.axis or detector not in position_dict:
+            return
+        self.x.append(self._first_field(position_dict[self.axis]))
+        self.y.append(self._first_field(position_dict[detector]))
+
+    def callAtScanEnd(self):
+        if self.auto and len(self.x) >= 3:
+            try:
+                self.fit()
+            except DiffcalcException, e:
+                print e
+                return
+            print self.str_fit()
+
+    def fit(self, shape=None):
+        """Fit peak in the data from the last scan"""
+        if not self.x:
+            raise DiffcalcException("No scan data available for peak fitting")
+        self.last_fit = fit_peak(self.x, self.y, shape or self.shape)
+        return self.last_fit
+
+    def str_fit(self):
+        if self.last_fit is None:
+            return "No peak fitted"
+        res = self.last_fit
+        return ("%s peak (%s): centre=% .5f +/- %.5f, fwhm=%.5f, height=%.5g, "
+                "background=%.5g" % (self.axis.getName(), res.shape, res.centre,
+                                     res.centre_err, res.fwhm, res.height,
+                                     res.background))
+
+    def move_to_peak(self):
+        """Move the scanned axis to the fitted peak centre and wait for it
+        to arrive"""
+        if self.last_fit is None:
+            raise DiffcalcException("No peak fitted")
+        self.axis.asynchronousMoveTo(self.last_fit.centre)
+        self.axis.waitWhileBusy()
@@ -0,0 +1,226 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""
+Columnar recording of scan data.
+
+ScanDataRecorder keeps every field of every scannable in a scan, plus a
+time stamp, in preallocated float arrays. With a directory set, the points
+are also appended in chunks to a binary file:
+
+    DIFFCALC-SCAN 1
+    {"columns": [...], ...}     json header on one line
+    rows of little endian float64 values, one per column
+
+Files can be read while the scan is still running, see read_scan_file().
+
+Values which are not numbers, and fields missing from a point, are
+recorded as NaN so a misbehaving scannable never stops a scan.
+"""
+
+import datetime
+import os
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from diffcalc.gdasupport.minigda.command import ScanDataHandler
+
+MAGIC = 'DIFFCALC-SCAN 1\n'
+
+
+def _field_names(scn):
+    return list(scn.getInputNames()) + list(scn.getExtraNames())
+
+
+def _column_names(scannables):
+    """Return a column name for every field of the scannables, named as in
+    the printed scan table. Fields of multi-field scannables clashing with
+    other names are prefixed with the scannable name."""
+    owners, names = [], []
+    for scn in scannables:
+        fields = _field_names(scn)
+        if len(fields) == 1:
+            owners.append(None)
+            names.append(scn.getName())
+        else:
+            owners.extend([scn.getName()] * len(fields))
+            names.extend(fields)
+    return [name if owner is None or names.count(name) == 1 else '%s.%s' % (owner, name)
+            for owner, name in zip(owners, names)]
+
+
+def _fields(pos):
+    if pos is None or isinstance(pos, basestring):
+        return [pos]
+    try:
+        return list(pos)
+    except TypeError:
+        return [pos]
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+class ScanDataRecorder(ScanDataHandler):
+    """Scan data handler buffering points into column arrays.
+
+    Parameters
+    ----------
+    directory: str, optional
+        Write every scan to a new numbered file in this directory.
+    prefix: str, optional
+        File name prefix.
+    chunk_points: int, optional
+        Number of points buffered before they are appended to the file.
+    capacity: int, optional
+        Number of points allocated at the start of a scan. The buffer grows
+        by doubling.
+    """
+
+    def __init__(self, directory=None, prefix='scan', chunk_points=1000, capacity=1024):
+        ScanDataHandler.__init__(self)
+        self.directory = directory
+        self.prefix = prefix
+        self.chunk_points = chunk_points
+        self.capacity = capacity
+        self.names = []
+        self.path = None
+        self._buffer = None
+        self._count = 0
+        self._written = 0
+
+    def _next_path(self):
+        numbers = [0]
+        for f in os.listdir(self.directory):
+            if f.startswith(self.prefix) and f.endswith('.bin'):
+                try:
+                    numbers.append(int(f[len(self.prefix):-len('.bin')]))
+                except ValueError:
+                    pass
+        return os.path.join(self.directory, '%s%05d.bin' % (self.prefix, max(numbers) + 1))
+
+    def callAtScanStart(self, scannables):
+        import numpy as np
+        self.scannables = scannables
+        self.names = _column_names(scannables) + ['time']
+        self._widths = [len(_field_names(scn)) for scn in scannables]
+        self._warned = set()
+        self._buffer = np.empty((self.capacity, len(self.names)), dtype='<f8')
+        self._count = 0
+        self._written = 0
+        self.path = None
+        if self.directory is not None:
+            self.path = self._next_path()
+            header = {'columns': self.names,
+                      'scannables': [scn.getName() for scn in scannables],
+                      'started': datetime.datetime.now().isoformat()}
+            with open(self.path, 'wb') as f:
+                f.write(MAGIC + json.dumps(header) + '\n')
+
+    def callWithScanPoint(self, position_dict):
+        import numpy as np
+        if self._count == len(self._buffer):
+            grown = np.empty((2 * len(self._buffer), len(self.names)), dtype='<f8')
+            grown[:self._count] = self._buffer[:self._count]
+            self._buffer = grown
+        row = []
+        for scn, width in zip(self.scannables, self._widths):
+            fields = _fields(position_dict.get(scn))
+            if len(fields) != width:
+                self._warn(scn, "%s returned %d fields, expected %d. Recording missing "
+                           "fields as NaN and dropping extra ones." %
+                           (scn.getName(), len(fields), width))
+                fields = (fields + [None] * width)[:width]
+            row.extend(_to_float(v) for v in fields)
+        row.append(time.time())
+        self._buffer[self._count] = row
+        self._count += 1
+        if self.path is not None and self._count - self._written >= self.chunk_points:
+            try:
+                self.flush()
+            except (IOError, OSError), e:
+                print ("Warning: Could not write scan data to %s, keeping it in memory "
+                       "only: %s" % (self.path, e))
+                self.path = None
+
+    def _warn(self, scn, message):
+        # Once per scannable and scan, as the same happens at every point
+        if scn not in self._warned:
+            self._warned.add(scn)
+            print "Warning: " + message
+
+    def callAtScanEnd(self):
+        self.flush()
+
+    def restore(self, rows):
+        """Add points recorded before the scan was resumed"""
+        import numpy as np
+        rows = np.asarray(rows, dtype='<f8').reshape(-1, len(self.names))
+        if self._count + len(rows) > len(self._buffer):
+            grown = np.empty((2 * (self._count + len(rows)), len(self.names)), dtype='<f8')
+            grown[:self._count] = self._buffer[:self._count]
+            self._buffer = grown
+        self._buffer[self._count:self._count + len(rows)] = rows
+        self._count += len(rows)
+
+    def flush(self):
+        """Append the points recorded since the last flush to the file"""
+        if self.path is None or self._written == self._count:
+            return
+        with open(self.path, 'ab') as f:
+            self._buffer[self._written:self._count].tofile(f)
+        self._written = self._count
+
+    @property
+    def data(self):
+        """Array of the recorded points, one column per field"""
+        if self._buffer is None:
+            return None
+        return self._buffer[:self._count]
+
+    def __getitem__(self, name):
+        """Return the values of a column as an array view"""
+        return self.data[:, self.names.index(name)]
+
+    def columns(self):
+        """Return a dictionary of column names and value arrays"""
+        return dict((name, self[name]) for name in self.names)
+
+
+def read_scan_file(path):
+    """Return the header and a dictionary of column arrays of a scan file.
+
+    A partly written last row is ignored."""
+    import numpy as np
+    with open(path, 'rb') as f:
+        if f.readline() != MAGIC:
+            raise IOError("%s is not a scan data file" % path)
+        header = json.loads(f.readline())
+        raw = f.read()
+    ncol = len(header['columns'])
+    rowsize = 8 * ncol
+    data = np.frombuffer(raw[:len(raw) // rowsize * rowsize], dtype='<f8').reshape(-1, ncol)
+    return header, dict((name, data[:, i]) for i, name in enumerate(header['columns']))
@@ -16,9 +16,36 @@
 # along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
 ###
 
+import sys
+import threading
 import time
 from diffcalc.util import DiffcalcException
 
+
+def run_concurrently(calls):
+    """Call (function, argument) pairs each in its own thread.
+
+    Return the results once all calls have returned. The first exception
+    raised by any of the calls is raised again."""
+    results = [None] * len(calls)
+    errors = []
+
+    def run(i, f, arg):
+        try:
+            results[i] = f(arg)
+        except Exception:
+            errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=run, args=(i, f, arg))
+               for i, (f, arg) in enumerate(calls)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
 try:
     from gda.device.scannable import ScannableBase, ScannaleMotionBase
 except ImportError:
@@ -33,6 +60,7 @@ except ImportError:
         inputNames = []
         extraNames = []
         outputFormat = []
+        pollInterval = .1
     
         def isBusy(self):
             raise NotImplementedError()
@@ -45,7 +73,7 @@ except ImportError:
     
         def waitWhileBusy(self):
             while self.isBusy():
-                time.sleep(.1)
+                time.sleep(self.pollInterval)
     
         def getPosition(self):
             return self.rawGetPosition()
@@ -55,6 +83,15 @@ except ImportError:
     
         def asynchronousMoveTo(self, newpos):
             self.rawAsynchronousMoveTo(newpos)
+
+        def prepareMoveTo(self, newpos):
+            """Check a target and return it in the form taken by
+            asynchronousMoveToPrepared(). Scannables computing their motor
+            positions do so here, so scans can prepare points ahead."""
+            return newpos
+
+        def asynchronousMoveToPrepared(self, prepared):
+            self.asynchronousMoveTo(prepared)
     
         def atScanStart(self):
             pass
@@ -235,6 +272,12 @@ except ImportError:
                 raise DiffcalcException(report)
             ScannableBase.asynchronousMoveTo(self, newpos)
 
+        def prepareMoveTo(self, newpos):
+            report = self.checkPositionValid([newpos,])
+            if report:
+                raise DiffcalcException(report)
+            return newpos
+
         def checkPositionValid(self, externalPosition):
             limitsComponentMsg = self.limitsComponent.checkInternalPosition(externalPosition)
             if limitsComponentMsg:
@@ -282,6 +325,17 @@ except ImportError:
         
         def asynchronousMoveTo(self, newpos):
             self.delegate_scn.asynchronousMoveTo(newpos - self.offset)
+
+        def prepareMoveTo(self, newpos):
+            prepare = getattr(self.delegate_scn, 'prepareMoveTo', None)
+            if prepare is None:
+                return newpos - self.offset
+            return prepare(newpos - self.offset)
+
+        def asynchronousMoveToPrepared(self, prepared):
+            move = getattr(self.delegate_scn, 'asynchronousMoveToPrepared',
+                           self.delegate_scn.asynchronousMoveTo)
+            move(prepared)
             
         def __repr__(self):
             pos = self.getPosition()
@@ -387,9 +441,14 @@ class ZeroInputExtraFieldsDummyScannable(ScannableMotionBase):
 
 
 class ScannableGroup(ScannableBase):
-    """wraps up motors. Simulates motors if non given."""
+    """wraps up motors. Simulates motors if non given.
 
-    def __init__(self, name, motorList):
+    With concurrent set, the members' moves are started each in their own
+    thread, for motors whose asynchronousMoveTo blocks until they arrive.
+    """
+
+    def __init__(self, name, motorList, concurrent=False):
+        self.concurrent = concurrent
 
         self.setName(name)
         # Set input format
@@ -413,8 +472,12 @@ class ScannableGroup(ScannableBase):
                 if val is None:
                     position[idx] = current[idx]
 
-        for scn, pos in zip(self.__motors, position):
-            scn.asynchronousMoveTo(pos)
+        moves = [(scn.asynchronousMoveTo, pos) for scn, pos in zip(self.__motors, position)]
+        if self.concurrent:
+            run_concurrently(moves)
+        else:
+            for move, pos in moves:
+                move(pos)
 
     def getPosition(self):
         return [scn.getPosition() for scn in self.__motors]
@@ -434,6 +497,10 @@ class ScannableGroup(ScannableBase):
                 return True
         return False
 
+    def waitWhileBusy(self):
+        for scn in self.__motors:
+            scn.waitWhileBusy()
+
     def configure(self):
         pass
 
@@ -573,6 +640,11 @@ class ScannableMotionWithScannableFieldsBase(ScannableMotionBase):
             newpos = self.completePosition(newpos)
         ScannableBase.asynchronousMoveTo(self, newpos)
 
+    def prepareMoveTo(self, newpos):
+        if self.autoCompletePartialMoveToTargets:
+            newpos = self.completePosition(list(newpos))
+        return newpos
+
     def completePosition(self, position):
         '''
         If position contains any null or None values, these are replaced with
@@ -635,10 +707,19 @@ class ScannableMotionWithScannableFieldsBase(ScannableMotionBase):
                     " cannot be moved because " +
                     self.parentScannable.getName() + " is already moving")
 
+            self.parentScannable.asynchronousMoveTo(self._parentTarget(new_position))
+
+        def _parentTarget(self, new_position):
             toMoveTo = [None] * len(self.parentScannable.getInputNames())
             toMoveTo[self.index] = new_position
-            self.parentScannable.asynchronousMoveTo(toMoveTo)
-            
+            return toMoveTo
+
+        def prepareMoveTo(self, new_position):
+            return self.parentScannable.prepareMoveTo(self._parentTarget(new_position))
+
+        def asynchronousMoveToPrepared(self, prepared):
+            self.parentScannable.asynchronousMoveToPrepared(prepared)
+
         def moveTo(self, new_position):
             self.asynchronousMoveTo(new_position)
             self.waitWhileBusy()
@@ -0,0 +1,244 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""
+Coarse to fine search for a reflection around a predicted position.
+
+A coarse mesh over all search axes locates the strongest point in the search
+volume. Each following level scans the axes one at a time over a range
+shrinking with every level and moves them to the fitted peak centres. The
+search stops early once all peaks are significant and the axes have stopped
+moving by more than the tolerance.
+"""
+
+from collections import namedtuple
+from math import sqrt
+
+from diffcalc.gdasupport.minigda.command import Scan, ScanDataHandler, \
+    ScanDataPrinter
+from diffcalc.gdasupport.minigda.peakfit import fit_peak
+from diffcalc.util import DiffcalcException
+
+SearchStep = namedtuple('SearchStep', ('level', 'axis', 'fit', 'significance'))
+
+
+def significance(y, height, background):
+    """Return peak height in units of the background noise.
+
+    The noise is the larger of the Poisson estimate from the background level
+    and the robust spread of the points below half maximum.
+    """
+    import numpy as np
+    y = np.asarray(y, dtype=float)
+    tail = y[y < background + height / 2.]
+    spread = 1.4826 * np.median(abs(tail - np.median(tail))) if len(tail) else 0.
+    noise = max(spread, sqrt(max(background, 0.)))
+    if noise <= 0:
+        return float('inf') if height > 0 else 0.
+    return height / noise
+
+
+class _PointCollector(ScanDataHandler):
+    """Records the positions of the scanned axes and detector value at
+    every scan point"""
+
+    def __init__(self, axes, detector):
+        self.axes = axes
+        self.detector = detector
+        self.points = []
+        self.counts = []
+
+    def callAtScanStart(self, scannables):
+        self.points = []
+        self.counts = []
+
+    def callWithScanPoint(self, position_dict):
+        self.points.append([float(position_dict[scn]) for scn in self.axes])
+        count = position_dict[self.detector]
+        try:
+            count = count[0]
+        except (TypeError, IndexError):
+            pass
+        self.counts.append(float(count))
+
+
+class ReflectionSearch(object):
+    """Hierarchical search for a reflection by scanning sample axes.
+
+    Parameters
+    ----------
+    axes: list of Scannable
+        Single field scannables to search over, e.g. eta and chi.
+    counter: Scannable
+        Detector read at every scan point.
+    shape: str, optional
+        Peak profile fitted in the fine scans.
+    coarse_points: int, optional
+        Number of points along each axis of the coarse mesh.
+    points: int, optional
+        Number of points in each fine scan.
+    levels: int, optional
+        Maximum number of fine scan levels.
+    shrink: float, optional
+        Factor by which the scan range is reduced at each fine level.
+    threshold: float, optional
+        Minimum peak significance, see significance().
+    tolerance: float, optional
+        Axis movement below which the search is considered converged.
+        Defaults to half the step of the current fine level.
+    verbose: bool, optional
+        Print scan data while searching.
+    """
+
+    def __init__(self, axes, counter, shape='gaussian', coarse_points=7,
+                 points=11, levels=3, shrink=4., threshold=5., tolerance=None,
+                 verbose=False):
+        if coarse_points < 2 or points < 3:
+            raise DiffcalcException("Search needs at least 2 coarse and 3 fine scan points")
+        self.axes = list(axes)
+        self.counter = counter
+        self.shape = shape
+        self.coarse_points = coarse_points
+        self.points = points
+        self.levels = levels
+        self.shrink = float(shrink)
+        self.threshold = threshold
+        self.tolerance = tolerance
+        self.verbose = verbose
+        self.steps = []
+
+    def _scan(self, collector, *args):
+        handlers = [collector]
+        if self.verbose:
+            handlers.insert(0, ScanDataPrinter())
+        Scan(handlers)(*args)
+        return collector
+
+    def _move(self, position):
+        for scn, pos in zip(self.axes, position):
+            scn.asynchronousMoveTo(pos)
+        for scn in self.axes:
+            scn.waitWhileBusy()
+
+    def coarse_search(self, centre, widths):
+        """Scan a mesh over the search volume and move to its strongest point.
+
+        Return the significance of the strongest point.
+        """
+        args = []
+        for scn, pos, width in zip(self.axes, centre, widths):
+            step = float(width) / (self.coarse_points - 1)
+            args.extend([scn, pos - width / 2., pos + width / 2., step])
+        args.append(self.counter)
+        collector = self._scan(_PointCollector(self.axes, self.counter), *args)
+
+        import numpy as np
+        counts = np.array(collector.counts)
+        background = np.median(counts)
+        best = int(np.argmax(counts))
+        sig = significance(counts, counts[best] - background, background)
+        self.steps.append(SearchStep(0, None, None, sig))
+        if sig < self.threshold:
+            self._move(centre)
+            raise DiffcalcException(
+                "No significant peak found in the search volume (significance "
+                "%.3g < %.3g). Try a larger uncertainty." % (sig, self.threshold))
+        self._move(collector.points[best])
+        return sig
+
+    def fine_search(self, level, widths):
+        """Scan each axis in turn around its current position and move it to
+        the fitted peak.
+
+        Return True if all peaks are significant and no axis moved by more
+        than the tolerance.
+        """
+        converged = True
+        for scn, width in zip(self.axes, widths):
+            step = float(width) / (self.points - 1)
+            tolerance = step / 2. if self.tolerance is None else self.tolerance
+            start = float(scn.getPosition())
+            collector = self._scan(_PointCollector([scn], self.counter), scn,
+                                   start - width / 2., start + width / 2., step,
+                                   self.counter)
+            x = [p[0] for p in collector.points]
+            try:
+                fit = fit_peak(x, collector.counts, self.shape)
+            except DiffcalcException:
+                fit, sig = None, 0.
+            else:
+                sig = significance(collector.counts, fit.height, fit.background)
+            self.steps.append(SearchStep(level, scn.getName(), fit, sig))
+            if fit is None or sig < self.threshold:
+                scn.asynchronousMoveTo(start)
+                scn.waitWhileBusy()
+                converged = False
+                continue
+            scn.asynchronousMoveTo(fit.centre)
+            scn.waitWhileBusy()
+            if abs(fit.centre - start) > tolerance:
+                converged = False
+        return converged
+
+    def search(self, centre, widths):
+        """Search for a peak in a volume around a predicted position.
+
+        Parameters
+        ----------
+        centre: list of float
+            Predicted position of the search axes.
+        widths: float or list of float
+            Full width of the search volume along each axis.
+
+        Returns
+        -------
+        list of float:
+            Position of the search axes at the peak. The axes are left there.
+        """
+        if len(centre) != len(self.axes):
+            raise DiffcalcException("Expected %d search axis positions" % len(self.axes))
+        try:
+            widths = [float(w) for w in widths]
+        except TypeError:
+            widths = [float(widths)] * len(self.axes)
+        self.steps = []
+        self.coarse_search(centre, widths)
+        # First fine level spans two coarse mesh steps around the best point
+        widths = [2. * w / (self.coarse_points - 1) for w in widths]
+        for level in range(1, self.levels + 1):
+            if self.fine_search(level, widths):
+                break
+            widths = [w / self.shrink for w in widths]
+        else:
+            if not any(st.significance >= self.threshold
+                       for st in self.steps if st.level == self.levels):
+                raise DiffcalcException("Peak lost while refining the search")
+        return [float(scn.getPosition()) for scn in self.axes]
+
+    def str_steps(self):
+        lines = []
+        for st in self.steps:
+            if st.level == 0:
+                lines.append("  coarse mesh: significance=%.3g" % st.significance)
+            elif st.fit is None:
+                lines.append("  level %d %s: no peak" % (st.level, st.axis))
+            else:
+                lines.append("  level %d %s: centre=% .5f fwhm=%.5f significance=%.3g" %
+                             (st.level, st.axis, st.fit.centre, st.fit.fwhm,
+                              st.significance))
+        return '\n'.join(lines)
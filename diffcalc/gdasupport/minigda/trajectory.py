@@ -0,0 +1,390 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""
+Fly scan trajectories.
+
+An hkl path is sampled densely with the diffraction calculator and turned
+into time-position-velocity (PVT) profiles, one per axis, as taken by
+motion controllers running trajectory scans. Between the profile points
+each axis follows the cubic polynomial fixed by the positions and
+velocities at both ends. Segment times are stretched until no axis
+exceeds its speed or acceleration, and run-up and run-down segments are
+added so the axes pass the first and last path points at speed.
+
+Before a profile is used the sampled path is checked for jumps in the axes
+or the virtual angles (a change of solution branch) and the whole profile,
+including the run-up and run-down, is checked against the axis limits.
+SimulatedTrajectoryExecutor plays a profile back without hardware.
+"""
+
+import time
+
+from diffcalc.util import DiffcalcException
+
+
+def _hermite(t, dt, p0, p1, v0, v1):
+    """Position and velocity at time t into a segment of cubic motion"""
+    s = t / dt
+    h00 = 2 * s ** 3 - 3 * s ** 2 + 1
+    h10 = s ** 3 - 2 * s ** 2 + s
+    h01 = -2 * s ** 3 + 3 * s ** 2
+    h11 = s ** 3 - s ** 2
+    pos = h00 * p0 + h10 * dt * v0 + h01 * p1 + h11 * dt * v1
+    vel = ((6 * s ** 2 - 6 * s) * p0 + (3 * s ** 2 - 4 * s + 1) * dt * v0 +
+           (-6 * s ** 2 + 6 * s) * p1 + (3 * s ** 2 - 2 * s) * dt * v1) / dt
+    return pos, vel
+
+
+def _segment_accelerations(dt, dp, v0, v1):
+    """Accelerations at the start and end of segments of cubic motion. The
+    acceleration changes linearly, so these are its extremes."""
+    dt = dt[:, None]
+    a0 = (6 * dp - 4 * v0 * dt - 2 * v1 * dt) / dt ** 2
+    a1 = (-6 * dp + 2 * v0 * dt + 4 * v1 * dt) / dt ** 2
+    return a0, a1
+
+
+def _segment_peak_speeds(dt, v0, v1, a0, a1):
+    """Largest speeds within segments of cubic motion, reached at the ends
+    or where the acceleration changes sign"""
+    import numpy as np
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = a0 / (a0 - a1)
+    inside = (s > 0) & (s < 1)
+    turning = np.where(inside, abs(v0 + a0 * dt[:, None] * np.where(inside, s, 0) / 2), 0.)
+    return np.maximum(np.maximum(abs(v0), abs(v1)), turning)
+
+
+def _point_velocities(dt, dp):
+    """Velocities at the path points from the neighbouring segment slopes"""
+    import numpy as np
+    slopes = dp / dt[:, None]
+    v = np.empty((len(dp) + 1, dp.shape[1]))
+    v[0] = slopes[0]
+    v[-1] = slopes[-1]
+    if len(dp) > 1:
+        w0, w1 = dt[1:, None], dt[:-1, None]
+        v[1:-1] = (slopes[:-1] * w0 + slopes[1:] * w1) / (w0 + w1)
+    return v
+
+
+class TrajectoryProfile(object):
+    """Time, position and velocity of every axis at every profile point.
+
+    Attributes
+    ----------
+    names: list of str
+        Axis names.
+    times: ndarray
+        (N,) times in seconds from the start of the run-up.
+    positions, velocities: ndarray
+        (N, naxes) positions (deg) and velocities (deg/s).
+    path: slice
+        Profile points sampled from the path, i.e. without the run-up and
+        run-down points.
+    hkl: ndarray
+        (npath, 3) hkl of the path points if planned by HklFlyScan.
+    """
+
+    def __init__(self, names, times, positions, velocities, path, hkl=None):
+        self.names = list(names)
+        self.hkl = hkl
+        self.times = times
+        self.positions = positions
+        self.velocities = velocities
+        self.path = path
+
+    @property
+    def duration(self):
+        return self.times[-1]
+
+    @property
+    def path_times(self):
+        return self.times[self.path]
+
+    def pvt(self, name):
+        """Return (time since previous point, position, velocity) tuples of
+        one axis"""
+        i = self.names.index(name)
+        deltas = [0.] + [float(dt) for dt in self.times[1:] - self.times[:-1]]
+        return zip(deltas, self.positions[:, i].tolist(), self.velocities[:, i].tolist())
+
+    def to_dict(self):
+        """Return the profile as a json serialisable dictionary of per-axis
+        position and velocity lists sharing a list of time deltas"""
+        deltas = [0.] + (self.times[1:] - self.times[:-1]).tolist()
+        return {'axes': self.names,
+                'time_deltas': deltas,
+                'positions': dict((name, self.positions[:, i].tolist())
+                                  for i, name in enumerate(self.names)),
+                'velocities': dict((name, self.velocities[:, i].tolist())
+                                   for i, name in enumerate(self.names)),
+                'path_start': self.path.start,
+                'path_stop': self.path.stop}
+
+    def state_at(self, t):
+        """Return (naxes,) arrays of the positions and velocities at time t"""
+        import numpy as np
+        t = min(max(float(t), 0.), self.duration)
+        i = max(0, min(int(np.searchsorted(self.times, t, 'right')) - 1, len(self.times) - 2))
+        dt = self.times[i + 1] - self.times[i]
+        return _hermite(t - self.times[i], dt, self.positions[i], self.positions[i + 1],
+                        self.velocities[i], self.velocities[i + 1])
+
+    def sample(self, substeps=10):
+        """Return times and (M, naxes) positions at substeps points within
+        every segment"""
+        import numpy as np
+        dt = np.diff(self.times)
+        s = np.arange(substeps) / float(substeps)
+        t = (self.times[:-1, None] + dt[:, None] * s).ravel()
+        pos, _ = _hermite((dt[:, None] * s)[:, :, None], dt[:, None, None],
+                          self.positions[:-1, None], self.positions[1:, None],
+                          self.velocities[:-1, None], self.velocities[1:, None])
+        pos = pos.reshape(-1, len(self.names))
+        return np.append(t, self.times[-1]), np.vstack([pos, self.positions[-1]])
+
+    def limit_violations(self, lower, upper, substeps=10):
+        """Return (time, axis name, position) of the first point beyond the
+        limits of every axis leaving them.
+
+        lower and upper hold one limit per axis, None for no limit."""
+        import numpy as np
+        times, pos = self.sample(substeps)
+        result = []
+        for i, name in enumerate(self.names):
+            low = -np.inf if lower[i] is None else lower[i]
+            high = np.inf if upper[i] is None else upper[i]
+            bad = np.flatnonzero((pos[:, i] < low - 1e-9) | (pos[:, i] > high + 1e-9))
+            if len(bad):
+                result.append((times[bad[0]], name, pos[bad[0], i]))
+        return result
+
+    def __str__(self):
+        lines = ['%d profile points, %.3f s (path %.3f s, run-up %.3f s, run-down %.3f s)' % (
+            len(self.times), self.duration, self.path_times[-1] - self.path_times[0],
+            self.path_times[0], self.duration - self.path_times[-1])]
+        vmax = abs(self.velocities).max(axis=0)
+        for name, first, last, v in zip(self.names, self.positions[0],
+                                        self.positions[-1], vmax):
+            lines.append('  %5s: % 9.4f -> % 9.4f  max speed %.4f deg/s' % (name, first, last, v))
+        return '\n'.join(lines)
+
+
+def build_profile(names, positions, velocity, acceleration, duration=None,
+                  max_iterations=100):
+    """Build a PVT profile through positions sampled along a path.
+
+    Parameters
+    ----------
+    names: list of str
+        Axis names.
+    positions: array_like
+        (N, naxes) axis positions in degrees along the path.
+    velocity, acceleration: array_like
+        Speed (deg/s) and acceleration (deg/s^2) limits of each axis.
+    duration: float, optional
+        Time to spend on the path. Segments are stretched beyond the even
+        share of this time where the axes could not follow otherwise. By
+        default the path is run as fast as the axes allow.
+
+    Returns
+    -------
+    TrajectoryProfile
+    """
+    import numpy as np
+    positions = np.asarray(positions, dtype=float)
+    velocity = np.asarray(velocity, dtype=float)
+    acceleration = np.asarray(acceleration, dtype=float)
+    if len(positions) < 2:
+        raise DiffcalcException("A trajectory needs at least two path points")
+    dp = np.diff(positions, axis=0)
+    dt = (abs(dp) / velocity).max(axis=1)
+    if duration is not None:
+        dt = np.maximum(dt, float(duration) / len(dp))
+    dt = np.maximum(dt, 1e-6)
+    for _ in range(max_iterations):
+        v = _point_velocities(dt, dp)
+        a0, a1 = _segment_accelerations(dt, dp, v[:-1], v[1:])
+        accel_ratio = (np.maximum(abs(a0), abs(a1)) / acceleration).max(axis=1)
+        speed_ratio = (_segment_peak_speeds(dt, v[:-1], v[1:], a0, a1) / velocity).max(axis=1)
+        # Velocities fall as 1/dt and accelerations as 1/dt**2
+        stretch = np.maximum(np.maximum(speed_ratio, np.sqrt(accel_ratio)), 1.)
+        if np.all(stretch <= 1 + 1e-9):
+            break
+        dt = dt * np.where(stretch > 1 + 1e-9, stretch * 1.01, 1.)
+    else:
+        raise DiffcalcException("No trajectory found within the axis speed and acceleration "
+                                "limits. Sample the path more densely.")
+
+    # Constant acceleration from and to rest before and after the path
+    t_up = (abs(v[0]) / acceleration).max()
+    t_down = (abs(v[-1]) / acceleration).max()
+    times = [np.concatenate([[0.], np.cumsum(dt)])]
+    pos = [positions]
+    vel = [v]
+    path_start = 0
+    if t_up > 0:
+        times.insert(0, [-t_up])
+        pos.insert(0, [positions[0] - v[0] * t_up / 2])
+        vel.insert(0, [np.zeros(len(names))])
+        path_start = 1
+    if t_down > 0:
+        times.append([times[-1][-1] + t_down])
+        pos.append([positions[-1] + v[-1] * t_down / 2])
+        vel.append([np.zeros(len(names))])
+    times = np.concatenate(times) + t_up
+    return TrajectoryProfile(names, times, np.vstack(pos), np.vstack(vel),
+                             slice(path_start, path_start + len(positions)))
+
+
+def path_jumps(names, values, max_jump, wrap=False):
+    """Return (index, name, jump) for steps between consecutive path points
+    larger than max_jump, i.e. steps from point index to index + 1.
+
+    With wrap set, differences are taken modulo 360 degrees."""
+    import numpy as np
+    steps = np.diff(np.asarray(values, dtype=float), axis=0)
+    if wrap:
+        steps = (steps + 180.) % 360. - 180.
+    result = []
+    for idx, col in zip(*np.nonzero(abs(steps) > max_jump)):
+        result.append((int(idx), names[col], float(steps[idx, col])))
+    return result
+
+
+class HklFlyScan(object):
+    """Plans fly scans along straight lines in reciprocal space.
+
+    Parameters
+    ----------
+    hkl_to_angles: callable
+        Function taking h, k and l and returning axis positions and a
+        dictionary of virtual angles.
+    names: list of str
+        Axis names.
+    velocity, acceleration: list of float
+        Axis speed and acceleration limits.
+    lower, upper: list of float
+        Axis limits, None for no limit.
+    max_jump: float, optional
+        Largest change in degrees of any axis or virtual angle between
+        neighbouring path points accepted as continuous.
+    """
+
+    def __init__(self, hkl_to_angles, names, velocity, acceleration, lower, upper,
+                 max_jump=1.):
+        self.hkl_to_angles = hkl_to_angles
+        self.names = list(names)
+        self.velocity = velocity
+        self.acceleration = acceleration
+        self.lower = lower
+        self.upper = upper
+        self.max_jump = max_jump
+
+    def sample_path(self, start, stop, npoints):
+        """Return (N, 3) hkl, (N, naxes) positions and the virtual angle
+        names and (N, nangles) values at npoints along the path"""
+        import numpy as np
+        if npoints < 2:
+            raise DiffcalcException("A fly scan needs at least two path points")
+        hkl = np.linspace(0., 1., npoints)[:, None] * (np.subtract(stop, start, dtype=float)) + start
+        positions, virtual = [], []
+        for i, (h, k, l) in enumerate(hkl):
+            try:
+                pos, params = self.hkl_to_angles(h, k, l)
+            except DiffcalcException, e:
+                raise DiffcalcException("Path point %d %s can not be reached: %s" %
+                                        (i, tuple(hkl[i]), e.message))
+            positions.append(list(pos))
+            virtual.append(params)
+        angle_names = sorted(virtual[0])
+        values = [[params[name] for name in angle_names] for params in virtual]
+        return hkl, np.array(positions), angle_names, np.array(values)
+
+    def plan(self, start, stop, npoints, duration=None):
+        """Sample the path, check it and return its TrajectoryProfile.
+
+        Raises DiffcalcException if the solution jumps between path points or
+        the axes leave their limits anywhere along the profile.
+        """
+        hkl, positions, angle_names, values = self.sample_path(start, stop, npoints)
+        jumps = (path_jumps(self.names, positions, self.max_jump) +
+                 path_jumps(angle_names, values, self.max_jump, wrap=True))
+        if jumps:
+            idx, name, jump = min(jumps)
+            raise DiffcalcException(
+                "Solution not continuous along the path: %s changes by %.4f between "
+                "%s and %s. Sample the path more densely or change the constraints." %
+                (name, jump, tuple(hkl[idx]), tuple(hkl[idx + 1])))
+        profile = build_profile(self.names, positions, self.velocity, self.acceleration,
+                                duration)
+        violations = profile.limit_violations(self.lower, self.upper)
+        if violations:
+            t, name, pos = min(violations)
+            raise DiffcalcException("Trajectory leaves the limits of %s (%.4f) at %.3f s" %
+                                    (name, pos, t))
+        profile.hkl = hkl
+        return profile
+
+
+class SimulatedTrajectoryExecutor(object):
+    """Plays a TrajectoryProfile back in place of a motion controller.
+
+    Parameters
+    ----------
+    profile: TrajectoryProfile
+    realtime: bool, optional
+        Wait for the profile times to pass. By default the profile is run
+        without waiting.
+    """
+
+    def __init__(self, profile, realtime=False):
+        self.profile = profile
+        self.realtime = realtime
+        self.time = 0.
+
+    def run(self, move=None, trigger=None, interval=None):
+        """Run the profile.
+
+        move(positions) is called at every profile point and, with interval
+        set, every interval seconds in between. trigger(index, time, positions) is
+        called at every path point, as a controller would trigger detectors.
+        """
+        import numpy as np
+        profile = self.profile
+        times = profile.times
+        if interval:
+            extra = np.arange(0., profile.duration, float(interval))
+            times = np.union1d(times, extra)
+        path_times = profile.path_times
+        path_index = dict((t, i) for i, t in enumerate(path_times))
+        start = time.time()
+        for t in times:
+            if self.realtime:
+                wait = start + t - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            self.time = t
+            pos, _ = profile.state_at(t)
+            if move is not None:
+                move(pos)
+            if trigger is not None and t in path_index:
+                trigger(path_index[t], t, pos)
+        return self.time
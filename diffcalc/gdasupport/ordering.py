@@ -0,0 +1,332 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""
+Travel-optimised ordering of measurement queues.
+
+The time to move between two diffractometer positions is that of the
+slowest axis, every axis moving from rest to rest with the speed and
+acceleration held by the hardware adapter (see hardware.move_time). The
+queue is ordered as an open travelling salesman tour starting from the
+current position: a nearest neighbour tour improved by 2-opt and Or-opt
+moves. Only moves joining each position to one of its closest neighbours
+are tried, so queues of 10^4 positions are ordered in seconds without
+holding the full matrix of travel times.
+"""
+
+from math import sqrt
+
+from diffcalc.hardware import move_time
+from diffcalc.util import DiffcalcException
+
+
+def travel_times(source, targets, velocity, acceleration):
+    """Return the times to move from position source to each of targets"""
+    import numpy as np
+    steps = np.asarray(targets, dtype=float) - np.asarray(source, dtype=float)
+    return move_time(steps, velocity, acceleration).max(axis=-1)
+
+
+def _closest(source, candidates, count, scaled, velocity, acceleration):
+    """Return the indices of the count candidates closest to the source
+    node, closest first, and the travel times to them.
+
+    Candidates are shortlisted by the time the slowest axis spends at full
+    speed, taken from the positions scaled by the axis speeds, and the
+    shortlist ranked by travel time."""
+    import numpy as np
+    shortlist = min(3 * count, len(candidates))
+    approx = abs(scaled[candidates] - scaled[source]).max(axis=1)
+    if shortlist < len(candidates):
+        candidates = candidates[np.argpartition(approx, shortlist - 1)[:shortlist]]
+    times = travel_times(scaled[source] * velocity, scaled[candidates] * velocity,
+                         velocity, acceleration)
+    order = np.argsort(times)[:count]
+    return candidates[order], times[order]
+
+
+def _nearest_neighbours(positions, velocity, acceleration, count):
+    """Return indices of the count closest positions to every position,
+    closest first, and the travel times to them"""
+    import numpy as np
+    n = len(positions)
+    count = min(count, n - 1)
+    scaled = positions / velocity
+    # Axes at the same position everywhere do not change the shortlist
+    moving = [axis.astype(np.float32) for axis in scaled.T if axis.min() < axis.max()]
+    shortlist = min(3 * count, n - 1)
+    neighbours = np.empty((n, count), dtype=int)
+    times = np.empty((n, count))
+    # Work on blocks of rows to bound the memory used
+    block = max(1, 4000000 // n)
+    for first in range(0, n, block):
+        rows = np.arange(first, min(first + block, n))
+        approx = np.zeros((len(rows), n), dtype=np.float32)
+        step = np.empty_like(approx)
+        for axis in moving:
+            np.subtract(axis[rows, None], axis[None, :], out=step)
+            np.maximum(approx, np.abs(step, out=step), out=approx)
+        approx[np.arange(len(rows)), rows] = np.inf
+        candidates = np.argpartition(approx, shortlist - 1, axis=1)[:, :shortlist]
+        cost = travel_times(positions[rows, None, :], positions[candidates],
+                            velocity, acceleration)
+        order = np.argsort(cost, axis=1)[:, :count]
+        picked = np.arange(len(rows))[:, None], order
+        neighbours[rows] = candidates[picked]
+        times[rows] = cost[picked]
+    return neighbours, times
+
+
+def tour_time(positions, order, velocity, acceleration, start=None):
+    """Return the time to visit positions in the given order, from start
+    if given"""
+    import numpy as np
+    path = np.asarray(positions, dtype=float)[list(order)]
+    if start is not None:
+        path = np.vstack([start, path])
+    if len(path) < 2:
+        return 0.
+    return float(travel_times(path[:-1], path[1:], velocity, acceleration).sum())
+
+
+def order_positions(positions, velocity, acceleration, start, neighbours=10,
+                    max_segment=3):
+    """Order positions to minimise the time to visit them all from start.
+
+    Parameters
+    ----------
+    positions: array_like
+        (N, naxes) positions to visit.
+    velocity, acceleration: array_like
+        Speed and acceleration of every axis.
+    start: array_like
+        Position the tour starts from.
+    neighbours: int, optional
+        Number of closest positions considered when improving the tour.
+    max_segment: int, optional
+        Longest run of positions moved at once by Or-opt.
+
+    Returns
+    -------
+    list of int
+        Indices into positions in visiting order.
+    """
+    import numpy as np
+    positions = np.asarray(positions, dtype=float)
+    if not len(positions):
+        return []
+    # Node 0 is the start, node i + 1 is positions[i]
+    nodes = np.vstack([start, positions])
+    n = len(nodes)
+    velocity = np.broadcast_to(np.asarray(velocity, dtype=float), nodes.shape[1])
+    acceleration = np.broadcast_to(np.asarray(acceleration, dtype=float), nodes.shape[1])
+    scaled = nodes / velocity
+    neighbour_index, neighbour_times = _nearest_neighbours(nodes, velocity, acceleration,
+                                                           neighbours)
+    neighbour_list = [zip(*pair) for pair in zip(neighbour_index.tolist(),
+                                                 neighbour_times.tolist())]
+    points = nodes.tolist()
+    axes = [(float(v), float(a), float(v) ** 2 / a)
+            for v, a in zip(velocity, acceleration)]
+
+    def cost(i, j):
+        # None stands for the open end of the tour
+        if i is None or j is None:
+            return 0.
+        slowest = 0.
+        for x, y, (v, a, ramp) in zip(points[i], points[j], axes):
+            d = abs(x - y)
+            t = d / v + v / a if d > ramp else 2 * sqrt(d / a)
+            if t > slowest:
+                slowest = t
+        return slowest
+
+    # Nearest neighbour tour, scanning all nodes when the closest
+    # neighbours are all visited
+    visited = np.zeros(n, dtype=bool)
+    visited[0] = True
+    tour = [0]
+    for _ in range(n - 1):
+        last = tour[-1]
+        following = next((j for j, _ in neighbour_list[last] if not visited[j]), None)
+        if following is None:
+            remaining = np.flatnonzero(~visited)
+            closest, _ = _closest(last, remaining, 1, scaled, velocity, acceleration)
+            following = int(closest[0])
+        visited[following] = True
+        tour.append(following)
+
+    where = [0] * n
+    for k, node in enumerate(tour):
+        where[node] = k
+
+    def after(k):
+        return tour[k + 1] if k + 1 < n else None
+
+    def reverse(first, last):
+        tour[first:last + 1] = tour[first:last + 1][::-1]
+        for k in range(first, last + 1):
+            where[tour[k]] = k
+
+    def two_opt(node):
+        """Try joining node to one of its neighbours by reversing the path
+        between them. Return the nodes whose edges changed."""
+        i = where[node]
+        succ = after(i)
+        d_succ = cost(node, succ)
+        for other, d_new in neighbour_list[node]:
+            if d_new >= d_succ:
+                break
+            j = where[other]
+            if j > i:
+                # Replace edges node-succ and other-next by node-other and
+                # succ-next, reversing succ..other
+                following = after(j)
+                gain = d_succ + cost(other, following) - d_new - cost(succ, following)
+                if gain > 1e-9:
+                    reverse(i + 1, j)
+                    return [node, succ, other, following]
+            elif j + 1 < i:
+                # Replace edges other-next and node-succ by other-node and
+                # next-succ, reversing next..node
+                following = tour[j + 1]
+                gain = d_succ + cost(other, following) - d_new - cost(following, succ)
+                if gain > 1e-9:
+                    reverse(j + 1, i)
+                    return [node, succ, other, following]
+        return []
+
+    def or_opt(node):
+        """Try moving the segment starting at node between one of its
+        neighbours and the next node. Return the nodes whose edges
+        changed."""
+        i = where[node]
+        if i == 0:
+            return []
+        for length in range(1, max_segment + 1):
+            if i + length > n:
+                break
+            last = tour[i + length - 1]
+            before, beyond = tour[i - 1], after(i + length - 1)
+            removed = cost(before, node) + cost(last, beyond) - cost(before, beyond)
+            # Insert the segment after other, either way round, joining other
+            # to the first node inserted
+            for head, tail in ((node, last), (last, node)):
+                for other, d_head in neighbour_list[head]:
+                    if d_head >= removed:
+                        break
+                    j = where[other]
+                    if i - 1 <= j < i + length:
+                        continue
+                    following = after(j)
+                    added = d_head + cost(tail, following) - cost(other, following)
+                    if removed - added > 1e-9:
+                        segment = tour[i:i + length]
+                        if head != node:
+                            segment.reverse()
+                        rest = tour[:i] + tour[i + length:]
+                        k = rest.index(other) + 1
+                        tour[:] = rest[:k] + segment + rest[k:]
+                        for m, moved in enumerate(tour):
+                            where[moved] = m
+                        return [node, last, before, beyond, other, following]
+        return []
+
+    # Improve the tour until no move helps, only revisiting nodes whose
+    # edges changed
+    active = set(range(n))
+    queue = list(range(n))
+    while queue:
+        node = queue.pop()
+        active.discard(node)
+        changed = two_opt(node) or or_opt(node)
+        for other in changed:
+            if other is not None and other not in active:
+                active.add(other)
+                queue.append(other)
+    return [node - 1 for node in tour[1:]]
+
+
+class QueueOrder(object):
+    """Measurement queue ordered to minimise travel time.
+
+    Attributes
+    ----------
+    targets: list
+        Targets in visiting order, unreachable ones left out.
+    order: list of int
+        Indices of targets in the queue as given.
+    positions: ndarray
+        Diffractometer positions in visiting order.
+    unreachable: dict
+        Error messages of unreachable targets by index.
+    original_time, optimised_time: float
+        Estimated travel time in the order given and in the new order.
+    """
+
+    def __init__(self, targets, order, positions, unreachable, original_time,
+                 optimised_time):
+        self.targets = targets
+        self.order = order
+        self.positions = positions
+        self.unreachable = unreachable
+        self.original_time = original_time
+        self.optimised_time = optimised_time
+
+    @property
+    def time_saved(self):
+        return self.original_time - self.optimised_time
+
+    def __str__(self):
+        lines = ['Ordered %d targets:' % len(self.order)]
+        lines.append('  travel time as given : %.1f s' % self.original_time)
+        lines.append('  travel time ordered  : %.1f s' % self.optimised_time)
+        saved = self.time_saved
+        percent = 100. * saved / self.original_time if self.original_time else 0.
+        lines.append('  time saved           : %.1f s (%.0f%%)' % (saved, percent))
+        if self.unreachable:
+            lines.append('  unreachable          : %s' % ', '.join(
+                str(i) for i in sorted(self.unreachable)))
+        return '\n'.join(lines)
+
+
+def order_queue(targets, solve, start, velocity, acceleration, neighbours=10):
+    """Solve a queue of targets and order it to minimise travel time.
+
+    solve(target) returns the axis positions for a target, raising
+    DiffcalcException if it can not be reached. Unreachable targets are
+    left out of the ordered queue.
+    """
+    import numpy as np
+    targets = list(targets)
+    solved, positions, unreachable = [], [], {}
+    for i, target in enumerate(targets):
+        try:
+            positions.append(solve(target))
+            solved.append(i)
+        except DiffcalcException, e:
+            unreachable[i] = e.message
+    positions = np.array(positions, dtype=float).reshape(len(solved), len(start))
+    order = order_positions(positions, velocity, acceleration, start, neighbours)
+    original = tour_time(positions, range(len(solved)), velocity, acceleration, start)
+    optimised = tour_time(positions, order, velocity, acceleration, start)
+    if optimised > original:
+        # Never worse than the queue as given
+        order, optimised = range(len(solved)), original
+    return QueueOrder([targets[solved[k]] for k in order], [solved[k] for k in order],
+                      positions[order], unreachable, original, optimised)
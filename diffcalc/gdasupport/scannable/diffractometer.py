@@ -22,7 +22,7 @@ except ImportError:
     from diffcalc.gdasupport.minigda.scannable import \
         ScannableBase as ScannableMotionBase
 
-from diffcalc.util import getMessageFromException
+from diffcalc.util import getMessageFromException, DiffcalcException
 
 # TODO: Split into a base class when making other scannables
 
@@ -74,6 +74,16 @@ class DiffractometerScannableGroup(ScannableMotionBase):
         if self.slave_driver is not None:
             self.slave_driver.triggerAsynchronousMove(position)
 
+    def prepareMoveTo(self, position):
+        if None not in position:
+            report = self.__group.checkPositionValid(list(position))
+            if report:
+                raise DiffcalcException(report)
+        return position
+
+    def asynchronousMoveToPrepared(self, position):
+        self.asynchronousMoveTo(position)
+
     def getPosition(self):
         if self.slave_driver is None:
             slave_positions = []
@@ -67,18 +67,66 @@ class Hkl(ScannableMotionWithScannableFieldsBase):
         self.completeInstantiation()
         self.setAutoCompletePartialMoveToTargets(True)
         self.dynamic_class_doc = 'Hkl Scannable xyz'
+        self._inScan = False
+        self._lastPrepared = None
 
     def rawAsynchronousMoveTo(self, hkl):
+        self.diffhw.asynchronousMoveTo(self._hkl_to_angles(hkl))
+
+    def _hkl_to_angles(self, hkl, reference=None):
+        # With a reference position the solution closest to it is chosen,
+        # otherwise the one closest to the current position
         if len(hkl) != 3: raise ValueError('Hkl device expects three inputs')
         try:
-            (pos, _) = self._diffcalc.hkl_to_angles(hkl[0], hkl[1], hkl[2])
+            if reference is None:
+                (pos, _) = self._diffcalc.hkl_to_angles(hkl[0], hkl[1], hkl[2])
+            else:
+                solutions = self._diffcalc.hkl_to_all_angles(hkl[0], hkl[1], hkl[2])
+                pos = solutions[self._diffcalc.choose_solution(solutions, reference)][0]
         except DiffcalcException, e:
             if DEBUG:
                 raise
             else:
                 raise DiffcalcException(e.message)
+        return pos
+
+    def prepareMoveTo(self, hkl):
+        """Return the diffractometer position for an hkl target, checked
+        against the axis limits, without moving.
+
+        Targets are prepared before the diffractometer has reached the
+        previous one, so within a scan the solution is chosen closest to
+        the previously prepared position rather than the current one. A
+        scan then follows the same branch whether points are prepared
+        ahead or not."""
+        if self.autoCompletePartialMoveToTargets:
+            hkl = self.completePosition(list(hkl))
+        pos = self._hkl_to_angles(hkl, self._lastPrepared)
+        prepare = getattr(self.diffhw, 'prepareMoveTo', None)
+        if prepare is not None:
+            pos = prepare(pos)
+        if self._inScan:
+            self._lastPrepared = pos
+        return pos
+
+    def asynchronousMoveToPrepared(self, pos):
         self.diffhw.asynchronousMoveTo(pos)
 
+    def atScanStart(self):
+        ScannableMotionWithScannableFieldsBase.atScanStart(self)
+        self._inScan = True
+        self._lastPrepared = None
+
+    def atScanEnd(self):
+        ScannableMotionWithScannableFieldsBase.atScanEnd(self)
+        self._inScan = False
+        self._lastPrepared = None
+
+    def atCommandFailure(self):
+        ScannableMotionWithScannableFieldsBase.atCommandFailure(self)
+        self._inScan = False
+        self._lastPrepared = None
+
     def rawGetPosition(self):
         pos = self.diffhw.getPosition()  # a tuple
         (hkl , params) = self._diffcalc.angles_to_hkl(pos)
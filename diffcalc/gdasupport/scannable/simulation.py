@@ -56,19 +56,37 @@ class Gaussian(Equation):
 
 
 class SimulatedCrystalCounter(PseudoDevice):
+    """Counts from a simulated crystal at the diffractometer position.
+
+    Moving the counter to an exposure time starts an exposure and returns at
+    once. The counter is busy, as reported by isBusy(), until exposureTime
+    seconds later, so scans can move other scannables or prepare the next
+    point meanwhile. The count is taken at the diffractometer position
+    when the exposure starts. getPosition() waits for the exposure to end
+    and returns its count, or, if no exposure was started since the last
+    read, the count for the last exposure time at the current position.
+
+    With pause unset the counter runs in fast-forward mode: exposures end as
+    soon as they start. exposureClock always totals the simulated exposure
+    time. Exposures are timed by clock, a minigda VirtualClock, if given.
+    """
 
     def __init__(self, name, diffractometerScannable, geometryPlugin,
-                 wavelengthScannable, equation=Gaussian(.01), engine='you'):
+                 wavelengthScannable, equation=Gaussian(.01), engine='you', clock=None):
         self.setName(name)
         self.setInputNames([name + '_count'])
         self.setOutputFormat(['%7.5f'])
         self.exposureTime = 1
         self.pause = True
+        self.exposureClock = 0.
+        self._exposureEnd = 0.
+        self._exposureCount = None
         self.diffractometerScannable = diffractometerScannable
         self.geometry = geometryPlugin
         self.wavelengthScannable = wavelengthScannable
         self.equation = equation
         self.engine = engine
+        self.clock = clock
 
         self.cut = None
         self.UB = None
@@ -94,11 +112,35 @@ class SimulatedCrystalCounter(PseudoDevice):
         self.UB = CHI * PHI * self.cut.B
 
     def asynchronousMoveTo(self, exposureTime):
+        self.waitWhileBusy()
         self.exposureTime = exposureTime
+        self.exposureClock += exposureTime
+        self._exposureCount = self._count()
         if self.pause:
-            time.sleep(exposureTime)  # Should not technically block!
+            self._exposureEnd = self._time() + exposureTime
+
+    def _time(self):
+        return time.time() if self.clock is None else self.clock.time()
+
+    def isBusy(self):
+        return self._time() < self._exposureEnd
+
+    def waitWhileBusy(self):
+        if self.clock is not None:
+            self.clock.sleep_until(self._exposureEnd)
+            return
+        remaining = self._exposureEnd - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
 
     def getPosition(self):
+        self.waitWhileBusy()
+        count, self._exposureCount = self._exposureCount, None
+        if count is None:
+            count = self._count()
+        return count
+
+    def _count(self):
         h, k, l = self.getHkl()
         dh, dk, dl = h - round(h), k - round(k), l - round(l)
         count = self.equation(dh, dk, dl)
@@ -117,9 +159,6 @@ class SimulatedCrystalCounter(PseudoDevice):
         else:
             raise ValueError(self.engine)
 
-    def isBusy(self):
-        return False
-
     def __str__(self):
         return self.__repr__()
 
@@ -13,6 +13,7 @@ from diffcalc.gdasupport.scannable.qtrans import Qtrans
 reload(_dc)
 from diffcalc.dc.dcyou import *  # @UnusedWildImport
 from diffcalc import settings
+from diffcalc.util import DiffcalcException
 
 try:
     import gda  # @UnusedImport @UnresolvedImport
@@ -22,8 +23,30 @@ except:
     
 if not GDA:
     from diffcalc.gdasupport.minigda import command
+    from diffcalc.gdasupport.minigda.peakfit import PeakFitter
+    from diffcalc.gdasupport.minigda.search import ReflectionSearch
+    from diffcalc.gdasupport.minigda.scandata import ScanDataRecorder
+    from diffcalc.gdasupport.minigda.checkpoint import ScanCheckpoint
+    from diffcalc.gdasupport.minigda.mesh import MeshScan, QShell
+    from diffcalc.gdasupport.minigda.trajectory import HklFlyScan, \
+        SimulatedTrajectoryExecutor
+    from diffcalc.gdasupport.dryrun import DryRun
+    from diffcalc.gdasupport.ordering import order_queue
     _pos = command.Pos()
-    _scan = command.Scan(command.ScanDataPrinter())
+    _peakfit = PeakFitter()
+    _printer = command.ScanDataPrinter()
+    _scandata = ScanDataRecorder()  # set directory to also write scan files
+
+    def _scan_state():
+        # A scan can only be resumed with the same UB matrix and constraints
+        return {'UB': ubcalc.UB.tolist() if ubcalc.is_ub_calculated() else None,
+                'constraints': constraint_manager.all}
+
+    _checkpoint = ScanCheckpoint(_scandata, _scan_state)  # set path to checkpoint scans
+    _scan = command.Scan([_printer, _scandata, _peakfit], checkpoint=_checkpoint)
+    _pscan = command.Scan([_printer, _scandata, _peakfit], lookahead=10,
+                          checkpoint=_checkpoint)
+    _mesh = MeshScan([_printer, _scandata], checkpoint=_checkpoint)
 
     def pos(*args):
         """
@@ -39,6 +62,150 @@ if not GDA:
         """
         return _scan(*args)
 
+    def pscan(*args):
+        """
+        pscan scn start stop step {scn {target}} {det t}   scan computing positions of the next points while moving
+        """
+        return _pscan(*args)
+
+    def mesh(*args):
+        """
+        mesh scn start stop step scn start stop step {scn start stop step} {scn {target}} {det t}   scan a mesh in snake order
+        """
+        return _mesh(*args)
+
+    def meshopt(snake=True, qmin=None, qmax=None):
+        """
+        meshopt {snake} {qmin qmax}   set snake ordering and limit hkl meshes to a |Q| shell (1/Angstrom)
+        """
+        _mesh.snake = snake
+        if qmin is None:
+            _mesh.region = None
+        elif qmax is None:
+            raise DiffcalcException("Give both qmin and qmax to limit meshes to a |Q| shell")
+        else:
+            _mesh.region = QShell(qmin, qmax, lambda: ubcalc.UB, hkl)
+        print "mesh: %s order, %s" % ('snake' if _mesh.snake else 'raster',
+                                     _mesh.region or 'all points')
+
+    def flyscan(start, stop, npoints, duration=None, det=None):
+        """
+        flyscan [h k l] [h k l] npoints {duration} {det}   plan a trajectory along an hkl line and run it on the simulated controller
+        """
+        hw = settings.hardware
+        names = hw.get_axes_names()
+        planner = HklFlyScan(_dc.hkl_to_angles, names, hw.get_velocities(),
+                             hw.get_accelerations(),
+                             [hw.get_lower_limit(name) for name in names],
+                             [hw.get_upper_limit(name) for name in names])
+        profile = planner.plan(start, stop, npoints, duration)
+        print profile
+        det = ct if det is None else det
+        scannables = [hkl, det]
+        handlers = (_printer, _scandata)
+
+        def trigger(index, t, pos):
+            for handler in handlers:
+                handler.callWithScanPoint(dict((scn, scn.getPosition()) for scn in scannables))
+
+        for handler in handlers:
+            handler.callAtScanStart(scannables)
+        SimulatedTrajectoryExecutor(profile).run(
+            lambda pos: _diff_scn.asynchronousMoveTo(list(pos)), trigger)
+        for handler in handlers:
+            handler.callAtScanEnd()
+        return profile
+
+    def dryrun(*args):
+        """
+        dryrun {scan|pscan|mesh} scn start stop step {scn {target}} {det t}   estimate scan time and find unreachable points and branch switches without moving
+        """
+        scan_command = _scan
+        for func, cmd in ((scan, _scan), (pscan, _pscan), (mesh, _mesh)):
+            if args and args[0] is func:
+                scan_command, args = cmd, args[1:]
+        report = DryRun(scan_command, settings.hardware, _dc.hkl_to_all_angles,
+                        _dc.choose_solution)(*args)
+        print report
+        return report
+
+    def orderhkl(hkl_list):
+        """
+        orderhkl [[h k l] ...]   order a list of reflections to minimise the diffractometer travel time
+        """
+        hw = settings.hardware
+        result = order_queue(hkl_list, lambda hkl: _dc.hkl_to_angles(*hkl)[0],
+                             hw.get_position(), hw.get_velocities(),
+                             hw.get_accelerations())
+        print result
+        return result.targets
+
+    def scancheckpoint(path=None, interval=10):
+        """
+        scancheckpoint {'path'} {interval}   save the progress of scans to path at most every interval seconds (None to stop)
+        """
+        _checkpoint.path = path
+        _checkpoint.interval = interval
+
+    def resumescan():
+        """
+        resumescan   continue the last interrupted scan from its next point if the UB matrix and constraints are unchanged
+        """
+        header, _ = _checkpoint.load()
+        scan_command = _mesh if header['scan'] == _mesh.__class__.__name__ else _scan
+        namespace = dict(globals())
+        namespace.update(command.ROOT_NAMESPACE_DICT)
+        scan_command.resume(namespace)
+
+    def scanprint(interval=0):
+        """
+        scanprint {interval}   print scan points at most every interval seconds (None to stop printing)
+        """
+        _printer.enabled = interval is not None
+        _printer.min_interval = interval or 0
+
+    def scandata():
+        """
+        scandata   return a dictionary of column arrays recorded in the last scan
+        """
+        return _scandata.columns()
+
+    def fitpeak(shape='gaussian', hkl=None, tag=None):
+        """
+        fitpeak {'shape'}                  fit peak in last scan ('gaussian', 'lorentzian', 'pseudovoigt' or 'centroid')
+        fitpeak 'shape' [h k l] {'tag'}    move scanned axis to fitted peak and add it as a reflection
+        """
+        _peakfit.fit(shape)
+        print _peakfit.str_fit()
+        if hkl is not None:
+            _peakfit.move_to_peak()
+            if tag is None:
+                addref(hkl)
+            else:
+                addref(hkl, tag)
+
+    def searchref(hkl, uncertainty=1., tag=None, axes=('eta', 'chi'), counter=None):
+        """
+        searchref [h k l] {uncertainty} {'tag'}  search for reflection around position predicted by UB (uncertainty in deg)
+        """
+        scns = [settings.axes_scannable_group.getGroupMember(name) for name in axes]
+        if None in scns:
+            raise DiffcalcException("Unknown search axes %s. Choose from: %s" % (
+                list(axes), ', '.join(settings.axes_scannable_group.getInputNames())))
+        predicted, _ = _dc.hkl_to_angles(*hkl)
+        settings.axes_scannable_group.asynchronousMoveTo(predicted)
+        settings.axes_scannable_group.waitWhileBusy()
+        searcher = ReflectionSearch(scns, ct if counter is None else counter)
+        centre = [scn.getPosition() for scn in scns]
+        try:
+            found = searcher.search(centre, 4. * uncertainty)
+        finally:
+            print searcher.str_steps()
+        print "Peak found at: " + ', '.join(
+            '%s=% .5f' % (name, val) for name, val in zip(axes, found))
+        if tag is not None:
+            addref(hkl, tag)
+
 
 from diffcalc.gdasupport.scannable.sim import sim  # @UnusedImport
 
@@ -23,9 +23,14 @@ from diffcalc import settings
 
 SMALL = 1e-8
 
+# Axis speeds (deg/s) and accelerations (deg/s^2) assumed for motion time
+# estimates unless set with setspeed
+DEFAULT_VELOCITY = 1.
+DEFAULT_ACCELERATION = 2.
+
 from diffcalc.util import command
 
-__all__ = ['hardware', 'setcut', 'setmin', 'setmax']
+__all__ = ['hardware', 'setcut', 'setmin', 'setmax', 'setspeed']
 
 
 def getNameFromScannableOrString(o):
@@ -83,11 +88,29 @@ def _setMinOrMax(name, val, setMethod):
             setMethod(name, float(val))
 
 
+@command
+def setspeed(name=None, velocity=None, acceleration=None):
+    """setspeed {axis {velocity {acceleration}}} -- set axis speed (deg/s) and acceleration (deg/s^2) used for motion time estimates""" #@IgnorePep8
+    if name is None:
+        print settings.hardware.repr_axis_motion()  # @UndefinedVariable
+        return
+    name = getNameFromScannableOrString(name)
+    if name not in settings.hardware.get_axes_names():  # @UndefinedVariable
+        raise DiffcalcException("Diffractometer has no angle %s. Try: %s." %
+                                (name, ', '.join(settings.hardware.get_axes_names())))  # @UndefinedVariable
+    if velocity is not None:
+        settings.hardware.set_velocity(name, velocity)  # @UndefinedVariable
+    if acceleration is not None:
+        settings.hardware.set_acceleration(name, acceleration)  # @UndefinedVariable
+    print settings.hardware.repr_axis_motion(name)  # @UndefinedVariable
+
+
 commands_for_help = ['Hardware',
                      hardware,
                      setcut,
                      setmin,
-                     setmax]
+                     setmax,
+                     setspeed]
 
 
 class HardwareAdapter(object):
@@ -101,6 +124,8 @@ class HardwareAdapter(object):
         self.energyScannableMultiplierToGetKeV = \
             energyScannableMultiplierToGetKeV
         self._name = 'base'
+        self._velocities = {}
+        self._accelerations = {}
 
     @property
     def name(self):
@@ -205,6 +230,40 @@ class HardwareAdapter(object):
 
         return s
 
+### Motion ###
+
+    def get_velocity(self, name):
+        '''returns the axis speed in deg/s assumed for time estimates'''
+        return self._velocities.get(name, DEFAULT_VELOCITY)
+
+    def set_velocity(self, name, value):
+        if value <= 0:
+            raise DiffcalcException("Axis speed must be positive")
+        self._velocities[name] = float(value)
+
+    def get_acceleration(self, name):
+        '''returns the axis acceleration in deg/s^2 assumed for time
+        estimates'''
+        return self._accelerations.get(name, DEFAULT_ACCELERATION)
+
+    def set_acceleration(self, name, value):
+        if value <= 0:
+            raise DiffcalcException("Axis acceleration must be positive")
+        self._accelerations[name] = float(value)
+
+    def get_velocities(self):
+        return [self.get_velocity(name) for name in self.get_axes_names()]
+
+    def get_accelerations(self):
+        return [self.get_acceleration(name) for name in self.get_axes_names()]
+
+    def repr_axis_motion(self, name=None):
+        if name is None:
+            return '\n'.join(self.repr_axis_motion(name)
+                             for name in self.get_axes_names())
+        return '  %5s: % 8.3f deg/s  % 8.3f deg/s^2' % (
+            name, self.get_velocity(name), self.get_acceleration(name))
+
 ### Cutting Stuff ###
 
     def _configure_cuts(self, defaultCutsDict):
@@ -255,6 +314,50 @@ def cut_angle_at(cut_angle, value):
         return value
 
 
+def motion_times(positions, current, speeds=None):
+    """Estimate times to move from current to each of many positions.
+
+    All axes are assumed to move simultaneously so the time for a move is
+    that of its slowest axis. With no speeds given this is the largest single
+    axis move in degrees.
+
+    Parameters
+    ----------
+    positions: array_like
+        (N, naxes) array of target positions in degrees.
+    current: array_like
+        Current position in degrees.
+    speeds: array_like, optional
+        Axis speeds in degrees per second.
+
+    Returns
+    -------
+    ndarray:
+        (N,) array of move times.
+    """
+    import numpy as np
+    moves = abs(np.atleast_2d(np.asarray(positions, dtype=float)) -
+                np.asarray(current, dtype=float))
+    if speeds is not None:
+        moves = moves / np.asarray(speeds, dtype=float)
+    return moves.max(axis=1)
+
+
+def move_time(distance, velocity, acceleration):
+    """Time to move an axis by distance from rest to rest.
+
+    The axis accelerates to velocity, moves at constant speed and
+    decelerates again, or for short moves accelerates for half the distance
+    and decelerates for the other half. Works on arrays.
+    """
+    import numpy as np
+    distance = abs(np.asarray(distance, dtype=float))
+    ramp = np.asarray(velocity, dtype=float) ** 2 / acceleration
+    return np.where(distance > ramp,
+                    distance / velocity + velocity / np.asarray(acceleration, dtype=float),
+                    2 * np.sqrt(distance / acceleration))
+
+
 class DummyHardwareAdapter(HardwareAdapter):
 
     def __init__(self, diffractometerAngleNames):
@@ -92,8 +92,12 @@ class HklCalculatorBase(object):
 
         return pos, virtualAnglesReadback
 
-    def _verify_pos_map_to_hkl(self, h, k, l, wavelength, pos):
-        hkl, _ = self.anglesToHkl(pos, wavelength)
+    def _verify_pos_map_to_hkl(self, h, k, l, wavelength, pos, ubmatrix=None):
+        # A given ubmatrix replaces the current one, as in _hklToAngles()
+        if ubmatrix is None:
+            hkl, _ = self.anglesToHkl(pos, wavelength)
+        else:
+            hkl = self._anglesToHkl(pos.inRadians(), wavelength, ubmatrix)
         e = 0.001
         if ((abs(hkl[0] - h) > e) or (abs(hkl[1] - k) > e) or 
             (abs(hkl[2] - l) > e)):
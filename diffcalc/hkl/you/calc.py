@@ -19,6 +19,10 @@
 from math import pi, sin, cos, tan, acos, asin, atan, atan2, sqrt
 from itertools import product
 from diffcalc import settings
+try:
+    from collections import OrderedDict
+except ImportError:
+    from simplejson import OrderedDict
 
 try:
     from numpy import matrix
@@ -36,6 +40,7 @@ from diffcalc.util import DiffcalcException, bound, angle_between_vectors,\
     y_rotation
 from diffcalc.util import cross3, z_rotation, x_rotation
 from diffcalc.ub.calc import PaperSpecificUbCalcStrategy
+from diffcalc.hardware import motion_times
 
 from diffcalc.settings import NUNAME
 logger = logging.getLogger("diffcalc.hkl.you.calc")
@@ -184,6 +189,35 @@ class YouUbCalcStrategy(PaperSpecificUbCalcStrategy):
         # Transform this into the phi frame.
         return PHI.I * CHI.I * ETA.I * MU.I * q_lab
 
+    def calculate_q_phi_array(self, positions):
+        """Calculate scattering vectors for many positions at once.
+
+        Parameters
+        ----------
+        positions: array_like
+            (N,6) array of mu, delta, nu, eta, chi and phi angles in radians.
+
+        Returns
+        -------
+        ndarray:
+            (N,3) array of scattering vectors in the phi frame."""
+        import numpy as np
+        positions = np.atleast_2d(np.asarray(positions, dtype=float))
+        mu, delta, nu, eta, chi, phi = positions.T
+        # Equation 12 evaluated for all positions: (NU * DELTA - I) * y
+        x = np.sin(delta)
+        y = np.cos(delta) * np.cos(nu) - 1
+        z = np.cos(delta) * np.sin(nu)
+        # MU.I
+        y, z = np.cos(mu) * y + np.sin(mu) * z, -np.sin(mu) * y + np.cos(mu) * z
+        # ETA.I
+        x, y = np.cos(eta) * x - np.sin(eta) * y, np.sin(eta) * x + np.cos(eta) * y
+        # CHI.I
+        x, z = np.cos(chi) * x - np.sin(chi) * z, np.sin(chi) * x + np.cos(chi) * z
+        # PHI.I
+        x, y = np.cos(phi) * x - np.sin(phi) * y, np.sin(phi) * x + np.cos(phi) * y
+        return np.column_stack((x, y, z))
+
 
 UNREACHABLE_MSG = (
     'The current combination of constraints with %s = %.4f\n'
@@ -208,16 +242,16 @@ class YouHklCalculator(HklCalculatorBase):
     def _get_surf_nphi(self):
         return self._ubcalc.surf_nphi
     
-    def _get_ubmatrix(self):
-        return self._getUBMatrix()  # for consistency
-
     def repr_mode(self):
         return repr(self.constraints.all)
 
-    def _anglesToHkl(self, pos, wavelength):
-        """Calculate miller indices from position in radians.
+    def _anglesToHkl(self, pos, wavelength, ubmatrix=None):
+        """Calculate miller indices from position in radians, using the given
+        UB matrix instead of the current one if set.
         """
-        return youAnglesToHkl(pos, wavelength, self._get_ubmatrix())
+        if ubmatrix is None:
+            ubmatrix = self._getUBMatrix()
+        return youAnglesToHkl(pos, wavelength, ubmatrix)
 
     def _anglesToVirtualAngles(self, pos, _wavelength):
         """Calculate pseudo-angles in radians from position in radians.
@@ -270,13 +304,15 @@ class YouHklCalculator(HklCalculatorBase):
                 'betain': betain, 'betaout': betaout}
 
 
-    def _choose_single_solution(self, pos_virtual_angles_pairs_in_degrees):
+    def _choose_single_solution(self, pos_virtual_angles_pairs_in_degrees, reference=None):
+        # reference is the physical position the solutions are compared to,
+        # by default the current diffractometer position
 
         if len(pos_virtual_angles_pairs_in_degrees) == 1:
             return pos_virtual_angles_pairs_in_degrees[0]
 
         absolute_distances = []
-        _hw_pos = settings.hardware.get_position()
+        _hw_pos = settings.hardware.get_position() if reference is None else reference
         _you_pos = settings.geometry.physical_angles_to_internal_position(_hw_pos).totuple()
 
         metric = lambda (a, b): 2.* asin(abs(sin((a - b) * TORAD / 2.))) * TODEG
@@ -309,7 +345,7 @@ class YouHklCalculator(HklCalculatorBase):
 
         return pos, virtual_angles
 
-    def hklToAngles(self, h, k, l, wavelength, return_all_solutions=False):
+    def hklToAngles(self, h, k, l, wavelength, return_all_solutions=False, ubmatrix=None):
         """
         Return verified Position and all virtual angles in degrees from
         h, k & l and wavelength in Angstroms.
@@ -324,9 +360,12 @@ class YouHklCalculator(HklCalculatorBase):
         Throws a DiffcalcException if either check fails and
         raiseExceptionsIfAnglesDoNotMapBackToHkl is True, otherwise displays a
         warning.
+
+        With ubmatrix given, it is used instead of the current UB matrix.
         """
 
-        pos_virtual_angles_pairs = self._hklToAngles(h, k, l, wavelength, return_all_solutions)  # in rad
+        pos_virtual_angles_pairs = self._hklToAngles(h, k, l, wavelength, return_all_solutions,
+                                                     ubmatrix)  # in rad
         assert pos_virtual_angles_pairs
         pos_virtual_angles_pairs_in_degrees = []
         for pos, virtual_angles in pos_virtual_angles_pairs:
@@ -337,7 +376,7 @@ class YouHklCalculator(HklCalculatorBase):
                 if val is not None:
                     virtual_angles[key] = val * TODEG
 
-            self._verify_pos_map_to_hkl(h, k, l, wavelength, pos)
+            self._verify_pos_map_to_hkl(h, k, l, wavelength, pos, ubmatrix)
 
             pos_virtual_angles_pairs_in_degrees.append((pos, virtual_angles))
 
@@ -395,8 +434,83 @@ class YouHklCalculator(HklCalculatorBase):
     def hkl_to_all_angles(self, h, k, l, wavelength):
         return self.hklToAngles(h, k, l, wavelength, True)
 
+    def hkl_list_to_ranked_angles(self, hkl_list, wavelength, speeds=None):
+        """
+        Return all solutions within hardware limits for a list of reflections
+        ranked by the time needed to move there from the current position.
+
+        Every reflection is solved under the current constraints and the
+        motion costs of all resulting solutions are evaluated together. Axis
+        speeds in degrees per second may be given in the hardware axis order;
+        by default the cost is the largest single axis move in degrees.
+
+        Solutions are verified as in hklToAngles() and those that do not map
+        back to their hkl or virtual angle values are left out.
+
+        Returns a list of (cost, hkl, physical angles, virtual angles) tuples
+        sorted by cost and a list of (hkl, error message) pairs for the
+        reflections with no accessible solution.
+        """
+        solutions = []
+        failed = []
+        for hkl in hkl_list:
+            h, k, l = hkl
+            try:
+                pos_virtual_angles_pairs = self._hklToAngles(h, k, l, wavelength)
+            except DiffcalcException, e:
+                failed.append((tuple(hkl), e.message))
+                continue
+            verified = []
+            error = "No solutions found"
+            for pos, virtual_angles in pos_virtual_angles_pairs:
+                pos.changeToDegrees()
+                for key, val in virtual_angles.items():
+                    if val is not None:
+                        virtual_angles[key] = val * TODEG
+                try:
+                    self._verify_pos_map_to_hkl(h, k, l, wavelength, pos)
+                    virtual_angles = self._verify_virtual_angles(h, k, l, wavelength, pos,
+                                                                 virtual_angles)
+                except DiffcalcException, e:
+                    error = e.message
+                    continue
+                angle_tuple = settings.geometry.internal_position_to_physical_angles(pos)
+                angle_tuple = settings.hardware.cut_angles(angle_tuple)
+                verified.append((tuple(hkl), angle_tuple, virtual_angles))
+            if not verified:
+                failed.append((tuple(hkl), error))
+            solutions.extend(verified)
+        if not solutions:
+            return [], failed
+        costs = motion_times([angles for _, angles, _ in solutions],
+                             settings.hardware.get_position(), speeds)
+        ranked = sorted(zip(costs.tolist(), range(len(solutions))))
+        return ([(cost,) + solutions[idx] for cost, idx in ranked], failed)
+
+
+    def hkl_to_domain_angles(self, h, k, l, wavelength, names=None):
+        """
+        Return verified Position and all virtual angles in degrees for every
+        domain registered with the UB calculation.
+
+        Each domain is solved under the current constraints using its own
+        orientation matrix while the reference and surface vectors stay fixed
+        in the phi frame. The active UB matrix is not changed.
+
+        Returns an OrderedDict of domain names mapped onto (pos, virtual angles)
+        pairs and a list of (domain name, error message) pairs for the domains
+        with no accessible solution.
+        """
+        solutions = OrderedDict()
+        failed = []
+        for name, ubmatrix in self._ubcalc.get_domain_UBs(names).items():
+            try:
+                solutions[name] = self.hklToAngles(h, k, l, wavelength, ubmatrix=ubmatrix)
+            except DiffcalcException, e:
+                failed.append((name, e.message))
+        return solutions, failed
 
-    def _hklToAngles(self, h, k, l, wavelength, return_all_solutions=False):
+    def _hklToAngles(self, h, k, l, wavelength, return_all_solutions=False, ubmatrix=None):
         """(pos, virtualAngles) = hklToAngles(h, k, l, wavelength) --- with
         Position object pos and the virtual angles returned in degrees. Some
         modes may not calculate all virtual angles.
@@ -424,7 +538,9 @@ class YouHklCalculator(HklCalculatorBase):
                "Two 'detector' constraints given")
 
 
-        h_phi = self._get_ubmatrix() * matrix([[h], [k], [l]])
+        if ubmatrix is None:
+            ubmatrix = self._getUBMatrix()
+        h_phi = ubmatrix * matrix([[h], [k], [l]])
         theta = self._calc_theta(h_phi, wavelength)
         tau = angle_between_vectors(h_phi, self._get_n_phi())
         surf_tau = angle_between_vectors(h_phi, self._get_surf_nphi())
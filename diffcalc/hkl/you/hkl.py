@@ -26,9 +26,11 @@ from diffcalc import settings
 
 
 import diffcalc.ub.ub
+from diffcalc.ub.ub import reloads_external_changes
 from diffcalc.hkl.you.constraints import YouConstraintManager
+from diffcalc.ub.symmetry import get_equivalent_reflections
 
-__all__ = ['allhkl', 'con', 'uncon', 'hklcalc', 'constraint_manager']
+__all__ = ['allhkl', 'equivhkl', 'domainhkl', 'con', 'uncon', 'hklcalc', 'constraint_manager']
 
 
 _fixed_constraints = settings.geometry.fixed_constraints  # @UndefinedVariable
@@ -42,6 +44,7 @@ def __str__(self):
     return hklcalc.__str__()
 
 @command
+@reloads_external_changes
 def con(*args):
     """
     con -- list available constraints and values
@@ -127,6 +130,7 @@ def _handle_con(args):
 
 
 @command
+@reloads_external_changes
 def uncon(scn_or_string):
     """uncon <name> -- remove constraint
 
@@ -210,9 +214,61 @@ def allhkl(hkl, wavelength=None):
     print '\n'.join(lines)
 
 
+@command
+def equivhkl(hkl, group, wavelength=None):
+    """equivhkl [h k l] 'group' -- list symmetry equivalent reflections within limits ranked by distance from current position
+
+    The group is a point group or Laue class symbol, e.g. 'm-3m' or '6/mmm'.
+    """
+    _hardware = settings.hardware
+    if wavelength is None:
+        wavelength = _hardware.get_wavelength()
+    hkl_list = get_equivalent_reflections(hkl, group)
+    ranked, failed = hklcalc.hkl_list_to_ranked_angles(hkl_list, wavelength)
+
+    axes_names = list(_hardware.get_axes_names())
+    fmt_header = '%4s  %8s %8s %8s  ' + '%9s ' * len(axes_names) + ' %9s'
+    fmt_row = '%4s  % 8.4f % 8.4f % 8.4f  ' + '% 9.4f ' * len(axes_names) + ' % 9.4f'
+    lines = [fmt_header % tuple(['', 'h', 'k', 'l'] + axes_names + ['cost'])]
+    for n, (cost, (h, k, l), angles, _) in enumerate(ranked):
+        lines.append(fmt_row % ((str(n + 1) + '.', h, k, l) + tuple(angles) + (cost,)))
+    if not ranked:
+        lines.append('   <<< no equivalent reflection is accessible >>>')
+    if failed:
+        lines.append('')
+        lines.append('%d of %d equivalent reflections are not accessible:' % (len(failed), len(hkl_list)))
+        for (h, k, l), _ in failed:
+            lines.append('      % 8.4f % 8.4f % 8.4f' % (h, k, l))
+    print '\n'.join(lines)
+
+
+@command
+def domainhkl(hkl, wavelength=None):
+    """domainhkl [h k l] -- print positions reaching a reflection in every domain of the UB calculation"""
+    _hardware = settings.hardware
+    if wavelength is None:
+        wavelength = _hardware.get_wavelength()
+    h, k, l = hkl
+    solutions, failed = hklcalc.hkl_to_domain_angles(h, k, l, wavelength)
+
+    axes_names = list(_hardware.get_axes_names())
+    fmt_header = '%12s  ' + '%9s ' * len(axes_names)
+    fmt_row = '%12s  ' + '% 9.4f ' * len(axes_names)
+    lines = [fmt_header % tuple([''] + axes_names)]
+    for name, (pos, _) in solutions.items():
+        angles = settings.geometry.internal_position_to_physical_angles(pos)
+        angles = _hardware.cut_angles(angles)
+        lines.append(fmt_row % ((name,) + tuple(angles)))
+    for name, msg in failed:
+        lines.append('%12s  <<< %s >>>' % (name, msg.split('\n')[0]))
+    print '\n'.join(lines)
+
+
 commands_for_help = ['Constraints',
                      con,
                      uncon,
                      'Hkl',
-                     allhkl
+                     allhkl,
+                     equivhkl,
+                     domainhkl
                      ]
@@ -0,0 +1,141 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pytest
+
+from diffcalc.gdasupport.minigda import checkpoint as checkpoint_module
+from diffcalc.gdasupport.minigda.checkpoint import ScanCheckpoint
+from diffcalc.gdasupport.minigda.command import Scan
+from diffcalc.gdasupport.minigda.mesh import MeshScan
+from diffcalc.gdasupport.minigda.scandata import ScanDataRecorder
+from diffcalc.tests.gdasupport.minigda.test_command import RecordingScannable
+from diffcalc.util import DiffcalcException
+
+
+class FaultyScannable(RecordingScannable):
+    """Fails to move to fault, like a motor tripping"""
+
+    def __init__(self, name, log, fault=None):
+        RecordingScannable.__init__(self, name, log)
+        self.fault = fault
+
+    def asynchronousMoveTo(self, new_position):
+        if new_position == self.fault:
+            raise DiffcalcException("%s tripped" % self.name)
+        RecordingScannable.asynchronousMoveTo(self, new_position)
+
+
+class TestScanCheckpoint(object):
+
+    def setup_method(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'scan.checkpoint')
+        self.log = []
+        self.a = RecordingScannable('a', self.log)
+        self.b = FaultyScannable('b', self.log, fault=2)
+        self.namespace = {'a': self.a, 'b': self.b}
+        self.state = {'UB': [[1, 0], [0, 1]], 'constraints': {'mu': 0}}
+        self.recorder = ScanDataRecorder()
+        self.checkpoint = ScanCheckpoint(self.recorder, lambda: self.state, self.path,
+                                         interval=100)
+
+    def teardown_method(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _interrupt(self, scan, *scanargs):
+        with pytest.raises(DiffcalcException):
+            scan(*scanargs)
+        assert os.path.exists(self.path)
+        self.b.fault = None
+
+    @pytest.mark.parametrize('lookahead', [0, 5])
+    def test_resume(self, lookahead):
+        scan = Scan([self.recorder], lookahead=lookahead, checkpoint=self.checkpoint)
+        self._interrupt(scan, self.a, 0, 2, 1, self.b, 0, 3, 1)
+        header, data = self.checkpoint.load()
+        assert header['completed'] == 2
+        assert data.shape == (2, 3)
+        del self.log[:]
+        scan.resume(self.namespace)
+        assert not os.path.exists(self.path)
+        # The first point resumed moves the outer axis first moved before it
+        assert self.log[:2] == [('a', 0), ('b', 2)]
+        assert self.recorder.data.shape == (12, 3)
+        expected = [(a, b) for a in range(3) for b in range(4)]
+        assert map(tuple, self.recorder.data[:, :2]) == expected
+
+    def test_resume_mesh(self):
+        scan = MeshScan([self.recorder], lookahead=0, checkpoint=self.checkpoint)
+        self.b.fault = 1
+        self._interrupt(scan, self.a, 0, 2, 1, self.b, 0, 2, 1)
+        scan.resume(self.namespace)
+        assert [tuple(p) for p in self.recorder.data[:, :2]] == [
+            (0, 0), (0, 1), (0, 2), (1, 2), (1, 1), (1, 0), (2, 0), (2, 1), (2, 2)]
+
+    def test_mesh_options_checked(self):
+        scan = MeshScan([self.recorder], lookahead=0, checkpoint=self.checkpoint)
+        self._interrupt(scan, self.a, 0, 2, 1, self.b, 0, 3, 1)
+        scan.snake = False
+        with pytest.raises(DiffcalcException):
+            scan.resume(self.namespace)
+
+    def test_state_checked(self):
+        scan = Scan([self.recorder], checkpoint=self.checkpoint)
+        self._interrupt(scan, self.a, 0, 2, 1, self.b, 0, 3, 1)
+        self.state = {'UB': [[1, 0], [0, 1]], 'constraints': {'mu': 1}}
+        with pytest.raises(DiffcalcException) as e:
+            scan.resume(self.namespace)
+        assert 'constraints' in str(e.value) and 'UB' not in str(e.value)
+        # Still resumable once restored
+        self.state['constraints']['mu'] = 0
+        scan.resume(self.namespace)
+        assert self.recorder.data.shape == (12, 3)
+
+    def test_nothing_to_resume(self):
+        scan = Scan([self.recorder], checkpoint=self.checkpoint)
+        scan(self.a, 0, 1, 1)
+        assert not os.path.exists(self.path)
+        with pytest.raises(DiffcalcException):
+            scan.resume(self.namespace)
+
+    def test_saved_at_interval(self):
+        self.checkpoint.interval = 0
+        scan = Scan([self.recorder], checkpoint=self.checkpoint)
+        saved = []
+        save = self.checkpoint.save
+        self.checkpoint.save = lambda: saved.append(self.checkpoint._header['completed']) or save()
+        scan(self.a, 0, 3, 1)
+        assert saved == [0, 1, 2, 3, 4]
+
+    def test_interrupted_save_keeps_checkpoint(self, monkeypatch):
+        scan = Scan([self.recorder], checkpoint=self.checkpoint)
+        self._interrupt(scan, self.a, 0, 2, 1, self.b, 0, 3, 1)
+
+        def fail(fd):
+            raise OSError("disk full")
+        monkeypatch.setattr(checkpoint_module.os, 'fsync', fail)
+        with pytest.raises(OSError):
+            self.checkpoint.save()
+        header, _ = self.checkpoint.load()
+        assert header['completed'] == 2
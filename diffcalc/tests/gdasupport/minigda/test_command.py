@@ -16,11 +16,16 @@
 # along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
 ###
 
+import threading
+import time
 import unittest
+import pytest
 import diffcalc.gdasupport.minigda.command
-from diffcalc.gdasupport.minigda.command import Pos, Scan, ScanDataPrinter
+from diffcalc.gdasupport.minigda.command import Pos, Scan, ScanDataPrinter, \
+    ScanDataHandler
 from diffcalc.gdasupport.minigda.scannable import \
     MultiInputExtraFieldsDummyScannable, SingleFieldDummyScannable
+from diffcalc.util import DiffcalcException
 
 
 class BadSingleFieldDummyScannable(SingleFieldDummyScannable):
@@ -83,6 +88,70 @@ class TestPos(object):
         assert self.pos.posReturningReport(scnNone, 4.321) == "scnNone:  ---"
 
 
+class RecordingScannable(SingleFieldDummyScannable):
+    """Records moves, and the threads preparing them"""
+
+    def __init__(self, name, log):
+        SingleFieldDummyScannable.__init__(self, name)
+        self.log = log
+        self.prepared_in = set()
+
+    def prepareMoveTo(self, newpos):
+        self.prepared_in.add(threading.currentThread().getName())
+        return SingleFieldDummyScannable.prepareMoveTo(self, newpos)
+
+    def asynchronousMoveTo(self, new_position):
+        SingleFieldDummyScannable.asynchronousMoveTo(self, new_position)
+        self.log.append((self.name, new_position))
+
+
+class SlowDummyScannable(SingleFieldDummyScannable):
+    """Takes duration seconds to arrive, blocking in asynchronousMoveTo if
+    blocking is set"""
+
+    def __init__(self, name, duration, blocking=False):
+        SingleFieldDummyScannable.__init__(self, name)
+        self.duration = duration
+        self.blocking = blocking
+        self.pollInterval = .005
+        self._arrival = 0
+
+    def asynchronousMoveTo(self, new_position):
+        SingleFieldDummyScannable.asynchronousMoveTo(self, new_position)
+        self._arrival = time.time() + self.duration
+        if self.blocking:
+            time.sleep(self.duration)
+
+    def isBusy(self):
+        return time.time() < self._arrival
+
+    def waitWhileBusy(self):
+        SingleFieldDummyScannable.waitWhileBusy(self)
+        while self.isBusy():
+            time.sleep(self.pollInterval)
+
+
+class MotorsIdleCounter(SingleFieldDummyScannable):
+    """Reads 1 if none of the motors is moving"""
+
+    def __init__(self, name, motors):
+        SingleFieldDummyScannable.__init__(self, name)
+        self.motors = motors
+        self.setLevel(5)
+
+    def getPosition(self):
+        return 0. if any(m.isBusy() for m in self.motors) else 1.
+
+
+class PointRecorder(ScanDataHandler):
+
+    def __init__(self):
+        self.points = []
+
+    def callWithScanPoint(self, position_dict):
+        self.points.append(dict((scn.getName(), pos) for scn, pos in position_dict.items()))
+
+
 class TestScan(object):
 
     def setup_method(self):
@@ -136,3 +205,51 @@ class TestScan(object):
         scn6 = SingleFieldDummyScannable('scn6')
         scn6.setLevel(6)
         self.scan.__call__(scn5a, 1, 3, 1, scn6, 1, scn5b, scn4)
+
+    def _scan(self, lookahead):
+        log = []
+        outer = RecordingScannable('outer', log)
+        inner = RecordingScannable('inner', log)
+        fixed = RecordingScannable('fixed', log)
+        recorder = PointRecorder()
+        # Moves at one level made in sequence, so the log order is fixed
+        Scan([recorder], lookahead, concurrent=False)(outer, 0, 2, 1, inner, 0, .2, .1,
+                                                      fixed, 5)
+        return log, recorder.points, outer
+
+    def test_pipelined_scan_matches_sequential(self):
+        log, points, _ = self._scan(0)
+        log_pipelined, points_pipelined, outer = self._scan(2)
+        assert log_pipelined == log
+        assert points_pipelined == points
+        assert len(points) == 9
+        assert outer.prepared_in == set(['scan-lookahead'])
+
+    def test_pipelined_scan_reports_unreachable_point_ahead(self):
+        scn = SingleFieldDummyScannable('scn')
+        scn.setUpperDummyLimit(2.5)
+        recorder = PointRecorder()
+        with pytest.raises(DiffcalcException) as excinfo:
+            Scan([recorder], 10)(scn, 0, 10, 1)
+        assert 'Scan point 4 ' in str(excinfo.value)
+        assert len(recorder.points) <= 3
+        assert scn.getPosition() <= 2.5
+
+    def _timed_scan(self, blocking, concurrent=True, poll_interval=None):
+        motors = [SlowDummyScannable(name, .1, blocking) for name in ('a', 'b', 'c')]
+        counter = MotorsIdleCounter('counter', motors)
+        recorder = PointRecorder()
+        start = time.time()
+        Scan([recorder], concurrent=concurrent, poll_interval=poll_interval)(
+            motors[0], 0, 1, 1, motors[1], 5, motors[2], 7, counter)
+        assert [p['counter'] for p in recorder.points] == [1., 1.]
+        return time.time() - start
+
+    def test_axes_move_concurrently(self):
+        # Two points of three axes taking .1s each: .2s rather than .6s
+        assert self._timed_scan(blocking=False) < .45
+        assert self._timed_scan(blocking=False, poll_interval=.005) < .45
+
+    def test_blocking_axes_move_concurrently(self):
+        assert self._timed_scan(blocking=True) < .45
+        assert self._timed_scan(blocking=True, concurrent=False) > .55
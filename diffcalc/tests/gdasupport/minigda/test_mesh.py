@@ -0,0 +1,142 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+import time
+from itertools import islice
+
+import numpy as np
+import pytest
+
+from diffcalc.gdasupport.minigda.command import Scan
+from diffcalc.gdasupport.minigda.mesh import MeshScan, QShell
+from diffcalc.gdasupport.minigda.scannable import \
+    ScannableMotionWithScannableFieldsBase, SingleFieldDummyScannable
+from diffcalc.tests.gdasupport.minigda.test_command import PointRecorder, \
+    RecordingScannable
+from diffcalc.util import DiffcalcException
+
+
+class DummyHkl(ScannableMotionWithScannableFieldsBase):
+    """Three field scannable with parts, recording the targets it is
+    moved to"""
+
+    def __init__(self):
+        self.setName('hkl')
+        self.setInputNames(['h', 'k', 'l'])
+        self.setOutputFormat(['%.4f'] * 3)
+        self.completeInstantiation()
+        self.setAutoCompletePartialMoveToTargets(True)
+        self.position = [0., 0., 1.]
+        self.targets = []
+
+    def asynchronousMoveTo(self, newpos):
+        newpos = self.completePosition(list(newpos))
+        self.targets.append(tuple(newpos))
+        self.position = newpos
+
+    def getPosition(self):
+        return list(self.position)
+
+    def isBusy(self):
+        return False
+
+
+class TestMeshScan(object):
+
+    def setup_method(self):
+        self.log = []
+        self.a = RecordingScannable('a', self.log)
+        self.b = RecordingScannable('b', self.log)
+        self.c = RecordingScannable('c', self.log)
+        self.recorder = PointRecorder()
+
+    def _points(self, *names):
+        return [tuple(p[name] for name in names) for p in self.recorder.points]
+
+    def test_snake(self):
+        MeshScan([self.recorder])(self.a, 0, 2, 1, self.b, 0, 1, 1)
+        assert self._points('a', 'b') == [(0, 0), (0, 1), (1, 1), (1, 0), (2, 0), (2, 1)]
+        # Outer axes only move when their value changes
+        assert [name for name, _ in self.log].count('a') == 3
+
+    def test_raster(self):
+        MeshScan([self.recorder], snake=False)(self.a, 0, 2, 1, self.b, 0, 1, 1)
+        assert self._points('a', 'b') == [(0, 0), (0, 1), (1, 0), (1, 1), (2, 0), (2, 1)]
+
+    def test_snake_3d_never_jumps(self):
+        MeshScan([self.recorder], lookahead=0)(self.a, 0, 2, 1, self.b, 0, 3, 1,
+                                               self.c, 0, 1, 1)
+        points = np.array(self._points('a', 'b', 'c'))
+        assert len(points) == 24
+        assert len(set(map(tuple, points))) == 24
+        assert np.all(abs(np.diff(points, axis=0)).sum(axis=1) == 1)
+
+    def test_region(self):
+        disc = lambda scannables, points: (points ** 2).sum(axis=1) <= 1
+        MeshScan([self.recorder], region=disc)(self.a, -1, 1, 1, self.b, -1, 1, 1)
+        assert self._points('a', 'b') == [(-1, 0), (0, 1), (0, 0), (0, -1), (1, 0)]
+
+    def test_matches_sequential_scan(self):
+        other = PointRecorder()
+        Scan([other])(self.a, 0, 1, .5, self.b, 0, 2, 1, self.c, 7)
+        MeshScan([self.recorder], snake=False)(self.a, 0, 1, .5, self.b, 0, 2, 1, self.c, 7)
+        assert self.recorder.points == other.points
+
+    def test_needs_two_dimensions(self):
+        with pytest.raises(DiffcalcException):
+            MeshScan([self.recorder])(self.a, 0, 1, 1, self.b)
+
+    def test_lazy(self):
+        mesh = MeshScan([self.recorder])
+        groups = mesh._parseScanArgsIntoScannableArgGroups(
+            (self.a, 0, 999, 1, self.b, 0, 999, 1))
+        t0 = time.time()
+        points = list(islice(mesh._iterPointMoves(groups), 1500))
+        assert time.time() - t0 < 1
+        # The second row starts where the first ended
+        assert points[999] == [(self.b, 999)]
+        assert points[1000] == [(self.a, 1)]
+        assert points[1001] == [(self.b, 998)]
+
+
+class TestMeshScanParts(object):
+
+    def setup_method(self):
+        self.hkl = DummyHkl()
+        self.recorder = PointRecorder()
+
+    @pytest.mark.parametrize('lookahead', [0, 10])
+    def test_parts_moved_together(self, lookahead):
+        MeshScan([self.recorder], lookahead=lookahead)(
+            self.hkl.h, 0, 1, 1, self.hkl.k, 0, 2, 1)
+        assert self.hkl.targets == [(0, 0, 1), (0, 1, 1), (0, 2, 1),
+                                    (1, 2, 1), (1, 1, 1), (1, 0, 1)]
+
+    def test_qshell(self):
+        region = QShell(2.2, 2.5, np.diag([1., 1., 2.]), self.hkl)
+        MeshScan([self.recorder], region=region)(self.hkl.h, -2, 2, 1, self.hkl.k, -2, 2, 1)
+        # |Q|^2 = h^2 + k^2 + 4 with l = 1 from the scan start position
+        assert sorted(set(self.hkl.targets)) == [(-1, -1, 1), (-1, 0, 1), (-1, 1, 1),
+                                                 (0, -1, 1), (0, 1, 1),
+                                                 (1, -1, 1), (1, 0, 1), (1, 1, 1)]
+
+    def test_qshell_needs_hkl_axes(self):
+        a = SingleFieldDummyScannable('a')
+        with pytest.raises(DiffcalcException):
+            MeshScan([self.recorder], region=QShell(0, 1, np.eye(3)))(
+                self.hkl.h, 0, 1, 1, a, 0, 1, 1)
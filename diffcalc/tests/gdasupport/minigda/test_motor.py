@@ -0,0 +1,156 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+
+import time
+
+import pytest
+
+from diffcalc.gdasupport.minigda.command import Scan
+from diffcalc.gdasupport.minigda.motor import SimulatedMotor, VirtualClock
+from diffcalc.hardware import move_time
+from diffcalc.tests.gdasupport.minigda.test_command import PointRecorder
+from diffcalc.util import DiffcalcException
+
+
+class TestVirtualClock(object):
+
+    def test_waits_overlap(self):
+        clock = VirtualClock()
+        clock.sleep_until(3)
+        clock.sleep_until(2)
+        assert clock.time() == 3
+        clock.sleep(1)
+        assert clock.time() == 4
+
+    def test_accelerated(self):
+        clock = VirtualClock(100)
+        t0 = time.time()
+        clock.sleep(5)
+        assert .04 <= time.time() - t0 < 1
+        assert clock.time() >= 5
+
+    def test_rate_positive(self):
+        with pytest.raises(DiffcalcException):
+            VirtualClock(0)
+
+
+class TestSimulatedMotor(object):
+
+    def setup_method(self):
+        self.clock = VirtualClock()
+
+    def test_trapezoidal_move(self):
+        motor = SimulatedMotor('m', self.clock, velocity=1., acceleration=2.)
+        motor.asynchronousMoveTo(10)
+        assert motor.isBusy()
+        assert motor.getPosition() == 0
+        # Accelerates for .5 s over .25 units, then cruises at 1 unit/s
+        self.clock.sleep(.5)
+        assert motor.getPosition() == pytest.approx(.25)
+        self.clock.sleep(5)
+        assert motor.getPosition() == pytest.approx(5.25)
+        motor.waitWhileBusy()
+        assert self.clock.time() == pytest.approx(move_time(10, 1., 2.))
+        assert motor.getPosition() == 10
+        assert not motor.isBusy()
+
+    def test_short_move(self):
+        motor = SimulatedMotor('m', self.clock, velocity=10., acceleration=1.)
+        motor.asynchronousMoveTo(-1)
+        motor.waitWhileBusy()
+        assert self.clock.time() == pytest.approx(2.)
+        assert motor.getPosition() == -1
+
+    def test_latency_and_settle(self):
+        motor = SimulatedMotor('m', self.clock, latency=.2, settle=.3)
+        motor.asynchronousMoveTo(1)
+        self.clock.sleep(.2)
+        assert motor.getPosition() == 0
+        self.clock.sleep(1.5)
+        assert motor.getPosition() == 1
+        assert motor.isBusy()
+        motor.waitWhileBusy()
+        assert self.clock.time() == pytest.approx(2.)
+
+    def test_backlash(self):
+        motor = SimulatedMotor('m', self.clock, backlash=.5, initial_position=5)
+        motor.asynchronousMoveTo(2)
+        # Overshoots to 1.5 and comes back up
+        self.clock.sleep(move_time(3.5, 1., 2.))
+        assert motor.getPosition() == pytest.approx(1.5)
+        motor.waitWhileBusy()
+        assert motor.getPosition() == 2
+        assert self.clock.time() == pytest.approx(move_time(3.5, 1., 2.) + move_time(.5, 1., 2.))
+        # Moves up go straight to the target
+        motor.asynchronousMoveTo(3)
+        motor.waitWhileBusy()
+        assert self.clock.time() == pytest.approx(
+            move_time(3.5, 1., 2.) + move_time(.5, 1., 2.) + move_time(1, 1., 2.))
+
+    def test_noise_seeded(self):
+        reads = []
+        for _ in range(2):
+            motor = SimulatedMotor('m', self.clock, noise=.01, seed=3)
+            reads.append([motor.getPosition() for _ in range(100)])
+        assert reads[0] == reads[1]
+        assert 0 < max(abs(r) for r in reads[0]) < .1
+
+    def test_retarget_while_moving(self):
+        motor = SimulatedMotor('m', self.clock)
+        motor.asynchronousMoveTo(10)
+        self.clock.sleep(2)
+        reached = motor.getPosition()
+        motor.asynchronousMoveTo(0)
+        assert motor.getPosition() == reached
+        motor.waitWhileBusy()
+        assert motor.getPosition() == 0
+
+    def test_limits(self):
+        motor = SimulatedMotor('m', self.clock)
+        motor.setUpperDummyLimit(5)
+        with pytest.raises(DiffcalcException):
+            motor.asynchronousMoveTo(6)
+
+
+def test_scan_duration_deterministic():
+    durations = []
+    for _ in range(2):
+        clock = VirtualClock()
+        a = SimulatedMotor('a', clock, settle=.1, latency=.05)
+        b = SimulatedMotor('b', clock, velocity=2., settle=.1, latency=.05)
+        recorder = PointRecorder()
+        Scan([recorder])(a, 0, 3, 1, b, 4)
+        assert [p['a'] for p in recorder.points] == [0, 1, 2, 3]
+        durations.append(clock.time())
+    # b moves once alongside a, then a makes three unit moves
+    step = .05 + move_time(1, 1., 2.) + .1
+    assert durations[0] == durations[1] == pytest.approx(
+        .05 + move_time(4, 2., 2.) + .1 + 3 * step)
+
+
+def test_polled_scan():
+    clock = VirtualClock()
+    a = SimulatedMotor('a', clock, settle=.1, latency=.05)
+    recorder = PointRecorder()
+    Scan([recorder], poll_interval=.01)(a, 0, 2, 1)
+    assert [p['a'] for p in recorder.points] == [0, 1, 2]
+    # Every move ends at the first poll after it is done, the first one
+    # only waiting for latency and settling
+    expected = .05 + .1 + 2 * (.05 + move_time(1, 1., 2.) + .1)
+    assert expected <= clock.time() <= expected + 3 * .01 + 1e-9
@@ -0,0 +1,119 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+import pytest
+import numpy as np
+
+from diffcalc.gdasupport.minigda.command import Scan
+from diffcalc.gdasupport.minigda.motor import SimulatedMotor, VirtualClock
+from diffcalc.gdasupport.minigda.peakfit import PeakFitter, fit_peak, \
+    centroid, gaussian, lorentzian, pseudovoigt
+from diffcalc.gdasupport.minigda.scannable import SingleFieldDummyScannable
+from diffcalc.util import DiffcalcException
+
+
+class GaussianCounter(SingleFieldDummyScannable):
+
+    def __init__(self, name, axis, centre):
+        SingleFieldDummyScannable.__init__(self, name)
+        self.axis = axis
+        self.centre = centre
+
+    def getPosition(self):
+        return 10 + 100 * gaussian(self.axis.getPosition(), 1., self.centre, 0.2)
+
+
+class TestFitPeak(object):
+
+    def setup_method(self):
+        self.x = np.linspace(-2, 2, 4001)
+        self.noise = np.random.RandomState(0).normal(0, 0.5, len(self.x))
+
+    def test_gaussian(self):
+        y = 5 + gaussian(self.x, 100, 0.123, 0.3) + self.noise
+        res = fit_peak(self.x, y, 'gaussian')
+        assert res.shape == 'gaussian'
+        assert res.centre == pytest.approx(0.123, abs=1e-3)
+        assert res.fwhm == pytest.approx(0.3, abs=1e-3)
+        assert res.height == pytest.approx(100, abs=0.5)
+        assert res.background == pytest.approx(5, abs=0.1)
+        assert res.centre_err < 1e-3
+
+    def test_lorentzian(self):
+        y = 5 + lorentzian(self.x, 100, -0.4, 0.2) + self.noise
+        res = fit_peak(self.x, y, 'lorentzian')
+        assert res.shape == 'lorentzian'
+        assert res.centre == pytest.approx(-0.4, abs=1e-3)
+        assert res.fwhm == pytest.approx(0.2, abs=1e-3)
+
+    def test_pseudovoigt(self):
+        y = pseudovoigt(self.x, 100, 0.7, 0.25, 0.3) + self.noise
+        res = fit_peak(self.x[::-1], y[::-1], 'pseudovoigt')
+        assert res.centre == pytest.approx(0.7, abs=1e-3)
+        assert res.fwhm == pytest.approx(0.25, abs=1e-3)
+
+    def test_centroid(self):
+        y = gaussian(self.x, 100, 0.5, 0.2)
+        res = centroid(self.x, y)
+        assert res.shape == 'centroid'
+        assert res.centre == pytest.approx(0.5, abs=1e-6)
+        assert res.fwhm == pytest.approx(0.2, abs=2e-3)
+
+    def test_fallback_to_centroid(self):
+        # Triangular peak sampled at too few points for a stable fit
+        res = fit_peak([0, 1, 2], [0, 1, 0], 'pseudovoigt')
+        assert res.shape == 'centroid'
+        assert res.centre == pytest.approx(1)
+
+    def test_bad_input(self):
+        with pytest.raises(DiffcalcException):
+            fit_peak(self.x, np.zeros(len(self.x)))
+        with pytest.raises(DiffcalcException):
+            fit_peak([0, 1], [0, 1])
+        with pytest.raises(DiffcalcException):
+            fit_peak(self.x, self.x, 'triangle')
+
+
+class TestPeakFitter(object):
+
+    def setup_method(self):
+        self.axis = SingleFieldDummyScannable('axis')
+        self.counter = GaussianCounter('counter', self.axis, 0.31)
+        self.fitter = PeakFitter(auto=True)
+        self.scan = Scan([self.fitter])
+
+    def test_fit_and_move_to_peak(self):
+        self.scan(self.axis, -1, 1, .05, self.counter)
+        assert len(self.fitter.x) == 41
+        assert self.fitter.last_fit.centre == pytest.approx(0.31, abs=1e-6)
+        self.fitter.move_to_peak()
+        assert self.axis.getPosition() == pytest.approx(0.31, abs=1e-6)
+        assert self.fitter.fit('centroid').centre == pytest.approx(0.31, abs=1e-3)
+
+    def test_move_to_peak_waits(self):
+        self.axis = SimulatedMotor('axis', VirtualClock(), latency=.1)
+        self.counter.axis = self.axis
+        self.scan(self.axis, -1, 1, .05, self.counter)
+        self.fitter.move_to_peak()
+        assert self.axis.getPosition() == pytest.approx(0.31, abs=1e-6)
+
+    def test_no_data(self):
+        with pytest.raises(DiffcalcException):
+            self.fitter.fit()
+        with pytest.raises(DiffcalcException):
+            self.fitter.move_to_peak()
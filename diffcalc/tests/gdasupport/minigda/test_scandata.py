@@ -0,0 +1,122 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+import os
+import shutil
+import sys
+import tempfile
+from StringIO import StringIO
+
+import numpy as np
+import pytest
+
+from diffcalc.gdasupport.minigda.command import Scan, ScanDataPrinter
+from diffcalc.gdasupport.minigda.scandata import ScanDataRecorder, read_scan_file
+from diffcalc.gdasupport.minigda.scannable import \
+    MultiInputExtraFieldsDummyScannable, SingleFieldDummyScannable
+
+
+class TestScanDataRecorder(object):
+
+    def setup_method(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.a = SingleFieldDummyScannable('a')
+        self.b = SingleFieldDummyScannable('b')
+        self.multi = MultiInputExtraFieldsDummyScannable('multi', ['x', 'a'], ['e'])
+
+    def teardown_method(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_columns_in_memory(self):
+        recorder = ScanDataRecorder(capacity=2)
+        Scan([recorder])(self.a, 0, 1, .25, self.b, 0, .2, .1, self.multi)
+        eq = np.testing.assert_array_equal
+        assert recorder.names == ['a', 'b', 'x', 'multi.a', 'e', 'time']
+        assert recorder.data.shape == (15, 6)
+        eq(recorder['a'], np.repeat([0, .25, .5, .75, 1], 3))
+        eq(recorder['b'][:3], [0, .1, .2])
+        eq(recorder.columns()['e'], np.full(15, 100.))
+        assert np.all(np.diff(recorder['time']) >= 0)
+
+    def test_chunked_file(self):
+        recorder = ScanDataRecorder(self.tmpdir, chunk_points=4)
+        Scan([recorder])(self.a, 0, 9, 1, self.b)
+        assert os.path.basename(recorder.path) == 'scan00001.bin'
+        header, columns = read_scan_file(recorder.path)
+        assert header['columns'] == ['a', 'b', 'time']
+        np.testing.assert_array_equal(columns['a'], range(10))
+
+        # A partly written row is ignored
+        with open(recorder.path, 'ab') as f:
+            f.write('\0' * 12)
+        _, columns = read_scan_file(recorder.path)
+        assert len(columns['a']) == 10
+
+        Scan([recorder])(self.a, 0, 1, 1)
+        assert os.path.basename(recorder.path) == 'scan00002.bin'
+
+    def test_bad_points_recorded_as_nan(self):
+        recorder = ScanDataRecorder()
+        recorder.callAtScanStart([self.a, self.multi, self.b])
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            recorder.callWithScanPoint({self.a: 'busy', self.multi: [1, 2]})
+            recorder.callWithScanPoint({self.a: None, self.multi: [1, 2, 3, 4], self.b: 5})
+            recorder.callWithScanPoint({self.a: 1, self.multi: (1, 'x', 3), self.b: [6]})
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        # Warned once for the scannable returning the wrong number of fields
+        assert printed.count('Warning') == 1
+        assert 'multi returned 2 fields, expected 3' in printed
+        data = recorder.data[:, :-1]
+        np.testing.assert_array_equal(data, [[np.nan, 1, 2, np.nan, np.nan],
+                                             [np.nan, 1, 2, 3, 5],
+                                             [1, 1, np.nan, 3, 6]])
+
+    def test_bad_file(self):
+        path = os.path.join(self.tmpdir, 'other.bin')
+        with open(path, 'w') as f:
+            f.write('something else\n')
+        with pytest.raises(IOError):
+            read_scan_file(path)
+
+
+class TestRateLimitedPrinting(object):
+
+    def _printed_rows(self, printer, npoints):
+        a = SingleFieldDummyScannable('a')
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            Scan([printer])(a, 1, npoints, 1)
+            return sys.stdout.getvalue().splitlines()
+        finally:
+            sys.stdout = stdout
+
+    def test_rate_limited(self):
+        lines = self._printed_rows(ScanDataPrinter(min_interval=60), 100)
+        # Header, underline, first and last points and note of skipped points
+        assert len(lines) == 5
+        assert lines[3].strip() == '100.0000'
+        assert lines[4] == '(98 points not printed)'
+
+    def test_not_limited(self):
+        assert len(self._printed_rows(ScanDataPrinter(), 10)) == 12
+
+    def test_disabled(self):
+        assert self._printed_rows(ScanDataPrinter(enabled=False), 10) == []
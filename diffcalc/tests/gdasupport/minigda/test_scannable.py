@@ -81,3 +81,8 @@ class TestScannableGroup(object):
         self.a.makeNotBusy()
         self.c.makeNotBusy()
         assert not self.sg.isBusy()
+
+    def testConcurrentAsynchronousMoveTo(self):
+        sg = ScannableGroup('abc', (self.a, self.b, self.c), concurrent=True)
+        sg.asynchronousMoveTo([1, 2.0, None])
+        assert sg.getPosition() == [1.0, 2.0, 0.0]
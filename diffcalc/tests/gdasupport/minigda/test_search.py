@@ -0,0 +1,88 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+import pytest
+
+from diffcalc.gdasupport.minigda.motor import SimulatedMotor, VirtualClock
+from diffcalc.gdasupport.minigda.scannable import ScannableGroup, \
+    SingleFieldDummyScannable
+from diffcalc.gdasupport.minigda.search import ReflectionSearch, significance
+from diffcalc.gdasupport.scannable.simulation import SimulatedCrystalCounter, \
+    Gaussian
+from diffcalc.hkl.you.geometry import SixCircle
+from diffcalc.util import DiffcalcException
+
+
+class TestReflectionSearch(object):
+
+    def setup_method(self):
+        names = ('mu', 'delta', 'gam', 'eta', 'chi', 'phi')
+        self.motors = dict((n, SingleFieldDummyScannable(n)) for n in names)
+        self.group = ScannableGroup('sixc', [self.motors[n] for n in names])
+        self.wl = SingleFieldDummyScannable('wl')
+        self.wl.asynchronousMoveTo(1.)
+        self.ct = SimulatedCrystalCounter('ct', self.group, SixCircle(), self.wl,
+                                          Gaussian(.0001))
+        self.ct.pause = False
+        self.ct.setChiMissmount(1.5)
+        self.ct.setPhiMissmount(-2.)
+        self.search = ReflectionSearch([self.motors['eta'], self.motors['chi']], self.ct)
+
+    def test_finds_missmounted_reflection(self):
+        # Nominal position of the 100 reflection in an unrotated crystal
+        self.group.asynchronousMoveTo([0, 60, 0, 30, 0, 0])
+        assert self.ct.getPosition() < 0.01
+        found = self.search.search([30, 0], 8.)
+        h, k, l = self.ct.getHkl()
+        assert (h, k, l) == pytest.approx((1, 0, 0), abs=1e-3)
+        assert found == [self.motors['eta'].getPosition(), self.motors['chi'].getPosition()]
+        assert self.search.steps[0].level == 0
+        assert self.search.steps[-1].level <= self.search.levels
+        assert all(st.significance >= 5 for st in self.search.steps[-2:])
+
+    def test_waits_for_motors(self):
+        clock = VirtualClock()
+        for name in ('eta', 'chi'):
+            self.motors[name] = SimulatedMotor(name, clock, velocity=5., latency=.1)
+        self.group = ScannableGroup('sixc', [self.motors[n] for n in
+                                             ('mu', 'delta', 'gam', 'eta', 'chi', 'phi')])
+        self.ct.diffractometerScannable = self.group
+        self.search = ReflectionSearch([self.motors['eta'], self.motors['chi']], self.ct)
+        self.group.asynchronousMoveTo([0, 60, 0, 30, 0, 0])
+        self.group.waitWhileBusy()
+        found = self.search.search([30, 0], 8.)
+        assert self.ct.getHkl() == pytest.approx((1, 0, 0), abs=1e-3)
+        assert found == [self.motors['eta'].getPosition(), self.motors['chi'].getPosition()]
+
+    def test_no_peak_in_volume(self):
+        self.group.asynchronousMoveTo([0, 60, 0, 60, 0, 0])
+        with pytest.raises(DiffcalcException):
+            self.search.search([60, 0], 2.)
+        # Axes are returned to the predicted position
+        assert self.motors['eta'].getPosition() == 60
+        assert self.motors['chi'].getPosition() == 0
+
+    def test_bad_centre(self):
+        with pytest.raises(DiffcalcException):
+            self.search.search([30], 1.)
+
+
+def test_significance():
+    assert significance([1, 1, 1, 11, 1], 10., 1.) == pytest.approx(10.)
+    assert significance([0, 0, 5, 0], 5., 0.) == float('inf')
+    assert significance([0, 0, 0], 0., 0.) == 0.
@@ -0,0 +1,130 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+import json
+
+import numpy as np
+import pytest
+
+from diffcalc.gdasupport.minigda.trajectory import HklFlyScan, \
+    SimulatedTrajectoryExecutor, build_profile, path_jumps
+from diffcalc.util import DiffcalcException
+
+
+def _check_within_limits(profile, velocity, acceleration):
+    # Differentiate a finely sampled playback of the profile
+    times = np.linspace(0, profile.duration, 20001)
+    states = [profile.state_at(t) for t in times]
+    vel = np.array([v for _, v in states])
+    acc = np.diff(vel, axis=0) / np.diff(times)[:, None]
+    assert np.all(abs(vel) <= np.asarray(velocity) * (1 + 1e-6))
+    assert np.all(abs(acc) <= np.asarray(acceleration) * 1.05)
+    assert np.allclose(vel[0], 0) and np.allclose(vel[-1], 0)
+
+
+class TestBuildProfile(object):
+
+    def test_line(self):
+        positions = np.linspace([0., 10.], [10., 15.], 11)
+        profile = build_profile(['a', 'b'], positions, [2., 2.], [1., 1.])
+        # Constant speed on the path, limited by the first axis
+        assert np.allclose(profile.velocities[profile.path], [2., 1.])
+        assert np.allclose(np.diff(profile.path_times), .5)
+        # Run-up from rest at full acceleration
+        assert profile.path_times[0] == pytest.approx(2.)
+        assert np.allclose(profile.positions[0], [-2., 9.])
+        assert np.allclose(profile.positions[-1], [12., 16.])
+        _check_within_limits(profile, [2., 2.], [1., 1.])
+
+    def test_duration(self):
+        positions = np.linspace([0.], [10.], 11)
+        profile = build_profile(['a'], positions, [2.], [1.], duration=20)
+        assert profile.path_times[-1] - profile.path_times[0] == pytest.approx(20)
+
+    def test_curved_path_respects_limits(self):
+        angle = np.linspace(0, np.pi, 41)
+        positions = np.column_stack([10 * np.cos(angle), 10 * np.sin(angle)])
+        profile = build_profile(['a', 'b'], positions, [3., 2.], [4., 1.])
+        _check_within_limits(profile, [3., 2.], [4., 1.])
+        # The playback passes through the sampled path points
+        for t, pos in zip(profile.path_times, positions):
+            assert np.allclose(profile.state_at(t)[0], pos)
+
+    def test_pvt_output(self):
+        profile = build_profile(['a', 'b'], [[0., 0.], [1., 2.]], [1., 1.], [1., 1.])
+        pvt = profile.pvt('b')
+        assert len(pvt) == 4
+        assert pvt[0] == (0., -.5, 0.)
+        assert sum(dt for dt, _, _ in pvt) == pytest.approx(profile.duration)
+        d = json.loads(json.dumps(profile.to_dict()))
+        assert d['axes'] == ['a', 'b']
+        assert d['positions']['b'] == [p for _, p, _ in pvt]
+
+    def test_limit_violations(self):
+        positions = np.linspace([0.], [10.], 11)
+        profile = build_profile(['a'], positions, [2.], [1.])
+        assert profile.limit_violations([0.], [10.]) != []
+        # The run-up needs 2 degrees before the start of the path
+        assert profile.limit_violations([-2.], [12.]) == []
+        t, name, pos = profile.limit_violations([-1.], [None])[0]
+        assert name == 'a' and pos < -1
+
+    def test_path_jumps(self):
+        values = [[0., 179.], [.1, -179.], [20., -178.]]
+        assert path_jumps(['a', 'b'], values, 5) == [(0, 'b', -358.), (1, 'a', 19.9)]
+        assert path_jumps(['a', 'b'], values, 5, wrap=True) == [(1, 'a', pytest.approx(19.9))]
+
+
+class TestHklFlyScan(object):
+
+    def hkl_to_angles(self, h, k, l):
+        if h > 1.5:
+            raise DiffcalcException("unreachable")
+        # Virtual angle flips sign for negative k
+        return [10 * h, 5 * k], {'psi': 90. if k >= 0 else -90.}
+
+    def _planner(self, lower=(None, None), upper=(None, None)):
+        return HklFlyScan(self.hkl_to_angles, ['a', 'b'], [1., 1.], [1., 1.],
+                          list(lower), list(upper), max_jump=5)
+
+    def test_plan_and_run(self):
+        profile = self._planner().plan([0, 0, 0], [1, 1, 0], 11)
+        assert profile.hkl.shape == (11, 3)
+        moves, triggers = [], []
+        executor = SimulatedTrajectoryExecutor(profile)
+        executor.run(moves.append, lambda i, t, pos: triggers.append((i, pos)), interval=.1)
+        assert executor.time == profile.duration
+        assert len(moves) > profile.duration / .1
+        assert [i for i, _ in triggers] == range(11)
+        for (i, pos), hkl in zip(triggers, profile.hkl):
+            assert np.allclose(pos, [10 * hkl[0], 5 * hkl[1]])
+
+    def test_branch_flip(self):
+        with pytest.raises(DiffcalcException) as e:
+            self._planner().plan([0, 1, 0], [0, -1, 0], 11)
+        assert 'psi' in str(e.value)
+
+    def test_unreachable(self):
+        with pytest.raises(DiffcalcException) as e:
+            self._planner().plan([1, 0, 0], [2, 0, 0], 11)
+        assert 'Path point 6' in str(e.value)
+
+    def test_limits(self):
+        with pytest.raises(DiffcalcException) as e:
+            self._planner(lower=(-100, -100), upper=(10.4, 100)).plan([0, 0, 0], [1, 0, 0], 11)
+        assert 'limits of a' in str(e.value)
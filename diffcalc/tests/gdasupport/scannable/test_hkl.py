@@ -18,6 +18,7 @@
 
 import mock
 import nose
+from nose.tools import eq_  # @UnresolvedImport
 import unittest
 
 from diffcalc.gdasupport.scannable.diffractometer import \
@@ -75,6 +76,45 @@ class TestHkl(object):
         self.mock_dc_module.hkl_to_angles.assert_called_with(1, 0, 1)
         self.mockSixc.asynchronousMoveTo.assert_called_with([6, 5, 4, 3, 2, 1])
 
+    def testPrepareMoveTo(self):
+        self.mock_dc_module.hkl_to_angles.return_value = ([6, 5, 4, 3, 2, 1], None)
+        self.mockSixc.prepareMoveTo.side_effect = lambda pos: pos
+        prepared = self.hkl.prepareMoveTo([1, 0, 1])
+        self.mock_dc_module.hkl_to_angles.assert_called_with(1, 0, 1)
+        self.mockSixc.prepareMoveTo.assert_called_with([6, 5, 4, 3, 2, 1])
+        assert not self.mockSixc.asynchronousMoveTo.called
+        self.hkl.asynchronousMoveToPrepared(prepared)
+        self.mockSixc.asynchronousMoveTo.assert_called_with([6, 5, 4, 3, 2, 1])
+
+    def testPrepareMoveToPartWithNonesInScan(self):
+        self.mockSixc.getPosition.return_value = [6, 5, 4, 3, 2, 1]
+        self.mock_dc_module.angles_to_hkl.return_value = ([1, 0, 1], PARAM_DICT)
+        self.mockSixc.prepareMoveTo.side_effect = lambda pos: pos
+        self.hkl.atScanStart()
+        self.mock_dc_module.hkl_to_angles.return_value = ([12, 5, 4, 3, 2, 1], None)
+        prepared = self.hkl.h.prepareMoveTo(2)
+        self.mock_dc_module.hkl_to_angles.assert_called_with(2, 0, 1)
+        self.hkl.h.asynchronousMoveToPrepared(prepared)
+        self.mockSixc.asynchronousMoveTo.assert_called_with([12, 5, 4, 3, 2, 1])
+
+    def testPrepareMoveToInScanChoosesRelativeToPreviousTarget(self):
+        self.mockSixc.getPosition.return_value = [6, 5, 4, 3, 2, 1]
+        self.mock_dc_module.angles_to_hkl.return_value = ([1, 0, 1], PARAM_DICT)
+        self.mockSixc.prepareMoveTo.side_effect = lambda pos: pos
+        self.mock_dc_module.hkl_to_angles.return_value = ([7, 5, 4, 3, 2, 1], None)
+        solutions = [([8, 5, 4, 3, 2, 1], None, None), ([-8, 5, 4, 3, 2, 1], None, None)]
+        self.mock_dc_module.hkl_to_all_angles.return_value = solutions
+        self.mock_dc_module.choose_solution.return_value = 1
+        self.hkl.atScanStart()
+        eq_(self.hkl.prepareMoveTo([1, 0, 1]), [7, 5, 4, 3, 2, 1])
+        eq_(self.hkl.prepareMoveTo([2, 0, 1]), [-8, 5, 4, 3, 2, 1])
+        self.mock_dc_module.choose_solution.assert_called_with(solutions, [7, 5, 4, 3, 2, 1])
+        self.hkl.prepareMoveTo([3, 0, 1])
+        self.mock_dc_module.choose_solution.assert_called_with(solutions, [-8, 5, 4, 3, 2, 1])
+        self.hkl.atScanEnd()
+        self.hkl.prepareMoveTo([1, 0, 1])
+        eq_(self.mock_dc_module.hkl_to_angles.call_count, 2)
+
     def testGetPosition(self):
         self.mockSixc.getPosition.return_value = [6, 5, 4, 3, 2, 1]
         self.mock_dc_module.angles_to_hkl.return_value = ([1, 0, 1], PARAM_DICT)
@@ -16,6 +16,7 @@
 # along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
 ###
 
+import time
 from math import pi
 import unittest
 from pytest import approx
@@ -27,6 +28,7 @@ except ImportError:
 
 from diffcalc.gdasupport.scannable.simulation import SimulatedCrystalCounter, \
     Gaussian
+from diffcalc.gdasupport.minigda.motor import VirtualClock
 from diffcalc.hkl.vlieg.geometry import Fourc
 from diffcalc.util import nearlyEqual
 from diffcalc.tests.tools import mneq_
@@ -89,6 +91,58 @@ class TestSimulatedCrystalCounter(object):
         assert self.eq.dHkl == approx(dHkl)
         assert count == 2
 
+    def testCountTakenAtExposureStart(self):
+        self.diff.pos = [60, 30, 0, 0]
+        self.scc.asynchronousMoveTo(.1)
+        # Moving on while exposing
+        self.diff.pos = [60, 31, 0, 0]
+        self.eq.dHkl = None
+        assert self.scc.getPosition() == approx(.1)
+        assert self.eq.dHkl is None
+        # Read again without a new exposure
+        self.scc.getPosition()
+        assert self.eq.dHkl == approx((0.999847695156391 - 1, .017452406437283574, 0))
+
+    def testExposureInBackground(self):
+        self.diff.pos = [60, 30, 0, 0]
+        t0 = time.time()
+        self.scc.asynchronousMoveTo(.2)
+        assert time.time() - t0 < .1
+        assert self.scc.isBusy()
+        # Reading out waits for the exposure to end
+        assert self.scc.getPosition() == approx(.2)
+        assert time.time() - t0 >= .2
+        assert not self.scc.isBusy()
+
+    def testNextExposureWaitsForLast(self):
+        self.diff.pos = [60, 30, 0, 0]
+        t0 = time.time()
+        self.scc.asynchronousMoveTo(.1)
+        self.scc.asynchronousMoveTo(.1)
+        self.scc.waitWhileBusy()
+        assert time.time() - t0 >= .2
+        assert self.scc.exposureClock == approx(.2)
+
+    def testFastForward(self):
+        self.diff.pos = [60, 30, 0, 0]
+        self.scc.pause = False
+        t0 = time.time()
+        for _ in range(10):
+            self.scc.asynchronousMoveTo(10)
+            assert not self.scc.isBusy()
+            assert self.scc.getPosition() == 10
+        assert time.time() - t0 < 1
+        assert self.scc.exposureClock == 100
+
+    def testVirtualClock(self):
+        self.diff.pos = [60, 30, 0, 0]
+        self.scc.clock = VirtualClock()
+        self.scc.asynchronousMoveTo(5)
+        assert self.scc.isBusy()
+        assert self.scc.getPosition() == 5
+        assert self.scc.clock.time() == 5
+        assert not self.scc.isBusy()
+
     def test__repr__(self):
         self.diff.pos = [60, 30, 0, 0]
         print self.scc.__repr__()
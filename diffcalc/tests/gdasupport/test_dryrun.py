@@ -0,0 +1,93 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+
+import numpy as np
+import pytest
+
+from diffcalc.gdasupport.dryrun import _linear_runs, _ranges, solve_path
+from diffcalc.util import DiffcalcException
+
+
+def nearest(solutions, reference):
+    return int(np.argmin([abs(np.asarray(s) - reference).max() for s in solutions]))
+
+
+class TestSolvePath(object):
+
+    def setup_method(self):
+        self.solved = []
+
+    def solve(self, hkl):
+        h, k, _ = hkl
+        self.solved.append(tuple(hkl))
+        if h > 2:
+            raise DiffcalcException("unreachable")
+        # Two branches with the second axis 90 degrees apart
+        return [[30 * np.sin(h), 10 * k], [30 * np.sin(h), 10 * k + 90]]
+
+    def test_interpolated(self):
+        hkls = np.linspace([0, 0, 0], [1.5, 1, 0], 10001)
+        positions, failures, switches, nsolved = solve_path(
+            hkls, self.solve, nearest, [0, 0])
+        exact = np.column_stack([30 * np.sin(hkls[:, 0]), 10 * hkls[:, 1]])
+        assert abs(positions - exact).max() < 1e-3
+        assert nsolved == len(set(self.solved)) < 200
+        assert failures == {} and switches == []
+
+    def test_unreachable(self):
+        hkls = np.linspace([1, 0, 0], [3, 0, 0], 2001)
+        positions, failures, _, _ = solve_path(hkls, self.solve, nearest, [0, 0])
+        assert sorted(failures) == range(1001, 2001)
+        assert np.isnan(positions[1001:]).all()
+        assert not np.isnan(positions[:1001]).any()
+
+    def test_limit_crossed_between_solved_points(self):
+        def solve(hkl):
+            angle = 95 - 2000 * (hkl[0] - .62) ** 2
+            if angle > 90:
+                raise DiffcalcException("beyond limit")
+            return [[angle]]
+        hkls = np.linspace([0, 0, 0], [1, 0, 0], 101)
+        beyond = [i for i, h in enumerate(hkls[:, 0]) if 95 - 2000 * (h - .62) ** 2 > 90]
+        positions, failures, _, _ = solve_path(hkls, solve, nearest, [0],
+                                               limits=[(None, 90)])
+        assert sorted(failures) == beyond
+        assert np.nanmax(positions) <= 90
+
+    def test_branch_switch(self):
+        # A chooser keeping the second axis above -20 swaps branch at k = -2
+        above = lambda solutions, reference: int(solutions[0][1] < -20)
+        hkls = np.linspace([0, 0, 0], [0, -4, 0], 401)
+        positions, _, switches, _ = solve_path(hkls, self.solve, above, [0, 0])
+        assert switches == [201]
+        assert positions[200, 1] == pytest.approx(-20)
+        assert positions[201, 1] == pytest.approx(69.9)
+
+    def test_runs(self):
+        hkls = [[0, 0, 0], [1, 0, 0], [2, 0, 0], [2, 1, 0], [2, 2, 0], [5, 5, 5]]
+        assert _linear_runs(hkls) == [(0, 2), (2, 4), (4, 5)]
+        # Fresh runs after a jump are not checked for branch switches
+        positions, _, switches, _ = solve_path(
+            np.array(hkls) / 10., self.solve, nearest, [0, 0])
+        assert switches == []
+        assert len(positions) == 6
+
+    def test_ranges(self):
+        assert _ranges([1, 2, 3, 7, 9, 10]) == '1-3, 7, 9-10'
+        assert _ranges(range(0, 40, 2), limit=2) == '0, 2, ...'
@@ -0,0 +1,86 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+
+import time
+from itertools import permutations
+
+import numpy as np
+
+from diffcalc.gdasupport.ordering import order_positions, order_queue, tour_time, \
+    travel_times
+from diffcalc.util import DiffcalcException
+
+
+def test_travel_times_slowest_axis():
+    # 10 degrees at 1 deg/s and 1 deg/s^2 takes 11 s, 1 degree 2 s
+    times = travel_times([0, 0], [[10, 1], [1, 1], [0, 0]], [1., 1.], [1., 1.])
+    assert np.allclose(times, [11, 2, 0])
+    # A faster axis shortens its moves
+    assert np.allclose(travel_times([0, 0], [[10, 1]], [10., 1.], [10., 1.]), [2.])
+
+
+class TestOrderPositions(object):
+
+    def test_line(self):
+        positions = np.arange(20.)[:, None] * [1., 2.]
+        shuffled = np.random.RandomState(0).permutation(20)
+        order = order_positions(positions[shuffled], [1., 1.], [1., 1.], [-1., -2.])
+        assert list(shuffled[order]) == range(20)
+
+    def test_near_optimal(self):
+        rng = np.random.RandomState(1)
+        velocity = [1., 2., .5]
+        for _ in range(10):
+            positions = rng.uniform(-50, 50, (7, 3))
+            best = min(tour_time(positions, p, velocity, 1., [0, 0, 0])
+                       for p in permutations(range(7)))
+            order = order_positions(positions, velocity, 1., [0, 0, 0])
+            assert sorted(order) == range(7)
+            assert tour_time(positions, order, velocity, 1., [0, 0, 0]) <= 1.2 * best
+
+    def test_large_queue(self):
+        positions = np.random.RandomState(2).uniform(-90, 90, (3000, 4))
+        t0 = time.time()
+        order = order_positions(positions, [1., 1., 2., 2.], 2., [0, 0, 0, 0])
+        assert time.time() - t0 < 10
+        assert sorted(order) == range(3000)
+        given = tour_time(positions, range(3000), [1., 1., 2., 2.], 2., [0, 0, 0, 0])
+        assert tour_time(positions, order, [1., 1., 2., 2.], 2., [0, 0, 0, 0]) < given / 5
+
+    def test_empty(self):
+        assert order_positions(np.empty((0, 2)), [1., 1.], [1., 1.], [0, 0]) == []
+        assert order_positions([[1., 1.]], [1., 1.], [1., 1.], [0, 0]) == [0]
+
+
+def test_order_queue():
+
+    def solve(hkl):
+        if hkl[0] > 5:
+            raise DiffcalcException("unreachable")
+        return [10. * hkl[0], 10. * hkl[1]]
+
+    hkls = [[3, 0, 0], [1, 0, 0], [9, 0, 0], [4, 0, 0], [2, 0, 0]]
+    result = order_queue(hkls, solve, [0, 0], [1., 1.], [1., 1.])
+    assert result.targets == [[1, 0, 0], [2, 0, 0], [3, 0, 0], [4, 0, 0]]
+    assert result.order == [1, 4, 0, 3]
+    assert result.unreachable.keys() == [2]
+    assert result.optimised_time == 4 * 11
+    # Given order moves 30, 20, 30 and 20 degrees
+    assert result.time_saved == 31 + 21 + 31 + 21 - 4 * 11
+    assert 'time saved' in str(result)
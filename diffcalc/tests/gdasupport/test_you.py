@@ -16,16 +16,21 @@
 # along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
 ###
 
+import os
+import shutil
+import tempfile
 from math import pi
-from nose.tools import eq_, raises  # @UnresolvedImport
+from nose.tools import assert_raises, eq_, raises  # @UnresolvedImport
 from nose.plugins.skip import Skip, SkipTest  # @UnresolvedImport
 from diffcalc.hardware import ScannableHardwareAdapter
 from diffcalc.gdasupport.minigda.scannable import SingleFieldDummyScannable,\
     ScannableGroup
+from diffcalc.gdasupport.scannable.simulation import Gaussian
 from diffcalc.hkl.you.geometry import SixCircle
 from diffcalc.ub.persistence import UbCalculationNonPersister
 
 import diffcalc.util  # @UnusedImport
+from diffcalc.util import DiffcalcException
 
 try:
     from numpy import matrix
@@ -171,6 +176,171 @@ def test_hkl_move_okay():
     pos(you.hkl, [1, 1, 0])  # TODO: prints DEGENERATE. necessary?
     call_scannable(you.sixc)  # @UndefinedVariable
 
+def test_equivhkl():
+    _orient()
+    you.con(mu)
+    you.con(gam)
+    you.con('a_eq_b')
+    pos(you.mu_con, 0)
+    pos(you.gam_con, 0)
+    you.equivhkl([1, 1, 0], 'm-3m')
+
+def test_scan_fitpeak():
+    _orient()
+    pos(you.sixc, [0, 60, 0, 29.1, 0, 0])  # @UndefinedVariable
+    you.scan(eta, 29, 31, 0.05, you.ct)
+    you.fitpeak('gaussian', [1, 0, 0], 'fitted')
+    assert abs(eta.getPosition() - 30) < 1e-4
+    _, pos_fitted, _, tag, _ = you.ubcalc.get_reflection(3)
+    eq_(tag, 'fitted')
+    assert abs(pos_fitted.eta - 30) < 1e-4
+
+def test_pscan_hkl():
+    _orient()
+    you.con('mu', 0, 'gam', 0, 'phi', 0)
+    try:
+        pos(you.hkl, [1, 0, 0])
+        you.pscan(you.h, 1, 1.2, .05, you.ct)
+        h, k, l = you.hkl.getPosition()[:3]
+        assert abs(h - 1.2) < 1e-6 and abs(k) < 1e-6 and abs(l) < 1e-6
+        eq_(len(you._peakfit.x), 5)
+    finally:
+        you.uncon('phi')
+
+def test_pscan_follows_branch():
+    _orient()
+    you.con('mu', 0, 'gam', 0, 'phi', 0)
+    try:
+        # Beyond h = 0 the solutions on the branch started on are far from
+        # the start position, so all points must be chosen relative to the
+        # previous one
+        angles = []
+        for scan in (you.scan, you.pscan):
+            pos(you.sixc, [0, 60, 0, 30, 0, 0])  # @UndefinedVariable
+            # Counting lets pscan prepare points well ahead of the motors
+            scan(you.hkl, [1, .2, 0], [-1, .2, 0], [-.25, 0, 0], you.sixc, you.ct, .05)
+            data = you.scandata()
+            angles.append([data[name] for name in ('delta', 'eta')])
+        mneq_(matrix(angles[0]), matrix(angles[1]), 4)
+        assert all(angles[1][0] > 0)
+        assert abs(angles[1][1][-1] + 160.7) < .1
+    finally:
+        you.uncon('phi')
+
+def test_mesh_hkl():
+    _orient()
+    you.con('mu', 0, 'gam', 0, 'phi', 0)
+    try:
+        pos(you.hkl, [1, 0, 0])
+        you.meshopt(True, 0, 10)
+        you.mesh(you.h, 1, 1.1, .05, you.k, 0, .1, .05, you.ct)
+        # In snake order the third row runs forwards again
+        h, k, l = you.hkl.getPosition()[:3]
+        assert abs(h - 1.1) < 1e-6 and abs(k - .1) < 1e-6 and abs(l) < 1e-6
+        eq_(len(you.scandata()['ct']), 9)
+    finally:
+        you.meshopt()
+        you.uncon('phi')
+
+def test_flyscan():
+    _orient()
+    you.con('mu', 0, 'gam', 0, 'phi', 0)
+    try:
+        profile = you.flyscan([1, 0, 0], [1.2, 0, 0], 21)
+        h, k, l = you.hkl.getPosition()[:3]
+        # Left at the end of the run-down, beyond the last path point
+        assert h > 1.2 and abs(k) < 1e-6 and abs(l) < 1e-6
+        eq_(len(you.scandata()['ct']), 21)
+        assert abs(you.scandata()['h'][-1] - 1.2) < 1e-6
+        assert profile.duration > profile.path_times[-1]
+    finally:
+        you.uncon('phi')
+
+def test_dryrun():
+    _orient()
+    you.con('mu', 0, 'gam', 0, 'phi', 0)
+    try:
+        pos(you.hkl, [1, 0, 0])
+        report = you.dryrun(you.h, 1, 2.5, .1, you.ct, .5)
+        # Nothing moved
+        h, k, l = you.hkl.getPosition()[:3]
+        assert abs(h - 1) < 1e-6 and abs(k) < 1e-6 and abs(l) < 1e-6
+        # Beyond h = 2 theta would exceed 90 degrees
+        eq_(sorted(report.unreachable), range(10, 16))
+        eq_(report.branch_switches, [])
+        eq_(report.exposures.sum(), 8)
+        assert report.duration > 8
+
+        report = you.dryrun(you.mesh, you.h, 1, 1.2, .1, you.k, 0, .2, .1, phi, 30)
+        eq_(len(report.positions), 9)
+        assert all(report.positions[:, 5] == 30)
+    finally:
+        you.uncon('phi')
+
+def test_orderhkl():
+    _orient()
+    you.con('mu', 0, 'gam', 0, 'phi', 0)
+    try:
+        pos(you.hkl, [1, 0, 0])
+        ordered = you.orderhkl([[1, .4, 0], [1, .1, 0], [3, 0, 0], [1, .3, 0], [1, .2, 0]])
+        # Stepping out from the current position, without the unreachable one
+        eq_(ordered, [[1, .1, 0], [1, .2, 0], [1, .3, 0], [1, .4, 0]])
+    finally:
+        you.uncon('phi')
+
+def test_resumescan():
+    _orient()
+    you.con('mu', 0, 'gam', 0, 'phi', 0)
+    tmpdir = tempfile.mkdtemp()
+    you.scancheckpoint(os.path.join(tmpdir, 'scan.checkpoint'))
+    try:
+        pos(you.hkl, [1, 0, 0])
+        # h = 2.4 is beyond reach at 1 Angstrom
+        assert_raises(DiffcalcException, you.scan, you.hkl, [1, 0, 0], [2.4, 0, 0],
+                      [.7, 0, 0], you.ct, .1)
+        eq_(len(you.scandata()['ct']), 2)
+        you.con('phi', 10)
+        assert_raises(DiffcalcException, you.resumescan)
+        you.con('phi', 0)
+        pos(you.wl, .5)
+        you.resumescan()
+        assert max(abs(you.scandata()['h'] - [1, 1.7, 2.4])) < 1e-6
+        assert_raises(DiffcalcException, you.resumescan)
+    finally:
+        you.scancheckpoint()
+        shutil.rmtree(tmpdir)
+        pos(you.wl, 1)
+        you.uncon('phi')
+
+def test_searchref():
+    _orient()
+    you.con('mu', 0, 'gam', 0, 'phi', 0)
+    # A narrow peak, as the default one is wider than the search volume
+    equation = you.ct.equation
+    you.ct.equation = Gaussian(.0001)
+    you.ct.setChiMissmount(1)
+    try:
+        you.searchref([1, 0, 0], 1, 'found')
+        h, k, l = you.ct.getHkl()
+        assert abs(h - 1) < 1e-3 and abs(k) < 1e-3 and abs(l) < 1e-3
+        _, _, _, tag, _ = you.ubcalc.get_reflection(3)
+        eq_(tag, 'found')
+    finally:
+        you.ct.equation = equation
+        you.ct.setChiMissmount(0)
+        you.uncon('phi')
+
+def test_domainhkl():
+    _orient()
+    you.con(mu)
+    you.con(gam)
+    you.con('a_eq_b')
+    pos(you.mu_con, 0)
+    pos(you.gam_con, 0)
+    you.adddomain('main', 0)
+    you.adddomain('twin', 90, [0, 1, 0])
+    you.domainhkl([1, 1, 0])
+
 @raises(TypeError)
 def test_usage_error_signature():
     you.c2th('wrong arg', 'wrong arg')
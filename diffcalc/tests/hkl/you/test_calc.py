@@ -17,6 +17,10 @@
 ###
 
 from math import pi, cos, sin
+try:
+    from collections import OrderedDict
+except ImportError:
+    from simplejson import OrderedDict
 from nose.tools import raises
 from mock import Mock
 from diffcalc import settings
@@ -227,6 +231,55 @@ class TestCubicVertical_aeqb(_TestCubicVertical):
         _TestCubicVertical.setup_method(self)
         self.constraints._constrained = {'a_eq_b': None, 'mu': 0, NUNAME: 0}
 
+    def test_hkl_list_to_ranked_angles(self):
+        self.zrot, self.yrot = 0, 0
+        self._configure_ub()
+        self.mock_hardware.position = [0, 60, 0, 30, 0, 90]
+        hkl_list = [(1, 0, 0), (0, 1, 0), (0, 0, 1), (3, 0, 0)]
+        ranked, failed = self.calc.hkl_list_to_ranked_angles(hkl_list, 1)
+        assert [hkl for _, hkl, _, _ in ranked] == [(0, 1, 0), (1, 0, 0)]
+        assert_array_almost_equal([cost for cost, _, _, _ in ranked], [0, 90])
+        assert set(hkl for hkl, _ in failed) == set([(0, 0, 1), (3, 0, 0)])
+        # With a slow phi axis the chi move is cheaper
+        self.mock_hardware.position = [0, 60, 0, 30, 5, 10]
+        ranked, _ = self.calc.hkl_list_to_ranked_angles(hkl_list, 1,
+                                                        (1, 1, 1, 1, 1, 0.01))
+        assert ranked[0][1] == (1, 0, 0)
+
+    def test_hkl_list_to_ranked_angles_verifies_solutions(self, monkeypatch):
+        self.zrot, self.yrot = 0, 0
+        self._configure_ub()
+        self.mock_hardware.position = [0, 60, 0, 30, 0, 90]
+        angles_to_hkl = self.calc.anglesToHkl
+
+        def wrong_k(pos, wavelength):
+            (h, k, l), virtual_angles = angles_to_hkl(pos, wavelength)
+            return (h, k + (abs(k) > .5), l), virtual_angles
+        monkeypatch.setattr(self.calc, 'anglesToHkl', wrong_k)
+        ranked, failed = self.calc.hkl_list_to_ranked_angles([(1, 0, 0), (0, 1, 0)], 1)
+        assert [hkl for _, hkl, _, _ in ranked] == [(1, 0, 0)]
+        assert [hkl for hkl, _ in failed] == [(0, 1, 0)]
+        assert 'Converting these angles back' in failed[0][1]
+
+    def test_hkl_to_domain_angles(self):
+        self.zrot, self.yrot = 0, 0
+        self._configure_ub()
+        UB = self.mock_ubcalc.UB
+        domains = OrderedDict([('a', UB),
+                               ('b', z_rotation(90 * TORAD) * UB),
+                               ('c', y_rotation(90 * TORAD) * UB)])
+        self.mock_ubcalc.get_domain_UBs.return_value = domains
+        solutions, failed = self.calc.hkl_to_domain_angles(1, 0, 0, 1)
+        assert solutions.keys() == ['a', 'b']
+        assert [name for name, _ in failed] == ['c']
+        assert self.mock_ubcalc.UB is UB
+        for name, (pos, _) in solutions.items():
+            h, k, l = (UB.I * domains[name] * matrix('1; 0; 0')).T.tolist()[0]
+            pos_expected, _ = self.calc.hklToAngles(h, k, l, 1)
+            assert_array_almost_equal(pos.totuple(), pos_expected.totuple())
+            pos_given_ub, _ = self.calc.hklToAngles(1, 0, 0, 1, ubmatrix=domains[name])
+            assert_array_almost_equal(pos.totuple(), pos_given_ub.totuple())
+
 
 class TestCubicVertical_psi_90(_TestCubicVertical):
     '''mode psi=90 should be the same as mode a_eq_b'''
@@ -17,7 +17,7 @@
 ###
 
 
-from mock import Mock, call
+from mock import Mock, call, patch
 from diffcalc import settings
 
 import diffcalc
@@ -42,6 +42,15 @@ def setup_module():
     hkl.hklcalc.constraints.report_constraints_lines.return_value = ['report1', 'report2']
 
 
+def test_con_and_uncon_reload_external_changes():
+    ubcalc = diffcalc.ub.ub.ubcalc
+    calls = []
+    with patch.object(ubcalc, 'check_external_changes', lambda: calls.append('check')):
+        with patch.object(ubcalc, 'save', lambda: calls.append('save')):
+            hkl.con('cona')
+            hkl.uncon('cona')
+    assert calls == ['check', 'save', 'check', 'save']
+
 def test_con_with_1_constraint():
     hkl.con('cona')
     hkl.hklcalc.constraints.constrain.assert_called_with('cona')
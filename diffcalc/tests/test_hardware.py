@@ -129,6 +129,21 @@ class TestHardwareCommands():
         self.commands.setmax()
         print "*******"
 
+    def test_set_speed(self):
+        self.commands.setspeed('a', 5)
+        self.commands.setspeed('b', None, 3)
+        self.commands.setspeed()
+        eq_(self.hardware.get_velocities(), [5., 1., 1.])
+        eq_(self.hardware.get_accelerations(), [2., 3., 2.])
+        assert_raises(DiffcalcException, self.commands.setspeed, 'a', -1)
+        assert_raises(DiffcalcException, self.commands.setspeed, 'not an axis', 1)
+
+    def test_move_time(self):
+        # Triangular and trapezoidal speed profiles
+        eq_(self.commands.move_time(1, 2, 1), 2)
+        eq_(self.commands.move_time(-9, 2, 1), 6.5)
+        eq_(list(self.commands.move_time([0, 4], 2, 1)), [0, 4])
+
 
 class TestDummyHardwareAdapter(object):
 
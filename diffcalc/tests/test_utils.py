@@ -22,7 +22,10 @@ from nose.tools import eq_  # @UnresolvedImport
 from diffcalc.hkl.vlieg.geometry import VliegPosition
 from diffcalc.util import MockRawInput, \
     getInputWithDefault, differ, nearlyEqual, degreesEquivilant,\
-    CoordinateConverter
+    CoordinateConverter, FixedQSolver, DiffcalcException, solve_h_fixed_q, \
+    solve_k_fixed_q, solve_l_fixed_q
+from diffcalc.ub.crystal import CrystalUnderTest
+from diffcalc.tests.tools import assert_array_almost_equal
 import diffcalc.util  # @UnusedImport
 import pytest
 
@@ -219,3 +222,42 @@ class TestCoordinateConverter(object):
             self.conv.transform(failvec)
         with pytest.raises(TypeError):
             self.conv.transform(failmarix)
+
+
+class TestFixedQSolver(object):
+
+    def setup_method(self):
+        self.B = CrystalUnderTest('xtal', 3.1, 4.2, 5.3, 80, 95, 100).B
+        self.qval = 2.5
+
+    def _sorted(self, hkl_list):
+        return sorted(tuple(round(e, 8) for e in hkl) for hkl in hkl_list)
+
+    def test_matches_closed_form_solutions(self):
+        for coeff in [(1, 2, 3, 1.5), (0.5, -1, 2, 0.3), (-1, 2, -3, 0.1)]:
+            for index, func in (('h', solve_h_fixed_q), ('k', solve_k_fixed_q),
+                                ('l', solve_l_fixed_q)):
+                solver = FixedQSolver(self.B, coeff, index)
+                eq_(self._sorted(solver.solutions(0.1, self.qval)),
+                    self._sorted(func(0.1, self.qval, self.B, coeff)))
+
+    def test_solve_arrays(self):
+        coeff = (1, 1, -1, 0.2)
+        solver = FixedQSolver(self.B, coeff, 'k')
+        k = [-0.4, 0.1, 0.3, 10]
+        hkl1, hkl2, valid = solver.solve(k, self.qval)
+        eq_(valid.tolist(), [True, True, True, False])
+        for idx in range(3):
+            eq_(self._sorted([hkl1[idx], hkl2[idx]]),
+                self._sorted(solver.solutions(k[idx], self.qval)))
+        for hkl in (hkl1[valid], hkl2[valid]):
+            assert_array_almost_equal(hkl[:, 1], k[:3])
+            assert_array_almost_equal(hkl.dot(coeff[:3]), [coeff[3]] * 3)
+            q = hkl.dot(self.B.T.A)
+            assert_array_almost_equal((q ** 2).sum(axis=1), [self.qval] * 3)
+        with pytest.raises(DiffcalcException):
+            solver.solutions(10, self.qval)
+
+    def test_index_fixed_by_constraint(self):
+        with pytest.raises(DiffcalcException):
+            FixedQSolver(self.B, (1, 0, 0, 0.5), 'h')
@@ -17,6 +17,7 @@
 ###
 
 import unittest
+from math import pi
 
 try:
     from numpy import matrix
@@ -59,4 +60,29 @@ class TestCrystalUnderTest(object):
 
     def test__str__(self):
         cut = CrystalUnderTest("HCl", 1, 2, 3, 4, 5, 6)
-        print cut.__str__()
\ No newline at end of file
+        print cut.__str__()
+
+    def test_batched_plane_distances_match_scalar(self):
+        cut = CrystalUnderTest('tc', 'Triclinic', 3.1, 4.2, 5.3, 85, 95, 100)
+        hkls = [[1, 0, 0], [0, 1, 1], [1, -2, 3], [2, 2, 2]]
+        distances = cut.get_hkl_plane_distances(hkls)
+        q_lengths = cut.get_q_lengths(hkls)
+        for hkl, d, q in zip(hkls, distances, q_lengths):
+            assert abs(d - cut.get_hkl_plane_distance(hkl)) < 1e-10
+            assert abs(q * d - 2 * pi) < 1e-10
+
+    def test_batched_plane_angles_match_scalar(self):
+        cut = CrystalUnderTest('tc', 'Triclinic', 3.1, 4.2, 5.3, 85, 95, 100)
+        hkls1 = [[1, 0, 0], [0, 1, 1], [1, -2, 3]]
+        hkls2 = [[0, 0, 1], [1, 1, 0]]
+        angles = cut.get_hkl_plane_angles(hkls1, hkls2)
+        assert angles.shape == (3, 2)
+        for i, hkl1 in enumerate(hkls1):
+            for j, hkl2 in enumerate(hkls2):
+                assert abs(angles[i, j] - cut.get_hkl_plane_angle(hkl1, hkl2)) < 1e-10
+
+    def test_metric_tensors(self):
+        cut = CrystalUnderTest('tc', 'Cubic', 2.)
+        mneq_(cut.metric_tensor, matrix([[4, 0, 0], [0, 4, 0], [0, 0, 4]]), 7)
+        mneq_(cut.reciprocal_metric_tensor,
+              matrix([[.25, 0, 0], [0, .25, 0], [0, 0, .25]]), 7)
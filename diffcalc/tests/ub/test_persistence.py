@@ -21,15 +21,20 @@ import shutil
 import unittest
 import tempfile
 import time
+import datetime
 from nose.tools import eq_  # @UnresolvedImport
+import json
 
 try:
     from gda.configuration.properties import LocalProperties
 except ImportError:
     print "Could not import LocalProperties to configure database locations."
 
-from diffcalc.ub.persistence import UbCalculationNonPersister, UBCalculationJSONPersister
-from diffcalc.ub.calcstate import UBCalcStateEncoder
+from diffcalc.ub.persistence import UbCalculationNonPersister, UBCalculationJSONPersister, \
+    read_header, fcntl
+from diffcalc.ub.calcstate import UBCalcStateEncoder, literal, time_repr_to_iso, \
+    iso_to_datetime
+from diffcalc.util import DiffcalcException
 
 
 def prepareEmptyGdaVarFolder():
@@ -102,3 +107,276 @@ class TestUBCalculationJSONPersister(object):
         
     
 
+class TestUBCalculationJSONPersisterWriteBehind(object):
+
+    def setup_method(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.persister = UBCalculationJSONPersister(self.tmpdir, UBCalcStateEncoder,
+                                                    write_interval=600)
+
+    def test_save_is_held_back_until_flush(self):
+        self.persister.save({'a': 1}, 'first')
+        assert not os.path.exists(self.persister.filepath('first'))
+        self.persister.flush()
+        assert os.path.exists(self.persister.filepath('first'))
+
+    def test_saves_coalesce(self):
+        for i in range(100):
+            self.persister.save({'a': i}, 'first')
+        eq_(self.persister._pending.keys(), ['first'])
+        eq_(self.persister.load('first'), {'a': 99})
+        eq_(self.persister._pending, {})
+
+    def test_pending_save_is_a_snapshot(self):
+        state = {'a': [1, 2]}
+        self.persister.save(state, 'first')
+        state['a'].append(3)
+        state['b'] = 4
+        eq_(self.persister.load('first'), {'a': [1, 2]})
+
+    def test_list_sees_pending(self):
+        self.persister.save({'a': 1}, 'first')
+        eq_(self.persister.list(), ['first'])
+
+    def test_remove_drops_pending(self):
+        self.persister.save({'a': 1}, 'first')
+        self.persister.flush()
+        self.persister.save({'a': 2}, 'first')
+        self.persister.remove('first')
+        self.persister.flush()
+        eq_(self.persister.list(), [])
+
+    def test_background_write(self):
+        self.persister.write_interval = .01
+        self.persister.save({'a': 1}, 'first')
+        for _ in range(200):
+            if os.path.exists(self.persister.filepath('first')):
+                break
+            time.sleep(.01)
+        with open(self.persister.filepath('first')) as f:
+            data = json.load(f)
+        eq_(data.pop('header')['name'], 'first')
+        eq_(data, {'a': 1})
+
+    def test_unserialisable_state_not_retried(self):
+        self.persister.save({'a': object()}, 'first')
+        try:
+            self.persister.flush()
+        except TypeError:
+            pass
+        else:
+            assert False, 'Expected TypeError'
+        eq_(self.persister._pending, {})
+
+    def test_no_temporary_files_left(self):
+        self.persister.save({'a': 1}, 'first')
+        self.persister.save({'a': 2}, 'second')
+        dump = self.persister._atomic_write
+
+        def failing_write(path, write, mode='w'):
+            if path == self.persister.filepath('second'):
+                def write(f):
+                    f.write('partial')
+                    raise IOError('disk full')
+            dump(path, write, mode)
+        self.persister._atomic_write = failing_write
+        try:
+            self.persister.flush()
+        except IOError:
+            pass
+        else:
+            assert False, 'Expected IOError'
+        eq_([f for f in os.listdir(self.tmpdir) if f.endswith('.tmp')], [])
+        # The failed save is kept for a retry
+        eq_(self.persister._pending.keys(), ['second'])
+        del self.persister._atomic_write
+        self.persister.flush()
+        eq_(self.persister.load('second'), {'a': 2})
+
+
+class TestUBCalculationIndex(object):
+
+    def setup_method(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.persister = UBCalculationJSONPersister(self.tmpdir, UBCalcStateEncoder)
+        self.state = {'crystal': repr(['xtal', 'Cubic', 1., 1., 1., 90., 90., 90.]),
+                      'reflist': {'1': {}, '2': {}}}
+
+    def test_entries(self):
+        self.persister.save(self.state, 'first')
+        entry, = self.persister.list_entries()
+        eq_(entry['name'], 'first')
+        eq_(entry['lattice'], 'xtal')
+        eq_(entry['nref'], 2)
+        eq_(entry['size'], os.path.getsize(self.persister.filepath('first')))
+        assert '2 refl' in self.persister.list_metadata()[0]
+
+    def test_index_file_shared(self):
+        self.persister.save(self.state, 'first')
+        other = UBCalculationJSONPersister(self.tmpdir, UBCalcStateEncoder)
+        other.index.refresh()
+        eq_(other.index._entries.keys(), ['first'])
+        eq_(other.list(), ['first'])
+
+    def test_saves_appended_to_log(self):
+        self.persister.save(self.state, 'first')
+        other = UBCalculationJSONPersister(self.tmpdir, UBCalcStateEncoder)
+        eq_(other.list(), ['first'])
+        snapshot = os.stat(self.persister.index.path)
+        other.index.rebuild = None  # must not be needed
+        for name in ('second', 'third'):
+            self.persister.save(self.state, name)
+        self.persister.remove('first')
+        eq_(other.list(), ['third', 'second'])
+        eq_(os.stat(self.persister.index.path).st_ino, snapshot.st_ino)
+        with open(self.persister.index.logpath) as f:
+            eq_(len(f.readlines()), 5)
+
+    def test_log_compacted(self):
+        self.persister.index.COMPACT_AFTER = 4
+        for i in range(10):
+            self.persister.save(self.state, 'calc%d' % i)
+        with open(self.persister.index.logpath) as f:
+            assert len(f.readlines()) <= 1 + 10 // 2
+        assert self.persister.index._generation > 1
+        other = UBCalculationJSONPersister(self.tmpdir, UBCalcStateEncoder)
+        other.index.rebuild = None
+        eq_(sorted(other.list()), ['calc%d' % i for i in range(10)])
+        eq_(self.persister.list()[0], 'calc9')
+        eq_([f for f in os.listdir(self.tmpdir) if f.endswith('.tmp')], [])
+
+    def test_rebuild_holds_lock(self):
+        self.persister.save(self.state, 'first')
+        shutil.copy(self.persister.filepath('first'), self.persister.filepath('copy'))
+        locked = []
+        rebuild = self.persister.index.rebuild
+
+        def check_lock():
+            with open(os.path.join(self.tmpdir, self.persister.LOCKFILE)) as f:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    locked.append(True)
+                else:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                    locked.append(False)
+            rebuild()
+        self.persister.index.rebuild = check_lock
+        eq_(sorted(self.persister.list()), ['copy', 'first'])
+        eq_(locked, [True])
+
+    def test_external_changes(self):
+        self.persister.save(self.state, 'first')
+        eq_(self.persister.list(), ['first'])
+        shutil.copy(self.persister.filepath('first'), self.persister.filepath('copy'))
+        eq_(sorted(self.persister.list()), ['copy', 'first'])
+        eq_(self.persister.list_entries()[0]['lattice'], 'xtal')
+        os.remove(self.persister.filepath('first'))
+        eq_(self.persister.list(), ['copy'])
+
+    def test_corrupt_index_rebuilt(self):
+        self.persister.save(self.state, 'first')
+        with open(self.persister.index.path, 'w') as f:
+            f.write('{not json')
+        other = UBCalculationJSONPersister(self.tmpdir, UBCalcStateEncoder)
+        eq_(other.list(), ['first'])
+        eq_(other.list_entries()[0]['nref'], 2)
+
+    def test_header_only_listing(self):
+        self.persister.save(self.state, 'first')
+        header = read_header(self.persister.filepath('first'))
+        eq_((header['name'], header['lattice'], header['nref']), ('first', 'xtal', 2))
+        eq_(self.persister.load('first'), self.state)
+        # Spoil everything after the header: listing must not need it
+        path = self.persister.filepath('first')
+        with open(path) as f:
+            first_line = f.readline()
+        with open(path, 'w') as f:
+            f.write(first_line + '    "reflist": {not json\n')
+        other = UBCalculationJSONPersister(self.tmpdir, UBCalcStateEncoder)
+        os.remove(other.index.path)
+        eq_(other.list_entries()[0]['nref'], 2)
+        eq_(other.load_header('first')['lattice'], 'xtal')
+
+    def test_file_without_header(self):
+        with open(self.persister.filepath('old'), 'w') as f:
+            json.dump(self.state, f)
+        eq_(read_header(self.persister.filepath('old')), None)
+        eq_(self.persister.load_header('old')['nref'], 2)
+        eq_(self.persister.list_entries()[0]['lattice'], 'xtal')
+
+
+class TestUBCalculationJSONPersisterSharedDirectory(object):
+
+    def setup_method(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.ours = UBCalculationJSONPersister(self.tmpdir, UBCalcStateEncoder)
+        self.theirs = UBCalculationJSONPersister(self.tmpdir, UBCalcStateEncoder)
+
+    def test_generation_and_change_detection(self):
+        self.ours.save({'a': 1}, 'shared')
+        eq_(read_header(self.ours.filepath('shared'))['generation'], 1)
+        eq_(self.ours.changed('shared'), False)
+        eq_(self.theirs.changed('shared'), False)  # never loaded there
+
+        self.theirs.load('shared')
+        self.theirs.save({'a': 2}, 'shared')
+        eq_(read_header(self.ours.filepath('shared'))['generation'], 2)
+        eq_(self.ours.changed('shared'), True)
+        eq_(self.theirs.changed('shared'), False)
+
+        eq_(self.ours.load('shared'), {'a': 2})
+        eq_(self.ours.changed('shared'), False)
+
+        self.theirs.remove('shared')
+        eq_(self.ours.changed('shared'), True)
+        eq_(self.ours.changed('shared'), False)  # reported once
+
+    def test_conflicting_save_fails(self):
+        self.ours.save({'a': 1}, 'shared')
+        self.theirs.load('shared')
+        self.theirs.save({'a': 2}, 'shared')
+        self.ours.write_interval = 600
+        self.ours.save({'a': 3}, 'shared')
+        try:
+            self.ours.flush()
+        except DiffcalcException:
+            pass
+        else:
+            assert False, 'Expected DiffcalcException'
+        eq_(self.ours._pending, {})  # not retried
+        eq_(self.theirs.load('shared'), {'a': 2})
+
+    def test_discard_pending(self):
+        self.ours.write_interval = 600
+        self.ours.save({'a': 1}, 'shared')
+        eq_(self.ours.discard_pending('shared'), True)
+        eq_(self.ours.discard_pending('shared'), False)
+        eq_(self.ours.list(), [])
+
+    def test_lock_file(self):
+        self.ours.save({'a': 1}, 'shared')
+        if fcntl is not None:
+            assert os.path.exists(os.path.join(self.tmpdir, self.ours.LOCKFILE))
+        eq_(self.ours.list(), ['shared'])
+
+
+def test_literal():
+    eq_(literal('[1.0, -2, inf, -inf]'), [1.0, -2, float('inf'), -float('inf')])
+    value = literal('nan')
+    assert value != value
+    eq_(literal("['latt', None, (1, 2)]"), ['latt', None, (1, 2)])
+    for text in ("__import__('os')", "[1, 2] + [3]", "open"):
+        try:
+            literal(text)
+        except ValueError:
+            pass
+        else:
+            assert False, 'Expected ValueError for %s' % text
+
+
+def test_time_repr_round_trip():
+    for dt in (datetime.datetime(2013, 8, 5, 15, 47, 7, 962432),
+               datetime.datetime(2013, 8, 5, 15, 47, 7)):
+        eq_(iso_to_datetime(time_repr_to_iso(repr(dt))), dt)
+    eq_(time_repr_to_iso('None'), None)
@@ -17,10 +17,12 @@
 ###
 
 from datetime import datetime
-from diffcalc.ub.reflections import ReflectionList
+from diffcalc.ub.reflections import ReflectionList, read_reflections
 from diffcalc.hkl.you.geometry  import YouPosition as Pos, SixCircle
 from diffcalc.util import DiffcalcException
 import pytest
+import tempfile
+import os.path
 
 
 class TestReflectionList(object):
@@ -40,6 +42,15 @@ class TestReflectionList(object):
         pos = Pos(0.11, 0.22, 0.33, 0.44, 0.55, 0.66, 'DEG')
         self.reflist.add_reflection(11.1, 12.2, 13.3, pos, 1100, "ref2", self.time)
 
+    def test_add_reflections(self):
+        self.reflist.add_reflections([(0, 0, 1, (1, 2, 3, 4, 5, 6), 10, 'a'),
+                                      (0, 0, 2, (2, 3, 4, 5, 6, 7), 10, None)],
+                                     self.time)
+        assert len(self.reflist) == 4
+        assert (self.reflist.getReflection('a')
+                == ([0, 0, 1], Pos(1, 2, 3, 4, 5, 6, 'DEG'), 10, 'a', self.time))
+        assert self.reflist.getReflection(4)[0] == [0, 0, 2]
+
     def testGetReflection(self):
         answered = self.reflist.getReflection(1)
         pos = Pos(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 'DEG')
@@ -107,4 +118,57 @@ class TestReflectionList(object):
             'tag': "ref2",
             'time': repr(self.time)
         }
-        return ref_0, ref_1
\ No newline at end of file
+        return ref_0, ref_1
+
+
+class TestReadReflections(object):
+
+    def setup_method(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def _write(self, name, text):
+        filename = os.path.join(self.tmpdir, name)
+        with open(filename, 'w') as f:
+            f.write(text)
+        return filename
+
+    def test_read_csv(self):
+        filename = self._write('refs.csv',
+            "h,k,l,mu,delta,nu,eta,chi,phi,energy,tag\n"
+            "0,0,1,0,60,0,30,90,0,12.39842,001\n"
+            "\n"
+            "# comment\n"
+            "1,0,0,0,60,0,30,0,0,12.39842\n"
+            "1,0,a,0,60,0,30,0,0,12.39842\n"
+            "1,0,0,0,60,0,30,0\n")
+        rows, rejected = read_reflections(filename, 6)
+        assert rows == [(2, 0, 0, 1, (0, 60, 0, 30, 90, 0), 12.39842, '001'),
+                        (5, 1, 0, 0, (0, 60, 0, 30, 0, 0), 12.39842, None)]
+        assert [n for n, _ in rejected] == [6, 7]
+
+    def test_malformed_first_row_rejected(self):
+        filename = self._write('refs.csv',
+            "# h,k,l,mu,delta,nu,eta,chi,phi,energy\n"
+            "0,0,x,0,60,0,30,90,0,12.39842\n"
+            "1,0,0,0,60,0,30,0,0,12.39842\n")
+        rows, rejected = read_reflections(filename, 6)
+        assert [row[0] for row in rows] == [3]
+        assert rejected == [(2, 'non-numeric value')]
+
+    def test_read_whitespace(self):
+        filename = self._write('refs.dat',
+            "0 0 1  0 60 0 30 90 0  12.39842  001\n"
+            "1 0 0  0 60 0 30 0 0  12.39842\n")
+        rows, rejected = read_reflections(filename, 6)
+        assert [row[0] for row in rows] == [1, 2]
+        assert rows[0][-1] == '001'
+        assert rejected == []
+
+    def test_read_npy(self):
+        import numpy as np
+        filename = os.path.join(self.tmpdir, 'refs.npy')
+        np.save(filename, np.array([[0, 0, 1, 0, 60, 0, 30, 90, 0, 12.39842]]))
+        rows, rejected = read_reflections(filename, 6)
+        assert rows == [(1, 0, 0, 1, (0, 60, 0, 30, 90, 0), 12.39842, None)]
+        with pytest.raises(DiffcalcException):
+            read_reflections(filename, 5)
@@ -0,0 +1,57 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+import pytest
+
+from diffcalc.ub.symmetry import get_symmetry_operations, \
+    get_equivalent_reflections, get_laue_class
+from diffcalc.util import DiffcalcException
+
+
+class TestSymmetry(object):
+
+    def test_laue_class_orders(self):
+        orders = {'-1': 2, '2/m': 4, 'mmm': 8, '4/m': 8, '4/mmm': 16,
+                  '-3': 6, '-3m': 12, '6/m': 12, '6/mmm': 24, 'm-3': 24,
+                  'm-3m': 48}
+        for laue, order in orders.items():
+            assert len(get_symmetry_operations(laue)) == order
+
+    def test_point_group_maps_to_laue_class(self):
+        assert get_laue_class('432') == 'm-3m'
+        assert get_laue_class('mm2') == 'mmm'
+        assert get_laue_class('-6m2') == '6/mmm'
+
+    def test_unknown_group(self):
+        with pytest.raises(DiffcalcException):
+            get_laue_class('p1')
+
+    def test_cubic_equivalents(self):
+        eqs = get_equivalent_reflections((1, 1, 0), 'm-3m')
+        assert eqs[0] == (1, 1, 0)
+        assert len(eqs) == 12
+        assert (0, -1, 1) in eqs
+
+    def test_hexagonal_equivalents(self):
+        eqs = get_equivalent_reflections((1, 0, 0), '6/mmm')
+        assert set(eqs) == set([(1, 0, 0), (0, 1, 0), (-1, 1, 0),
+                                (-1, 0, 0), (0, -1, 0), (1, -1, 0)])
+
+    def test_monoclinic_equivalents(self):
+        eqs = get_equivalent_reflections((1, 2, 3), '2/m')
+        assert set(eqs) == set([(1, 2, 3), (-1, 2, -3), (-1, -2, -3), (1, -2, 3)])
@@ -188,6 +188,20 @@ class _UBCommandsBase():
         result = reflist.get_reflection_in_external_angles(4)
         eq_(result[:-1], ([4.1, 4.2, 4.3], pos4, 4.10, 'tag2'))
 
+    def testImportref(self):
+        self.ub.newub('testing_importref')
+        self.ub.setlat('cube', 1, 1, 1, 90, 90, 90)
+        filename = os.path.join(tempfile.mkdtemp(), 'refs.csv')
+        with open(filename, 'w') as f:
+            f.write("0 0 1 0 60 0 30 90 0 12.39842 001\n"
+                    "0 0 1 0 65 0 30 90 0 12.39842 bad\n"
+                    "0 0 1 0 60 0\n"
+                    "1 0 0 0 60 0 30 0 90 12.39842\n")
+        self.ub.importref(filename)
+        eq_(self.ub.ubcalc.get_number_reflections(), 2)
+        self.ub.importref(filename, None)
+        eq_(self.ub.ubcalc.get_number_reflections(), 5)
+
     def testAddrefInteractively(self):
         prepareRawInput([])
         # start new ubcalc
@@ -619,6 +633,51 @@ class _UBCommandsBase():
             mneq_(self.ub.ubcalc.U, matrix(s.umatrix),
                   3, note="wrong U matrix after fitting UB")
 
+    def testFitmiscut(self):
+        self.ub.newub('testfitmiscut')
+        self.ub.setlat('cube', 1, 1, 1, 90, 90, 90)
+        self.ub.setmiscut(0)
+        self.ub.addref([0, 0, 1], [0, 60, 0, 30, 90, 0], 12.39842, '001')
+        self.ub.addref([0, 0, 1.5], [0, 97.18076, 0, 48.59038, 90, 0], 12.39842, '0015')
+        self.ub.addref([0, 0, 1], [0, 60, 0, 30, 90, 90], 12.39842, '001b')
+        # Miscut about an axis perpendicular to the surface normal
+        mc_axis = self.conv.transform(matrix('1; 0; 0'), True).T.tolist()[0]
+        self.ub.setmiscut(2, mc_axis)
+        UB = self.ub.ubcalc.UB
+        hkls = [[0, 0, 1], [0, 0, 1.5], [0, 0, 1]]
+        positions = [self.ub.ubcalc.get_reflection(i)[1] for i in (1, 2, 3)]
+        angle, _, _, _, axis = self.ub.ubcalc.fit_miscut(hkls, positions)
+        assert abs(angle - 2) < 1e-4
+        assert_iterable_almost_equal(axis, [-v for v in mc_axis])
+        prepareRawInput(['n'])
+        self.ub.fitmiscut()
+        mneq_(self.ub.ubcalc.UB, UB, 6, note="UB changed when not applying miscut")
+        prepareRawInput(['y'])
+        self.ub.fitmiscut('001', '001b')
+        mneq_(self.ub.ubcalc.U, matrix('1 0 0; 0 1 0; 0 0 1'), 4,
+              note="wrong U matrix after applying fitted miscut")
+
+    def testAdddomain(self):
+        self.ub.newub('testadddomain')
+        self.ub.setlat('cube', 1, 1, 1, 90, 90, 90)
+        self.ub.setmiscut(0)
+        with pytest.raises(TypeError):
+            self.ub.adddomain('bad', 'a')
+        self.ub.adddomain('rot', 90)
+        self.ub.adddomain('tilt', 10, [1, 0, 0])
+        self.ub.adddomain('mat', [[1, 0, 0], [0, 1, 0], [0, 0, 1]])
+        prepareRawInput(['', '', ''])
+        self.ub.adddomain('ident')
+        eq_(self.ub.ubcalc.get_domain_names(), ['rot', 'tilt', 'mat', 'ident'])
+        UBs = self.ub.ubcalc.get_domain_UBs()
+        mneq_(UBs['tilt'], self.conv.transform(xyz_rotation([1, 0, 0], 10 * TORAD)) * self.ub.ubcalc.UB)
+        mneq_(UBs['mat'], self.ub.ubcalc.UB)
+        self.ub.ub()
+        self.ub.deldomain('rot')
+        with pytest.raises(DiffcalcException):
+            self.ub.deldomain('rot')
+        eq_(self.ub.ubcalc.get_domain_names(), ['tilt', 'mat', 'ident'])
+
     def testC2th(self):
         self.ub.newub('testc2th')
         self.ub.setlat('cube', 1, 1, 1, 90, 90, 90)
@@ -799,3 +858,34 @@ class TestUbCommandsJsonPersistence(TestUBCommandsYou):
         self.ub.loadub('test1')
         arrayeq_(self.ub.ubcalc.n_phi.T.tolist()[0], [0, 1, 0])
 
+
+
+class TestUbCommandsWriteBehindPersistence(TestUbCommandsJsonPersistence):
+
+    def _createPersister(self):
+        TestUbCommandsJsonPersistence._createPersister(self)
+        # Long interval so that only explicit flushes reach the disk
+        self.persister = UBCalculationJSONPersister(self.tmpdir, UBCalcStateEncoder,
+                                                    write_interval=600)
+        return self.persister
+
+    def testSaveub(self):
+        self.ub.newub('test1')
+        path = self.persister.filepath('test1')
+        with open(path) as f:
+            saved = f.read()
+        self.ub.setnphi([0, 1, 0])
+        with open(path) as f:
+            eq_(f.read(), saved)
+        self.ub.saveub()
+        with open(path) as f:
+            assert f.read() != saved
+
+    def testListubFilterAndPage(self):
+        for name in ('alpha', 'beta', 'alpha2'):
+            self.ub.newub(name)
+        self.ub.listub('alpha*')
+        self.ub.listub('alpha*', 1)
+        self.ub.listub(1)
+        with pytest.raises(DiffcalcException):
+            self.ub.listub(2)
@@ -26,16 +26,22 @@ crystal miscut information.
 from diffcalc.ub.calcstate import UBCalcState
 from diffcalc.ub.crystal import CrystalUnderTest
 from diffcalc.ub.reflections import ReflectionList
-from diffcalc.ub.persistence import UBCalculationJSONPersister, UBCalculationPersister
+from diffcalc.ub.persistence import UBCalculationJSONPersister, UBCalculationPersister, \
+    UBCalculationSQLitePersister, UBCalculationJournalPersister
 from diffcalc.util import DiffcalcException, cross3, dot3, bold, xyz_rotation,\
-    bound, angle_between_vectors, norm3, CoordinateConverter, allnum, TODEG
+    bound, angle_between_vectors, norm3, CoordinateConverter, allnum, TODEG, TORAD, \
+    TWELVEISH
 from math import acos, cos, sin, pi, atan2
 from diffcalc.ub.reference import YouReference
 from diffcalc.ub.orientations import OrientationList
 from diffcalc import settings
 from itertools import product
-from diffcalc.ub.fitting import fit_crystal, fit_u_matrix
-from diffcalc.hkl.you.geometry import create_you_matrices
+try:
+    from collections import OrderedDict
+except ImportError:
+    from simplejson import OrderedDict
+from diffcalc.ub.fitting import fit_crystal, fit_u_matrix, fit_miscut
+from diffcalc.hkl.you.geometry import create_you_matrices, YouPosition
 
 try:
     from numpy import matrix, hstack
@@ -160,18 +166,42 @@ class UBCalculation:
             Name of a new UB matrix calculation
         """
         # Create storage object if name does not exist (TODO)
+        self.flush()
         self._clear(name)
         self.save()
+        self.flush()
+
+    def load(self, name, when=None):
+        """Load a saved UB matrix calculation.
 
-    def load(self, name):
-        state = self._persister.load(name)
-        if isinstance(self._persister, UBCalculationJSONPersister):
+        Parameters
+        ----------
+        name : str
+            Name of the saved UB matrix calculation.
+        when : datetime, optional
+            Restore the calculation as it was at this time. Only available
+            with a persister keeping the calculation history.
+        """
+        self.flush()
+        if when is None:
+            state = self._persister.load(name)
+        elif hasattr(self._persister, 'load_at'):
+            state = self._persister.load_at(name, when)
+        else:
+            raise DiffcalcException("UB calculation store %s does not keep the "
+                                    "calculation history" % self._persister.description)
+        if isinstance(self._persister, (UBCalculationJSONPersister,
+                                        UBCalculationSQLitePersister,
+                                        UBCalculationJournalPersister)):
             self._state = self._persister.encoder.decode_ubcalcstate(state,
                                                                      settings.geometry,
                                                                      self._get_diffractometer_axes_names(),
                                                                      settings.hardware.energyScannableMultiplierToGetKeV)
             self._state.reference.get_UB = self._get_UB
             self._state.surface.get_UB = self._get_UB
+            if state.get('version', 1) < self._persister.encoder.VERSION:
+                # One-time migration of files written in an older format
+                self._persister.save(self._state, name)
         elif isinstance(self._persister, UBCalculationPersister):
             self._state = state
         else:
@@ -190,6 +220,9 @@ class UBCalculation:
                 print e
         else:
             print "Warning: No UB calculation loaded."
+        if when is not None:
+            # Record the restore as the latest change of the calculation
+            self.save()
 
     def save(self):
         """Save current UB matrix calculation."""
@@ -207,8 +240,42 @@ class UBCalculation:
             Name for the saved UB matrix calculation.
         """
         self._state.name = name
+        self._state.UB = self._UB
         self._persister.save(self._state, name)
 
+    def flush(self):
+        """Write any saves held back by the persister."""
+        self._persister.flush()
+
+    def check_external_changes(self):
+        """Reload the current UB matrix calculation if another process has
+        saved it since it was last loaded or saved here. Saves of it held
+        back by the persister are discarded.
+
+        Returns
+        -------
+        bool
+            True if the calculation was changed by another process.
+        """
+        name = self._state.name
+        changed = getattr(self._persister, 'changed', None)
+        if not name or changed is None or not changed(name):
+            return False
+        # A held back save would overwrite the other process's version
+        discard = getattr(self._persister, 'discard_pending', None)
+        if discard is not None and discard(name):
+            print ("Warning: Changes to UB calculation '%s' not yet written here are "
+                   "discarded, as another process has saved it since." % name)
+        try:
+            self._persister.load_header(name)
+        except IOError:
+            print ("Warning: UB calculation '%s' was removed by another process. "
+                   "Use saveub to save it again." % name)
+            return True
+        print "UB calculation '%s' was changed by another process, reloading." % name
+        self.load(name)
+        return True
+
     def listub(self):
         """List saved UB matrix calculations.
         
@@ -286,6 +353,9 @@ class UBCalculation:
             lines.append("")
             lines.extend(self.str_lines_ub(self.UB))
 
+        if self._state.domains:
+            lines.extend(self.str_lines_domains())
+
         lines.extend(self.str_lines_refl())
         
         lines.extend(self.str_lines_orient())
@@ -328,6 +398,17 @@ class UBCalculation:
         lines.append(' ' * WIDTH + fmt % (z(UB[2, 0]), z(UB[2, 1]), z(UB[2, 2])))
         return lines
 
+    def str_lines_domains(self):
+        lines = ["", bold("DOMAINS"), ""]
+        fmt = "% 9.5f % 9.5f % 9.5f"
+        for name, rot in self._state.domains.items():
+            R = self._tobj.transform(rot, True)
+            lines.append(("   " + name + ":").ljust(WIDTH) +
+                         fmt % (z(R[0, 0]), z(R[0, 1]), z(R[0, 2])))
+            lines.append(" " * WIDTH + fmt % (z(R[1, 0]), z(R[1, 1]), z(R[1, 2])))
+            lines.append(" " * WIDTH + fmt % (z(R[2, 0]), z(R[2, 1]), z(R[2, 2])))
+        return lines
+
     def str_lines_refl(self):
         lines = ["", bold("REFLECTIONS"), ""]
         
@@ -497,6 +578,89 @@ class UBCalculation:
             self._autocalculateUbAndReport()
         self.save()
 
+    def add_reflections(self, hkls, positions, energies, tags=None, time=None,
+                        tolerance=None):
+        """Add many reference reflections with a single save.
+        
+        Reflections are validated together and only the accepted ones are
+        added to the reflection list.
+        
+        Parameters
+        ----------
+        hkls: array_like
+            (N,3) array of reflection hkl indices.
+        positions: :obj:`list` of positions
+            list of N diffractometer positions in internal representation in
+            degrees
+        energies: array_like
+            (N,) array of x-ray beam energies
+        tags: :obj:`list` of str, optional
+            identifying tags for the reflections
+        time : :obj:`datetime`, optional
+            datetime object
+        tolerance: float, optional
+            Maximum difference in degrees between the measured 2theta angles
+            and those calculated from the crystal lattice. No lattice check is
+            made by default.
+
+        Returns
+        -------
+        list:
+            (index, reason) pairs for the rejected reflections.
+        """
+        import numpy as np
+        if self._state.reflist is None:
+            raise DiffcalcException("No UBCalculation loaded")
+        hkls = np.atleast_2d(np.asarray(hkls, dtype=float))
+        energies = np.asarray(energies, dtype=float).ravel()
+        if tags is None:
+            tags = [None] * len(hkls)
+        if not len(hkls) == len(positions) == len(energies) == len(tags):
+            raise DiffcalcException("Numbers of hkl values, positions, energies "
+                                    "and tags differ.")
+        if not len(hkls):
+            return []
+        q_phi = self._calculate_q_phi_array(positions)
+        reasons = np.array([''] * len(hkls), dtype=object)
+        reasons[~np.isfinite(energies) | (energies <= 0)] = 'invalid energy'
+        reasons[~np.isfinite(q_phi).all(axis=1)] = 'invalid position'
+        reasons[(hkls == 0).all(axis=1)] = 'zero hkl'
+        reasons[~np.isfinite(hkls).all(axis=1)] = 'invalid hkl'
+        if tolerance is not None:
+            if self._state.crystal is None:
+                raise DiffcalcException("A crystal must be specified to check "
+                                        "reflections against the lattice")
+            ok = reasons == ''
+            hc = TWELVEISH * 1e7  # keV Angstrom
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ttheta = 2 * np.arcsin(np.clip(np.sqrt((q_phi ** 2).sum(axis=1)) / 2, 0, 1))
+                d = self.get_hkl_plane_distances(np.where(ok[:, None], hkls, 1))
+                sin_theta = hc / energies / (2 * d)
+            unreachable = ok & (sin_theta > 1)
+            reasons[unreachable] = 'not reachable at this energy'
+            ok &= ~unreachable
+            ttheta_calc = 2 * np.arcsin(np.clip(sin_theta, -1, 1))
+            ttheta_diff = np.abs(ttheta - ttheta_calc) * TODEG
+            bad = ok & (ttheta_diff > tolerance)
+            for idx in np.flatnonzero(bad):
+                reasons[idx] = '2theta differs from lattice by %.4f deg' % ttheta_diff[idx]
+        accepted = np.flatnonzero(reasons == '')
+        count = self.get_reference_count()
+        self._state.reflist.add_reflections(
+            [tuple(hkls[i]) + (positions[i], energies[i], tags[i]) for i in accepted], time)
+        if len(accepted):
+            calculated = False
+            # If the second reflection has just been added then calculateUB
+            if count < 2 <= self.get_reference_count():
+                try:
+                    calculated = self._autocalculateUbAndReport()
+                except Exception:
+                    self.save()  # keep the reflections if calculating UB fails
+                    raise
+            if not calculated:
+                self.save()  # calculate_UB saves otherwise
+        return [(i, reasons[i]) for i in np.flatnonzero(reasons != '')]
+
     def edit_reflection(self, idx, h, k, l, position, energy, tag, time):
         """Changes a reference reflection.
         
@@ -644,6 +808,8 @@ class UBCalculation:
                 print "Recalculating UB matrix."
             or12 = self.get_ub_references()
             self.calculate_UB(*or12)
+            return True
+        return False
 
 ### Orientations ###
 
@@ -837,6 +1003,105 @@ class UBCalculation:
 #    @property
 #    def reflist(self):
 #        return self._state.reflist
+### Domains ###
+
+    def add_domain(self, name, m, conv=True):
+        """Register a named domain orientation.
+        
+        The orientation matrix of the domain is obtained by applying the
+        domain rotation to the U matrix, i.e. UB_domain = R * U * B.
+        
+        Parameters
+        ----------
+        name: str
+            Name of the domain. An existing domain with this name is replaced.
+        m: matrix
+            3x3 orthogonal domain rotation matrix.
+        conv: bool, optional
+            If True, the matrix is given in the beamline coordinate system.
+        """
+        if self._state.name is None:
+            raise DiffcalcException("Cannot add a domain until a UBCalculation "
+                                    "has been started with 'newub'")
+        if m.__class__ != matrix:
+            m = matrix(m)
+        if m.shape[0] != 3 or m.shape[1] != 3:
+            raise ValueError("Expects 3*3 matrix")
+        mmt = (m * m.T).tolist()
+        for i in range(3):
+            for j in range(3):
+                if abs(mmt[i][j] - (1. if i == j else 0.)) > 1e-4:
+                    raise DiffcalcException("Domain matrix must be orthogonal")
+        self._state.domains[str(name)] = self._tobj.transform(m) if conv else m
+        self.save()
+
+    def remove_domain(self, name):
+        """Remove a named domain orientation."""
+        try:
+            del self._state.domains[name]
+        except KeyError:
+            raise DiffcalcException("No domain with name '%s' found" % name)
+        self.save()
+
+    def get_domain_names(self):
+        """list: Names of the registered domains."""
+        return list(self._state.domains.keys())
+
+    def get_domain_UBs(self, names=None):
+        """Orientation matrices of registered domains.
+        
+        Parameters
+        ----------
+        names: list of str, optional
+            Names of the domains to return. All domains by default.
+
+        Returns
+        -------
+        OrderedDict:
+            Domain names mapped onto domain UB matrices.
+        """
+        UB = self._get_UB()
+        if names is None:
+            names = self.get_domain_names()
+            if not names:
+                raise DiffcalcException("No domains have been defined in this "
+                                        "UB calculation. Use 'adddomain'")
+        res = OrderedDict()
+        for name in names:
+            try:
+                res[name] = self._state.domains[name] * UB
+            except KeyError:
+                raise DiffcalcException("No domain with name '%s' found" % name)
+        return res
+
+    def angles_to_hkl_domains(self, positions, wavelength, names=None):
+        """Calculate miller indices of many positions for several domains.
+        
+        The active UB matrix is not changed.
+        
+        Parameters
+        ----------
+        positions: array_like
+            (N,6) array of diffractometer positions in internal representation
+            in degrees or a list of position objects.
+        wavelength: float or array_like
+            Wavelength in Angstroms or (N,) array of wavelengths.
+        names: list of str, optional
+            Names of the domains to evaluate. All domains by default.
+
+        Returns
+        -------
+        OrderedDict:
+            Domain names mapped onto (N,3) arrays of hkl values.
+        """
+        import numpy as np
+        UBs = self.get_domain_UBs(names)
+        wavelength = np.asarray(wavelength, dtype=float).reshape(-1, 1)
+        q_phi = self._calculate_q_phi_array(positions) * (2 * pi / wavelength)
+        UB_inv = np.linalg.inv(np.array([np.asarray(m) for m in UBs.values()]))
+        hkls = np.einsum('dij,nj->dni', UB_inv, q_phi)
+        return OrderedDict(zip(UBs.keys(), hkls))
+
 ### Calculations ###
 
     def set_U_manually(self, m, conv=True):
@@ -1193,6 +1458,21 @@ class UBCalculation:
         """Calculates and returns the angle between planes"""
         return self._state.crystal.get_hkl_plane_angle(hkl1, hkl2)
 
+    def get_hkl_plane_distances(self, hkls):
+        """Calculates and returns the distances between planes for an (N,3)
+        array of hkl values"""
+        return self._state.crystal.get_hkl_plane_distances(hkls)
+
+    def get_q_lengths(self, hkls):
+        """Calculates and returns the scattering vector lengths for an (N,3)
+        array of hkl values"""
+        return self._state.crystal.get_q_lengths(hkls)
+
+    def get_hkl_plane_angles(self, hkls1, hkls2):
+        """Calculates and returns the (N,M) array of angles between (N,3) and
+        (M,3) arrays of planes"""
+        return self._state.crystal.get_hkl_plane_angles(hkls1, hkls2)
+
     def rescale_unit_cell(self, h, k, l, pos):
         """
         Calculate unit cell scaling parameter that matches
@@ -1228,6 +1508,62 @@ class UBCalculation:
             return None, None
         return miscut, axis.T.tolist()[0]
 
+    def _calculate_q_phi_array(self, positions):
+        """Scattering vectors in the phi frame for a sequence of positions.
+
+        Positions are either position objects or (N,6) internal angles in
+        degrees."""
+        import numpy as np
+        if hasattr(self._strategy, 'calculate_q_phi_array'):
+            angles = [pos.inDegrees().totuple() if hasattr(pos, 'totuple') else pos
+                      for pos in positions]
+            return self._strategy.calculate_q_phi_array(np.asarray(angles, dtype=float) * TORAD)
+        q_phi = []
+        for pos in positions:
+            if not hasattr(pos, 'totuple'):
+                try:
+                    pos = settings.geometry.create_position(*pos)
+                except AttributeError:
+                    pos = YouPosition(*pos, unit='DEG')
+            q_phi.append(self._strategy.calculate_q_phi(pos.inRadians()).T.tolist()[0])
+        return np.array(q_phi)
+
+    def fit_miscut(self, hkls, positions, apply=False):
+        """Estimate miscut from many specular and off-specular reflections.
+        
+        Parameters
+        ----------
+        hkls: array_like
+            (N,3) array of reflection hkl indices.
+        positions: array_like
+            (N,6) array of measured diffractometer positions in internal
+            representation in degrees or a list of position objects.
+        apply: bool, optional
+            If True, add the fitted miscut to the current U matrix.
+
+        Returns
+        -------
+        tuple:
+            Miscut angle and its standard error, miscut azimuth about the
+            surface normal and its standard error (all in degrees) and the
+            miscut rotation axis.
+        """
+        import numpy as np
+        hkls = np.atleast_2d(np.asarray(hkls, dtype=float))
+        if len(hkls) != len(positions):
+            raise DiffcalcException("Number of hkl values and positions differ.")
+        if len(hkls) < 2:
+            raise DiffcalcException("Need at least 2 reflections to fit miscut.")
+        hkl_phi = hkls.dot(np.asarray(self._get_UB()).T)
+        q_phi = self._calculate_q_phi_array(positions)
+        n_phi = np.asarray(self._get_surf_nphi()).ravel()
+        miscut, miscut_err, azimuth, azimuth_err, axis = fit_miscut(hkl_phi, q_phi, n_phi)
+        axis = self._tobj.transform(matrix([axis.tolist()]).T, True).T.tolist()[0]
+        if apply:
+            self.set_miscut(axis, miscut, True)
+        return (miscut * TODEG, miscut_err * TODEG,
+                azimuth * TODEG, azimuth_err * TODEG, axis)
+
     def get_miscut_angle_axis(self, ubmatrix):
         y = self._get_surf_nphi()
         l = ubmatrix * y
@@ -1,12 +1,15 @@
 from diffcalc.ub.crystal import CrystalUnderTest
 from diffcalc.ub.reflections import ReflectionList, _Reflection
 from math import pi
-import datetime  # @UnusedImport For crazy time eval code!
+import ast
+import datetime
+import re
 from diffcalc.ub.reference import YouReference
 from diffcalc.ub.orientations import _Orientation, OrientationList
 from diffcalc.log import logging
 from diffcalc import settings
 from diffcalc.hkl.you.geometry import YouPosition
+from diffcalc.util import DiffcalcException
 try:
     from collection import OrderedDict
 except ImportError:
@@ -31,7 +34,8 @@ nan = float('nan')
 class UBCalcState():
     
     def __init__(self, name=None, crystal=None, reflist=None, orientlist=None, tau=0, sigma=0,
-                 manual_U=None, manual_UB=None, or0=None, or1=None, reference=None, surface=None):
+                 manual_U=None, manual_UB=None, or0=None, or1=None, reference=None, surface=None,
+                 domains=None):
 
         assert reflist is not None
         self.name = name
@@ -46,6 +50,8 @@ class UBCalcState():
         self.or1 = or1
         self.reference = reference
         self.surface = surface
+        self.domains = OrderedDict() if domains is None else domains  # name -> rotation in phi frame
+        self.UB = None  # UB matrix at the last save, for persisters keeping history
         
     @property
     def is_okay_to_autocalculate_ub(self):
@@ -69,11 +75,21 @@ class UBCalcState():
 
 
 class UBCalcStateEncoder(json.JSONEncoder):
-    
+    """Encodes UB calculation state into a versioned json schema.
+
+    Version 2 stores all numbers natively: matrices and vectors as nested
+    lists and reflections and orientations as columns of equal length.
+    Files written before the schema was versioned (version 1) keep values as
+    repr strings and are still read by decode_ubcalcstate.
+    """
+
+    VERSION = 2
+
     def default(self, obj):
         
         if isinstance(obj, UBCalcState):
             d = OrderedDict()
+            d['version'] = self.VERSION
             d['name'] = obj.name
             d['crystal'] = obj.crystal
             d['reflist'] = obj.reflist
@@ -86,96 +102,216 @@ class UBCalcStateEncoder(json.JSONEncoder):
             d['ub'] = obj.manual_UB
             d['or0'] = obj.or0
             d['or1'] = obj.or1
+            d['domains'] = [[name, rot] for name, rot in getattr(obj, 'domains', {}).items()]
             
             return d
         
         if isinstance(obj, CrystalUnderTest):
-            return repr([obj._name, obj._system, obj._a1, obj._a2, obj._a3, obj._alpha1 * TODEG,
-                         obj._alpha2 * TODEG, obj._alpha3 * TODEG])
+            return [obj._name, obj._system, obj._a1, obj._a2, obj._a3, obj._alpha1 * TODEG,
+                    obj._alpha2 * TODEG, obj._alpha3 * TODEG]
             
         if isinstance(obj, matrix):
-            l = [', '.join((repr(e) for e in row)) for row in obj.tolist()]
-            return l
+            return obj.tolist()
         
         if isinstance(obj, ReflectionList):
-            d = OrderedDict()
-            for n, ref in enumerate(obj._reflist):
-                d[str(n+1)] = ref
-            return d
+            return UBCalcStateEncoder.reflist_to_columns(obj)
 
-        if isinstance(obj, _Reflection):
-            d = OrderedDict()
-            d['tag'] = obj.tag
-            d['hkl'] = repr([obj.h, obj.k, obj.l])
-            d['pos'] = repr(list(obj.pos.totuple()))
-            d['energy'] = obj.energy
-            dt = eval(obj.time)  # e.g. --> datetime.datetime(2013, 8, 5, 15, 47, 7, 962432)
-            d['time'] = None if dt is None else dt.isoformat()
-            return d
-        
         if isinstance(obj, OrientationList):
+            refs = obj._orientlist
             d = OrderedDict()
-            for n, orient in enumerate(obj._orientlist):
-                d[str(n+1)] = orient
+            d['count'] = len(refs)
+            d['tag'] = [ref.tag for ref in refs]
+            d['hkl'] = [[ref.h, ref.k, ref.l] for ref in refs]
+            d['xyz'] = [[ref.x, ref.y, ref.z] for ref in refs]
+            d['pos'] = [list(ref.pos.totuple()) for ref in refs]
+            d['time'] = _map_cached(time_repr_to_iso, [ref.time for ref in refs])
             return d
 
-        if isinstance(obj, _Orientation):
-            d = OrderedDict()
-            d['tag'] = obj.tag
-            d['hkl'] = repr([obj.h, obj.k, obj.l])
-            d['xyz'] = repr([obj.x, obj.y, obj.z])
-            d['pos'] = repr(list(obj.pos.totuple()))
-            dt = eval(obj.time)  # e.g. --> datetime.datetime(2013, 8, 5, 15, 47, 7, 962432)
-            d['time'] = None if dt is None else dt.isoformat()
-            return d
-        
         if isinstance(obj, YouReference):
             d = OrderedDict()
-            if obj.n_hkl_configured is not None:
-                d['n_hkl_configured'] = repr(obj.n_hkl_configured.T.tolist()[0])
-            else:
-                d['n_hkl_configured'] = None
-            if obj.n_phi_configured is not None:
-                d['n_phi_configured'] = repr(obj.n_phi_configured.T.tolist()[0])
-            else:
-                d['n_phi_configured'] = None
+            for key in ('n_hkl_configured', 'n_phi_configured'):
+                vec = getattr(obj, key)
+                d[key] = None if vec is None else vec.T.tolist()[0]
             return d
         
         
         return json.JSONEncoder.default(self, obj)
 
+    @staticmethod
+    def reflist_to_columns(reflist):
+        refs = reflist._reflist
+        d = OrderedDict()
+        d['count'] = len(refs)
+        d['tag'] = [ref.tag for ref in refs]
+        d['hkl'] = [[ref.h, ref.k, ref.l] for ref in refs]
+        d['pos'] = [list(ref.pos.totuple()) for ref in refs]
+        d['energy'] = [ref.energy for ref in refs]
+        d['time'] = _map_cached(time_repr_to_iso, [ref.time for ref in refs])
+        return d
+
     @staticmethod
     def decode_ubcalcstate(state, geometry, diffractometer_axes_names, multiplier):
 
-        # Backwards compatibility code
-        orientlist_=OrientationList(geometry, diffractometer_axes_names, [])
-        try:
-            orientlist_=decode_orientlist(state['orientlist'], geometry, diffractometer_axes_names)
-        except KeyError:
-            pass
-        try:
-            surface_=decode_reference(state['surface'], settings.surface_vector, False)
-        except KeyError:
-            surface_ = YouReference(None)
-            surface_._set_n_phi_configured(settings.surface_vector)
+        version = state.get('version', 1)
+        if version == 1:
+            return _decode_ubcalcstate_v1(state, geometry, diffractometer_axes_names, multiplier)
+        if version > UBCalcStateEncoder.VERSION:
+            raise DiffcalcException(
+                "UB calculation was saved in format version %s, but this version "
+                "of diffcalc only reads up to version %s" % (version, UBCalcStateEncoder.VERSION))
+        crystal = state['crystal']
         return UBCalcState(
             name=state['name'],
-            crystal=state['crystal'] and CrystalUnderTest(*eval(state['crystal'])),
-            reflist=decode_reflist(state['reflist'], geometry, diffractometer_axes_names, multiplier),
-            orientlist=orientlist_,
+            crystal=crystal and CrystalUnderTest(*crystal),
+            reflist=decode_reflist_columns(state['reflist'], geometry, diffractometer_axes_names, multiplier),
+            orientlist=decode_orientlist_columns(state['orientlist'], geometry, diffractometer_axes_names),
             tau=state['tau'],
             sigma=state['sigma'],
-            manual_U=state['u'] and decode_matrix(state['u']),
-            manual_UB=state['ub'] and decode_matrix(state['ub']),
+            manual_U=state['u'] and matrix(state['u']),
+            manual_UB=state['ub'] and matrix(state['ub']),
             or0=state['or0'],
             or1=state['or1'],
-            reference=decode_reference(state.get('reference', None), settings.reference_vector, True),
-            surface=surface_
+            reference=_decode_reference_vectors(state['reference'], settings.reference_vector, True),
+            surface=_decode_reference_vectors(state['surface'], settings.surface_vector, False),
+            domains=OrderedDict((name, matrix(rows)) for name, rows in state['domains'])
         )
 
 
+def _decode_ubcalcstate_v1(state, geometry, diffractometer_axes_names, multiplier):
+
+    # Backwards compatibility code
+    orientlist_=OrientationList(geometry, diffractometer_axes_names, [])
+    try:
+        orientlist_=decode_orientlist(state['orientlist'], geometry, diffractometer_axes_names)
+    except KeyError:
+        pass
+    try:
+        surface_=decode_reference(state['surface'], settings.surface_vector, False)
+    except KeyError:
+        surface_ = YouReference(None)
+        surface_._set_n_phi_configured(settings.surface_vector)
+    return UBCalcState(
+        name=state['name'],
+        crystal=state['crystal'] and CrystalUnderTest(*literal(state['crystal'])),
+        reflist=decode_reflist(state['reflist'], geometry, diffractometer_axes_names, multiplier),
+        orientlist=orientlist_,
+        tau=state['tau'],
+        sigma=state['sigma'],
+        manual_U=state['u'] and decode_matrix(state['u']),
+        manual_UB=state['ub'] and decode_matrix(state['ub']),
+        or0=state['or0'],
+        or1=state['or1'],
+        reference=decode_reference(state.get('reference', None), settings.reference_vector, True),
+        surface=surface_,
+        domains=OrderedDict((name, decode_matrix(rows)) for name, rows in state.get('domains', []))
+    )
+
+
+def _create_position(geometry, pos_tuple):
+    try:
+        return geometry.create_position(*pos_tuple)
+    except AttributeError:
+        return YouPosition(*pos_tuple)
+
+
+def _map_cached(func, values):
+    # Reflections added together share a time stamp, so convert each once
+    cache = {}
+    result = []
+    for value in values:
+        try:
+            result.append(cache[value])
+        except KeyError:
+            cache[value] = func(value)
+            result.append(cache[value])
+    return result
+
+
+def _iso_to_time_repr(iso):
+    return repr(iso and iso_to_datetime(iso))
+
+
+def decode_reflist_columns(columns, geometry, diffractometer_axes_names, multiplier):
+    reflections = [
+        _Reflection(h, k, l, _create_position(geometry, pos), energy, str(tag), time)
+        for tag, (h, k, l), pos, energy, time in zip(columns['tag'], columns['hkl'],
+                                                     columns['pos'], columns['energy'],
+                                                     _map_cached(_iso_to_time_repr, columns['time']))]
+    return ReflectionList(geometry, diffractometer_axes_names, reflections, multiplier)
+
+
+def decode_orientlist_columns(columns, geometry, diffractometer_axes_names):
+    orientations = [
+        _Orientation(h, k, l, x, y, z, _create_position(geometry, pos), str(tag), time)
+        for tag, (h, k, l), (x, y, z), pos, time in zip(columns['tag'], columns['hkl'],
+                                                        columns['xyz'], columns['pos'],
+                                                        _map_cached(_iso_to_time_repr, columns['time']))]
+    return OrientationList(geometry, diffractometer_axes_names, orientations)
+
+
+def _decode_reference_vectors(ref_dict, ref_vector, flg):
+    reference = YouReference(None)  # TODO: We can't set get_ub method yet (tangles!)
+    nhkl = ref_dict['n_hkl_configured']
+    nphi = ref_dict['n_phi_configured']
+    if nhkl:
+        reference._set_n_hkl_configured(matrix([nhkl]).T)
+    elif nphi:
+        reference._set_n_phi_configured(matrix([nphi]).T)
+    elif flg:
+        reference._set_n_hkl_configured(ref_vector)
+    else:
+        reference._set_n_phi_configured(ref_vector)
+    return reference
+
+
+_LITERAL_NAMES = {'inf': inf, 'nan': nan, 'None': None, 'True': True, 'False': False}
+
+
+def _literal_node(node):
+    if isinstance(node, ast.Name) and node.id in _LITERAL_NAMES:
+        return _LITERAL_NAMES[node.id]
+    if isinstance(node, ast.List):
+        return [_literal_node(e) for e in node.elts]
+    if isinstance(node, ast.Tuple):
+        return tuple(_literal_node(e) for e in node.elts)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        val = _literal_node(node.operand)
+        return -val if isinstance(node.op, ast.USub) else val
+    return ast.literal_eval(node)
+
+
+def literal(text):
+    """Safely evaluate the repr of numbers, strings, lists and tuples.
+
+    Unlike ast.literal_eval, inf and nan as written by repr are accepted.
+    """
+    return _literal_node(ast.parse(text.strip(), mode='eval').body)
+
+
+_DATETIME_REPR = re.compile(r'^datetime\.datetime\(([\d, ]*)\)$')
+
+
+def time_repr_to_iso(time_repr):
+    """Convert the repr of a datetime, as stored on reflections and
+    orientations, to an ISO 8601 string"""
+    if time_repr is None or time_repr == 'None':
+        return None
+    match = _DATETIME_REPR.match(time_repr)
+    if match is None:
+        raise DiffcalcException("Unexpected time stamp: %s" % time_repr)
+    return datetime.datetime(*[int(e) for e in match.group(1).split(',')]).isoformat()
+
+
+def iso_to_datetime(iso):
+    """Fast inverse of datetime.isoformat() for naive times"""
+    date, _, time = iso.partition('T')
+    time, _, us = time.partition('.')
+    fields = [int(e) for e in date.split('-') + time.split(':')]
+    return datetime.datetime(*fields + [int(us.rstrip('Z') or 0)])
+
+
 def decode_matrix(rows):
-    return matrix([[eval(e) for e in row.split(', ')] for row in rows])
+    return matrix([[literal(e) for e in row.split(', ')] for row in rows])
 
 
 def decode_reflist(reflist_dict, geometry, diffractometer_axes_names, multiplier):
@@ -207,13 +343,9 @@ def decode_orientlist(orientlist_dict, geometry, diffractometer_axes_names):
 
 
 def decode_reflection(ref_dict, geometry):
-    h, k, l = eval(ref_dict['hkl'])
+    h, k, l = literal(ref_dict['hkl'])
     time = ref_dict['time'] and gt(ref_dict['time'])
-    pos_tuple = eval(ref_dict['pos'])
-    try:
-        position = geometry.create_position(*pos_tuple)
-    except AttributeError:
-        position = YouPosition(*pos_tuple)
+    position = _create_position(geometry, literal(ref_dict['pos']))
     return _Reflection(h, k, l, position, ref_dict['energy'], str(ref_dict['tag']), repr(time))
 
 
@@ -223,9 +355,9 @@ def decode_reference(ref_dict, ref_vector, flg):
         nhkl = ref_dict.get('n_hkl_configured', None)
         nphi = ref_dict.get('n_phi_configured', None)
         if nhkl:
-            reference._set_n_hkl_configured(matrix([eval(nhkl)]).T)
+            reference._set_n_hkl_configured(matrix([literal(nhkl)]).T)
         elif nphi:
-            reference._set_n_phi_configured(matrix([eval(nphi)]).T)
+            reference._set_n_phi_configured(matrix([literal(nphi)]).T)
         elif flg:
             reference._set_n_hkl_configured(ref_vector)
         else:
@@ -234,11 +366,11 @@ def decode_reference(ref_dict, ref_vector, flg):
 
 
 def decode_orientation(orient_dict, geometry, diffractometer_axes_names):
-    h, k, l = eval(orient_dict['hkl'])
-    x, y, z = eval(orient_dict['xyz'])
+    h, k, l = literal(orient_dict['hkl'])
+    x, y, z = literal(orient_dict['xyz'])
     time = orient_dict['time'] and gt(orient_dict['time'])
     try:
-        pos_tuple = eval(orient_dict['pos'])
+        pos_tuple = literal(orient_dict['pos'])
         position = geometry.create_position(*pos_tuple)
     except KeyError:
         pos_tuple = (0.,) * len(diffractometer_axes_names)
@@ -107,6 +107,12 @@ class CrystalUnderTest(object):
             [0.0, b2 * sin(beta3), -b3 * sin(beta2) * cos(alpha1)],
             [0.0, 0.0, 2 * pi / a3]])
 
+        # Cache the real and reciprocal space metric tensors. The reciprocal
+        # one is in units of 1/Angstrom^2 so that 1/d^2 = hkl * G* * hkl.T
+        bReduced = self._bMatrix / (2 * pi)
+        self._recMetricTensor = bReduced.T * bReduced
+        self._metricTensor = self._recMetricTensor.I
+
     @property
     def B(self):
         '''
@@ -114,12 +120,20 @@ class CrystalUnderTest(object):
         was a problem calculating this'''
         return self._bMatrix
 
+    @property
+    def metric_tensor(self):
+        '''Returns the real space metric tensor G (Angstrom^2)'''
+        return self._metricTensor
+
+    @property
+    def reciprocal_metric_tensor(self):
+        '''Returns the reciprocal space metric tensor G* = G^-1 (1/Angstrom^2)'''
+        return self._recMetricTensor
+
     def get_hkl_plane_distance(self, hkl):
         '''Calculates and returns the distance between planes'''
         hkl = matrix([hkl])
-        bReduced = self._bMatrix / (2 * pi)
-        bMT = bReduced.I * bReduced.T.I
-        return 1.0 / sqrt((hkl * bMT.I * hkl.T)[0,0])
+        return 1.0 / sqrt((hkl * self._recMetricTensor * hkl.T)[0,0])
 
     def get_hkl_plane_angle(self, hkl1, hkl2):
         '''Calculates and returns the angle between [hkl1] and [hkl2] planes'''
@@ -130,6 +144,35 @@ class CrystalUnderTest(object):
         angle = angle_between_vectors(nphi1, nphi2)
         return angle
 
+    def get_hkl_plane_distances(self, hkls):
+        '''Calculates the distances between planes for an (N,3) array of hkl
+        values and returns them as an (N,) array'''
+        import numpy as np
+        hkls = np.atleast_2d(np.asarray(hkls, dtype=float))
+        gstar = np.asarray(self._recMetricTensor)
+        inv_dsq = np.einsum('ij,jk,ik->i', hkls, gstar, hkls)
+        return 1.0 / np.sqrt(inv_dsq)
+
+    def get_q_lengths(self, hkls):
+        '''Calculates the scattering vector lengths |Q| = 2*pi/d (1/Angstrom)
+        for an (N,3) array of hkl values and returns them as an (N,) array'''
+        return 2 * pi / self.get_hkl_plane_distances(hkls)
+
+    def get_hkl_plane_angles(self, hkls1, hkls2):
+        '''Calculates the angles (in radians) between every [hkl1] plane from
+        an (N,3) array and every [hkl2] plane from an (M,3) array and returns
+        them as an (N,M) array'''
+        import numpy as np
+        hkls1 = np.atleast_2d(np.asarray(hkls1, dtype=float))
+        hkls2 = np.atleast_2d(np.asarray(hkls2, dtype=float))
+        gstar = np.asarray(self._recMetricTensor)
+        g1 = hkls1.dot(gstar)
+        g2 = hkls2.dot(gstar)
+        norm1 = np.sqrt(np.einsum('ij,ij->i', g1, hkls1))
+        norm2 = np.sqrt(np.einsum('ij,ij->i', g2, hkls2))
+        cos_angles = g1.dot(hkls2.T) / np.outer(norm1, norm2)
+        return np.arccos(np.clip(cos_angles, -1, 1))
+
     def __str__(self):
         '''    Returns lattice name and all set and calculated parameters'''
         return '\n'.join(self.str_lines())
@@ -15,8 +15,8 @@
 # You should have received a copy of the GNU General Public License
 # along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
 ###
-from diffcalc.util import DiffcalcException, SMALL, angle_between_vectors, TODEG
-from math import pi, sqrt, sin, cos, atan2
+from diffcalc.util import DiffcalcException, SMALL, angle_between_vectors, TODEG, bound
+from math import pi, sqrt, sin, cos, atan2, acos
 from diffcalc.ub.crystal import CrystalUnderTest
 from diffcalc.hkl.you.geometry import create_you_matrices
 
@@ -306,3 +306,103 @@ def fit_u_matrix(init_u, uc, refl_list):
     #zr = q3 / sqrt(1. - q0 * q0)
     #print angle * TODEG, (xr, yr, zr), res
     return res_u
+
+
+def _rotation_from_vector(omega):
+    import numpy as np
+    angle = np.linalg.norm(omega)
+    if angle < SMALL:
+        return np.identity(3)
+    u, v, w = omega / angle
+    K = np.array([[0, -w, v], [w, 0, -u], [-v, u, 0]])
+    return np.identity(3) + sin(angle) * K + (1 - cos(angle)) * K.dot(K)
+
+
+def fit_miscut(hkl_phi, q_phi, n_phi, max_iter=20):
+    """Fit the crystal tilt relative to the surface normal.
+
+    Finds the rotation that brings the calculated reflection directions onto
+    the measured ones by iterated linear least squares on the small rotation
+    vector. All reflections are processed in a single vectorised step per
+    iteration. Rotations about the surface normal are refined but not
+    reported as miscut.
+
+    Parameters
+    ----------
+    hkl_phi: array_like
+        (N,3) array of reflection vectors calculated as UB * hkl.
+    q_phi: array_like
+        (N,3) array of measured scattering vectors in the phi frame.
+    n_phi: array_like
+        Surface normal vector in the phi frame.
+
+    Returns
+    -------
+    tuple:
+        Miscut angle and its standard error, miscut azimuth and its standard
+        error (all in radians) and the unit miscut rotation axis in the phi
+        frame.
+    """
+    import numpy as np
+    calc = np.atleast_2d(np.asarray(hkl_phi, dtype=float))
+    meas = np.atleast_2d(np.asarray(q_phi, dtype=float))
+    if calc.shape != meas.shape or calc.shape[1] != 3:
+        raise DiffcalcException("Calculated and measured reflection arrays must both have shape (N,3).")
+    calc = calc / np.linalg.norm(calc, axis=1)[:, np.newaxis]
+    meas = meas / np.linalg.norm(meas, axis=1)[:, np.newaxis]
+    nrefl = len(calc)
+
+    def design(vecs):
+        # d(omega x n)/d(omega) = -[n]x for every reflection, stacked to (3N,3)
+        x, y, z = vecs.T
+        zero = np.zeros(nrefl)
+        return -np.stack((np.column_stack((zero, -z, y)),
+                          np.column_stack((z, zero, -x)),
+                          np.column_stack((-y, x, zero))), axis=1).reshape(3 * nrefl, 3)
+
+    rot = np.identity(3)
+    for _ in range(max_iter):
+        trial = calc.dot(rot.T)
+        A = design(trial)
+        b = (meas - trial).ravel()
+        delta, _, rank, _ = np.linalg.lstsq(A, b, rcond=None)
+        rot = _rotation_from_vector(delta).dot(rot)
+        if np.linalg.norm(delta) < SMALL:
+            break
+
+    trial = calc.dot(rot.T)
+    A = design(trial)
+    resid = (meas - trial).ravel()
+    dof = max(3 * nrefl - rank, 1)
+    cov = resid.dot(resid) / dof * np.linalg.pinv(A.T.dot(A))
+
+    # Rotation vector of the total fitted rotation
+    angle = acos(bound((np.trace(rot) - 1) / 2.))
+    if angle < SMALL:
+        omega = np.zeros(3)
+    else:
+        omega = angle / (2 * sin(angle)) * np.array([rot[2, 1] - rot[1, 2],
+                                                     rot[0, 2] - rot[2, 0],
+                                                     rot[1, 0] - rot[0, 1]])
+
+    # Project out the rotation about the surface normal and express the tilt
+    # axis in an in-plane basis (e1, e2) to obtain the miscut azimuth.
+    n = np.asarray(n_phi, dtype=float).ravel()
+    n = n / np.linalg.norm(n)
+    ref = np.array([1., 0, 0]) if abs(n[0]) < 0.9 else np.array([0, 1., 0])
+    e1 = ref - n * ref.dot(n)
+    e1 = e1 / np.linalg.norm(e1)
+    e2 = np.cross(n, e1)
+    x, y = omega.dot(e1), omega.dot(e2)
+    miscut = sqrt(x * x + y * y)
+    if miscut < SMALL:
+        return 0., sqrt(max(e1.dot(cov).dot(e1), 0)), 0., float('nan'), np.zeros(3)
+    axis = (x * e1 + y * e2) / miscut
+    miscut_err = sqrt(max(axis.dot(cov).dot(axis), 0))
+    # The lattice normal tilts perpendicular to the rotation axis.
+    azimuth = atan2(y, x) - pi / 2
+    if azimuth <= -pi:
+        azimuth += 2 * pi
+    grad = (x * e2 - y * e1) / miscut ** 2
+    azimuth_err = sqrt(max(grad.dot(cov).dot(grad), 0))
+    return miscut, miscut_err, azimuth, azimuth_err, axis
@@ -19,7 +19,23 @@
 from __future__ import with_statement
 
 import os, glob
+import ast
 import datetime
+import atexit
+import getpass
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from copy import copy, deepcopy
+
+from diffcalc.util import DiffcalcException
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # No advisory locking on Windows and Jython
 
 try:
     import json
@@ -30,14 +46,9 @@ except ImportError:
 def is_writable(directory):
     """Return true if the file is writable from the current user
     """
-    probe = os.path.join(directory, "probe")
-    try:
-        open(probe, 'w')
-    except IOError:
-        return False
-    else:
-        os.remove(probe)
-        return True
+    # Not probing with a file, which would change the directory modification
+    # time the calculation index relies on
+    return os.access(directory, os.W_OK | os.X_OK)
 
 def check_directory_appropriate(directory):
 
@@ -51,47 +62,1131 @@ def check_directory_appropriate(directory):
         raise IOError("'%s' is not writable")
 
 
+def _state_summary(state):
+    """Return the lattice name and number of reflections of a UB calculation
+    state object or of its json dictionary"""
+    if isinstance(state, dict):
+        crystal = state.get('crystal')
+        try:
+            if isinstance(crystal, basestring):
+                crystal = ast.literal_eval(crystal)  # version 1 files
+            lattice = crystal[0]
+        except (ValueError, SyntaxError, TypeError, IndexError):
+            lattice = None
+        reflist = state.get('reflist')
+        if not isinstance(reflist, dict):
+            nref = 0
+        elif 'count' in reflist:
+            nref = reflist['count']
+        else:
+            nref = len(reflist)  # version 1 files
+    else:
+        crystal = getattr(state, 'crystal', None)
+        lattice = None if crystal is None else crystal.getLattice()[0]
+        reflist = getattr(state, 'reflist', None)
+        nref = 0 if reflist is None else len(reflist)
+    return lattice, nref
+
+
+_HEADER_START = '{"header": '
+
+
+def _dump_with_header(body, f, header):
+    """Write a json object with a one line header as its first member"""
+    f.write(_HEADER_START + json.dumps(header))
+    f.write(',\n' + body[1:] if body != '{}' else '\n}')
+
+
+def read_header(path):
+    """Return the header of a UB calculation file, reading only its first
+    line, or None if the file has no header"""
+    with open(path, 'r') as f:
+        line = f.readline()
+    if not line.startswith(_HEADER_START):
+        return None
+    try:
+        return json.loads(line[len(_HEADER_START):].rstrip().rstrip(','))
+    except ValueError:
+        return None
+
+
+def _copy_state(state):
+    """Return a copy of a UB calculation state which later changes to the
+    state do not reach.
+
+    State objects are copied structurally: reflections, orientations and
+    matrices are replaced rather than changed in place, so the copy shares
+    them and only the lists and objects holding them are copied. Anything
+    else is copied deeply.
+    """
+    if isinstance(state, dict) or not hasattr(state, 'reflist'):
+        return deepcopy(state)
+    state = copy(state)
+    for key in ('crystal', 'reference', 'surface'):
+        if getattr(state, key, None) is not None:
+            setattr(state, key, copy(getattr(state, key)))
+    for key, items in (('reflist', '_reflist'), ('orientlist', '_orientlist')):
+        entries = getattr(state, key, None)
+        if entries is not None:
+            entries = copy(entries)
+            setattr(entries, items, list(getattr(entries, items)))
+            setattr(state, key, entries)
+    if getattr(state, 'domains', None) is not None:
+        state.domains = copy(state.domains)
+    return state
+
+
+def _to_native(encoder, obj):
+    """Encode a UB calculation state into plain python values"""
+    if obj is None or isinstance(obj, (bool, int, long, float, basestring)):
+        return obj
+    if isinstance(obj, (list, tuple)):
+        return [_to_native(encoder, e) for e in obj]
+    if isinstance(obj, dict):
+        return dict((k, _to_native(encoder, v)) for k, v in obj.items())
+    return _to_native(encoder, encoder.default(obj))
+
+
+def _format_entry(entry):
+    dt = datetime.datetime.fromtimestamp(entry['mtime'])
+    fields = [dt.strftime('%d %b %Y (%H:%M)')]
+    if entry['lattice'] is not None:
+        fields.append(entry['lattice'])
+    fields.append('%d refl' % entry['nref'])
+    if entry['user'] is not None:
+        fields.append(entry['user'])
+    return '  '.join(fields)
+
+
+def _save_reflist_npz(f, columns):
+    import numpy as np
+    np.savez(f,
+             tag=np.array([unicode(tag) for tag in columns['tag']], dtype=unicode),
+             hkl=np.array(columns['hkl'], dtype=float),
+             pos=np.array(columns['pos'], dtype=float),
+             energy=np.array(columns['energy'], dtype=float),
+             time=np.array([time or u'' for time in columns['time']], dtype=unicode))
+
+
+def _load_reflist_npz(path):
+    try:
+        import numpy as np
+    except ImportError:
+        raise IOError("numpy is required to read the reflections in " + path)
+    data = np.load(path)
+    try:
+        columns = dict((key, data[key].tolist()) for key in
+                       ('tag', 'hkl', 'pos', 'energy', 'time'))
+    finally:
+        data.close()
+    columns['count'] = len(columns['tag'])
+    columns['time'] = [time or None for time in columns['time']]
+    return columns
+
+
+def _file_owner(path):
+    try:
+        import pwd
+        return pwd.getpwuid(os.stat(path).st_uid).pw_name
+    except (ImportError, KeyError, OSError):
+        return None
+
+
+def _current_user():
+    try:
+        return getpass.getuser()
+    except Exception:
+        return None
+
+
+@contextmanager
+def _no_lock():
+    yield
+
+
+def _atomic_write(path, dump, mode='w'):
+    """Write a file via a temporary file which is synced and renamed over
+    path, so readers see either the old or the new file"""
+    directory = os.path.dirname(path)
+    fd, tmppath = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.',
+                                   suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, mode) as f:
+            dump(f)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates files only readable by the owner
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmppath, 0666 & ~umask)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmppath, path)
+    except:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+
+class UBCalculationIndex(object):
+    """Index of the UB calculations stored in a directory.
+
+    For every calculation the index records name, modification time, size,
+    lattice name, number of reflections and the user who last saved it. It
+    is kept next to the calculations in two hidden files: a json snapshot of
+    all entries with a generation number, and a log which saves and removals
+    append a line to. The log starts with the generation of the snapshot it
+    belongs to, and every line records the directory modification time
+    after the change. Once the log holds more lines than COMPACT_AFTER or
+    half the number of entries, it is folded into a new snapshot of the
+    next generation and started again.
+
+    Other processes sharing the directory read only the lines appended since
+    they last looked, or the whole index when the generation changed. The
+    index is used while the directory modification time matches the last
+    one recorded. Otherwise it is rebuilt, reusing entries of files whose
+    mtime and size are unchanged. Snapshots are written atomically, and
+    changes and rebuilds are made holding the lock given, which the
+    persister shares with the calculation files.
+    """
+
+    FILENAME = '.index.json'
+    LOGNAME = '.index.log'
+    VERSION = 2
+    COMPACT_AFTER = 64
+
+    def __init__(self, directory, lock=None):
+        self.directory = directory
+        self.path = os.path.join(directory, self.FILENAME)
+        self.logpath = os.path.join(directory, self.LOGNAME)
+        self._lock = lock or _no_lock
+        self._entries = None
+        self._sorted = None
+        self._generation = None
+        self._signature = None
+        self._dir_mtime = None
+        self._log_offset = 0
+        self._log_lines = 0
+
+    def _read(self):
+        """Read the snapshot, dropping everything read before"""
+        self._entries = None
+        self._sorted = None
+        self._dir_mtime = None
+        self._log_offset = 0
+        self._log_lines = 0
+        try:
+            with open(self.path, 'r') as f:
+                st = os.fstat(f.fileno())
+                index = json.load(f)
+            self._signature = (st.st_mtime, st.st_size, st.st_ino)
+            if index['version'] != self.VERSION:
+                return
+            self._generation = index['generation']
+            self._entries = dict((e['name'], e) for e in index['entries'])
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            self._entries = None
+
+    def _read_log(self):
+        """Apply the lines appended to the log since it was last read"""
+        try:
+            with open(self.logpath, 'r') as f:
+                f.seek(self._log_offset)
+                text = f.read()
+        except IOError:
+            return
+        # A line still being written is read next time
+        end = text.rfind('\n') + 1
+        for line in text[:end].splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if self._log_offset == 0 and self._log_lines == 0:
+                if record.get('generation') != self._generation:
+                    return  # log of another snapshot, being replaced
+            elif 'update' in record:
+                self._entries[record['update']['name']] = record['update']
+            elif 'discard' in record:
+                self._entries.pop(record['discard'], None)
+            self._dir_mtime = record.get('dir_mtime')
+            self._log_lines += 1
+        self._log_offset += end
+        if end:
+            self._sorted = None
+
+    def refresh(self):
+        """Bring the index up to date with changes recorded by any process.
+        Return True if no other changes were made to the directory."""
+        try:
+            st = os.stat(self.path)
+            signature = (st.st_mtime, st.st_size, st.st_ino)
+        except OSError:
+            signature = None
+        if self._entries is None or signature != self._signature:
+            self._read()
+        if self._entries is None:
+            return False
+        self._read_log()
+        return self._dir_mtime == os.path.getmtime(self.directory)
+
+    def _make_entry(self, name, path, lattice, nref, user):
+        st = os.stat(path)
+        return {'name': name, 'mtime': st.st_mtime, 'size': st.st_size,
+                'lattice': lattice, 'nref': nref, 'user': user}
+
+    def _compact(self):
+        """Write all entries as the snapshot of the next generation and start
+        its log. The lock must be held."""
+        generation = (self._generation or 0) + 1
+        index = {'version': self.VERSION, 'generation': generation,
+                 'entries': self._entries.values()}
+        try:
+            _atomic_write(self.path, lambda f: json.dump(index, f))
+            st = os.stat(self.path)
+            with open(self.logpath, 'w') as f:
+                # After the rename and creating the log, which change it
+                dir_mtime = os.path.getmtime(self.directory)
+                f.write(json.dumps({'generation': generation, 'dir_mtime': dir_mtime}) + '\n')
+                self._log_offset = f.tell()
+        except (IOError, OSError):
+            self._dir_mtime = None  # rebuilt next time
+            return
+        self._generation = generation
+        self._signature = (st.st_mtime, st.st_size, st.st_ino)
+        self._dir_mtime = dir_mtime
+        self._log_lines = 1
+
+    def _append(self, record):
+        """Record a change in the log. The lock must be held and the index
+        up to date."""
+        if self._log_lines > max(self.COMPACT_AFTER, len(self._entries) // 2):
+            self._compact()
+            return
+        try:
+            with open(self.logpath, 'a') as f:
+                record['dir_mtime'] = os.path.getmtime(self.directory)
+                f.write(json.dumps(record) + '\n')
+                self._log_offset = f.tell()
+        except (IOError, OSError):
+            self._dir_mtime = None  # rebuilt next time
+            return
+        self._dir_mtime = record['dir_mtime']
+        self._log_lines += 1
+
+    def rebuild(self):
+        """Bring the index in line with the files in the directory. The
+        lock must be held."""
+        old_entries = self._entries or {}
+        self._entries = {}
+        self._sorted = None
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            name = os.path.basename(path)[:-len('.json')]
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entry = old_entries.get(name)
+            if entry is None or entry['mtime'] != st.st_mtime or entry['size'] != st.st_size:
+                try:
+                    header = read_header(path)
+                    if header is not None:
+                        lattice, nref, user = header['lattice'], header['nref'], header['user']
+                    else:
+                        with open(path, 'r') as f:
+                            lattice, nref = _state_summary(json.load(f))
+                        user = _file_owner(path)
+                except (IOError, ValueError, KeyError):
+                    lattice, nref, user = None, 0, _file_owner(path)
+                entry = self._make_entry(name, path, lattice, nref, user)
+            self._entries[name] = entry
+        self._compact()
+
+    def validate(self, locked=False):
+        """Bring the index up to date, rebuilding it if the directory has
+        been changed other than through an index. locked tells if the
+        caller holds the lock."""
+        if self.refresh():
+            return
+        if locked:
+            self.rebuild()
+            return
+        with self._lock():
+            if not self.refresh():
+                self.rebuild()
+
+    def update(self, name, path, lattice, nref):
+        """Record a calculation which has just been written to path. The
+        lock must be held."""
+        if self._entries is None:
+            self.validate(True)
+        entry = self._make_entry(name, path, lattice, nref, _current_user())
+        self._entries[name] = entry
+        if self._sorted is not None and (not self._sorted or
+                                         entry['mtime'] >= self._sorted[0]['mtime']):
+            self._sorted = [entry] + [e for e in self._sorted if e['name'] != name]
+        else:
+            self._sorted = None
+        self._append({'update': entry})
+
+    def discard(self, name):
+        """Forget a calculation which has just been removed. The lock must be
+        held."""
+        if self._entries is None:
+            self.validate(True)
+        if self._entries.pop(name, None) is not None and self._sorted is not None:
+            self._sorted = [e for e in self._sorted if e['name'] != name]
+        self._append({'discard': name})
+
+    def entries(self):
+        """Return index entries ordered from the most recently modified"""
+        self.validate()
+        if self._entries is None:
+            return []
+        if self._sorted is None:
+            self._sorted = sorted(self._entries.values(), key=lambda e: e['mtime'], reverse=True)
+        return list(self._sorted)
+
+
 class UBCalculationJSONPersister(object):
+    """Stores UB calculations as json files in a directory.
+
+    Files are written atomically via a temporary file which is synced and
+    renamed over the target. With a non-zero write_interval saves are held
+    back and written from a background thread, so that repeated saves of
+    the same calculation within the interval result in a single write.
+    save() then only takes a structural copy of the state, see
+    _copy_state(), which the thread encodes once per interval, so it never
+    reads a calculation which is being changed.
+    Pending saves are written by flush(), before any other access to the
+    directory and on interpreter exit. Listing is answered from an index of
+    the directory, see UBCalculationIndex.
+
+    With npz_threshold set, reflection lists of at least that many
+    reflections are stored in a binary numpy sidecar file next to the json
+    file.
+
+    Files start with a one line header holding the lattice name, number of
+    reflections, user and save time, which read_header() reads without
+    parsing the rest of the file.
+
+    Several processes may share a directory. Writes hold an advisory lock
+    on a lock file in the directory and bump a generation number in the
+    header. Saves never overwrite a generation other than the one last
+    loaded or saved here, but fail with a DiffcalcException. changed()
+    tells from a single stat whether a calculation was saved by someone
+    else since then, and discard_pending() drops a held back save which
+    would conflict.
+    """
+
+    LOCKFILE = '.lock'
 
-    def __init__(self, directory, encoder):
+    def __init__(self, directory, encoder, write_interval=0, npz_threshold=None):
         check_directory_appropriate(directory)
         self.directory = directory
         self.description = directory
         self.encoder = encoder
-        
+        self.write_interval = write_interval
+        self.npz_threshold = npz_threshold
+        self.index = UBCalculationIndex(directory, self._file_lock)
+        self._pending = {}
+        self._pending_lock = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._worker = None
+        self._seen = {}  # name -> (generation, file signature) last loaded or saved
+
     def filepath(self, name):
         return os.path.join(self.directory, name + '.json')
-        
+
+    def sidecarpath(self, name):
+        return os.path.join(self.directory, name + '.npz')
+
     def save(self, state, name):
         # FORMAT = '%Y-%m-%d %H:%M:%S'
         # time_string = datetime.datetime.strftime(datetime.datetime.now(), FORMAT)
-        with open(self.filepath(name), 'w') as f:
-            json.dump(state, f, indent=4, cls=self.encoder)
+        if not self.write_interval:
+            snapshot = self._snapshot(state, name)
+            with self._write_lock:
+                self._write(snapshot, name)
+            return
+        state = _copy_state(state)
+        with self._pending_lock:
+            self._pending[name] = state
+            self._start_worker()
+            self._pending_lock.notify()
+
+    def _snapshot(self, state, name):
+        """Encode everything written for a state: the json body, the
+        reflection columns of the sidecar file if one is used and the
+        lattice name and number of reflections for the header"""
+        lattice, nref = _state_summary(state)
+        columns = None
+        data = state
+        reflist = getattr(state, 'reflist', None)
+        if (self.npz_threshold is not None and reflist is not None and
+                len(reflist) >= self.npz_threshold):
+            columns = self.encoder.reflist_to_columns(reflist)
+            data = self.encoder().default(state)
+            data['reflist'] = {'count': columns['count'],
+                               'npz': os.path.basename(self.sidecarpath(name))}
+        return {'body': json.dumps(data, indent=4, cls=self.encoder),
+                'columns': columns, 'lattice': lattice, 'nref': nref}
+
+    def flush(self):
+        """Write all pending saves"""
+        with self._write_lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, {}
+            error = None
+            for name, state in pending.items():
+                try:
+                    self._write(self._snapshot(state, name), name)
+                except (DiffcalcException, TypeError, ValueError), e:
+                    # Saved by another process meanwhile or not serialisable,
+                    # retrying would fail again
+                    error = e
+                except Exception, e:
+                    # Keep for a retry unless superseded by a newer save
+                    with self._pending_lock:
+                        self._pending.setdefault(name, state)
+                    error = e
+            if error is not None:
+                raise error
+
+    def discard_pending(self, name):
+        """Drop a held back save of a calculation. Return True if there
+        was one."""
+        with self._pending_lock:
+            return self._pending.pop(name, None) is not None
+
+    def _start_worker(self):
+        if self._worker is not None and self._worker.isAlive():
+            return
+        if self._worker is None:
+            atexit.register(self._flush_quietly)
+        self._worker = threading.Thread(target=self._run, name='ubcalc-writer')
+        self._worker.setDaemon(True)
+        self._worker.start()
+
+    def _flush_quietly(self):
+        try:
+            self.flush()
+        except Exception, e:
+            print "Warning: Could not save UB calculation: %s" % e
+
+    def _run(self):
+        while True:
+            with self._pending_lock:
+                while not self._pending:
+                    self._pending_lock.wait()
+            time.sleep(self.write_interval)
+            self._flush_quietly()
+
+    @contextmanager
+    def _file_lock(self):
+        """Hold the advisory lock of the directory shared with other processes"""
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, self.LOCKFILE), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    @staticmethod
+    def _signature(st):
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def changed(self, name):
+        """Return True if the calculation has been saved or removed by
+        another process since it was last loaded or saved here"""
+        seen = self._seen.get(name)
+        if seen is None:
+            return False
+        try:
+            return self._signature(os.stat(self.filepath(name))) != seen[1]
+        except OSError:
+            del self._seen[name]
+            return True
+
+    def _write(self, snapshot, name):
+        with self._file_lock():
+            self._write_locked(snapshot, name)
+
+    def _write_locked(self, snapshot, name):
+        path = self.filepath(name)
+        sidecar = self.sidecarpath(name)
+        try:
+            previous = read_header(path)
+        except IOError:
+            previous = None
+        generation = previous.get('generation', 0) if previous else 0
+        seen = self._seen.get(name)
+        if previous is not None and seen is not None and seen[0] != generation:
+            raise DiffcalcException(
+                "UB calculation '%s' was not saved, as %s saved it at %s since it was "
+                "loaded here. Load it again to continue from that version." %
+                (name, previous.get('user'), previous.get('saved')))
+        # Pick up changes by others before our own write moves the directory mtime
+        self.index.validate(True)
+        columns = snapshot['columns']
+        if columns is not None:
+            self._atomic_write(sidecar, lambda f: _save_reflist_npz(f, columns), 'wb')
+        lattice, nref = snapshot['lattice'], snapshot['nref']
+        header = {'name': name, 'lattice': lattice, 'nref': nref, 'user': _current_user(),
+                  'saved': datetime.datetime.now().isoformat(),
+                  'version': getattr(self.encoder, 'VERSION', None),
+                  'generation': generation + 1}
+        self._atomic_write(path, lambda f: _dump_with_header(snapshot['body'], f, header))
+        self._seen[name] = (generation + 1, self._signature(os.stat(path)))
+        if columns is None and os.path.exists(sidecar):
+            os.remove(sidecar)
+        self.index.update(name, path, lattice, nref)
+        try:
+            dirfd = os.open(self.directory, os.O_RDONLY)
+        except (OSError, AttributeError):
+            return  # directories can not be opened on all platforms
+        try:
+            os.fsync(dirfd)
+        except OSError:
+            pass
+        finally:
+            os.close(dirfd)
+
+    def _atomic_write(self, path, dump, mode='w'):
+        _atomic_write(path, dump, mode)
 
     def load(self, name):
+        self.flush()
         with open(self.filepath(name), 'r') as f:
-            return json.load(f)
+            signature = self._signature(os.fstat(f.fileno()))
+            state = json.load(f)
+        header = state.pop('header', None) if isinstance(state, dict) else None
+        self._seen[name] = (header.get('generation', 0) if header else 0, signature)
+        reflist = state.get('reflist') if isinstance(state, dict) else None
+        if isinstance(reflist, dict) and 'npz' in reflist:
+            state['reflist'] = _load_reflist_npz(os.path.join(self.directory, reflist['npz']))
+        return state
+
+    def load_header(self, name):
+        """Return the header of a stored calculation without loading it"""
+        self.flush()
+        path = self.filepath(name)
+        header = read_header(path)
+        if header is None:
+            # Files written before headers were added
+            with open(path, 'r') as f:
+                lattice, nref = _state_summary(json.load(f))
+            header = {'name': name, 'lattice': lattice, 'nref': nref,
+                      'user': _file_owner(path), 'saved': None, 'version': None}
+        return header
 
     def list(self):  # @ReservedAssignment
-        files = self._get_save_files()
-        return [os.path.basename(f + '.json').split('.json')[0] for f in files]
-
-    def list_metadata(self):       
-        metadata = []
-        for f in self._get_save_files():            
-            dt = datetime.datetime.fromtimestamp(os.path.getmtime(f))
-            metadata.append(dt.strftime('%d %b %Y (%H:%M)'))
-        return metadata
-    
-    def _get_save_files(self):
-        files = filter(os.path.isfile, glob.glob(os.path.join(self.directory, '*.json')))
-        files.sort(key=lambda x: os.path.getmtime(x))
-        files.reverse()
-        return files
+        return [e['name'] for e in self.list_entries()]
+
+    def list_entries(self):
+        """Return index entries of the stored calculations, most recent first"""
+        self.flush()
+        with self._write_lock:
+            return self.index.entries()
+
+    def list_metadata(self):
+        return [_format_entry(e) for e in self.list_entries()]
+
+    def remove(self, name):
+        with self._write_lock:
+            with self._pending_lock:
+                self._pending.pop(name, None)
+            with self._file_lock():
+                self.index.validate(True)
+                os.remove(self.filepath(name))
+                if os.path.exists(self.sidecarpath(name)):
+                    os.remove(self.sidecarpath(name))
+                self.index.discard(name)
+            self._seen.pop(name, None)
+
+
+
+class UBCalculationSQLitePersister(object):
+    """Stores UB calculations in an SQLite database.
+
+    Calculations, reflections, orientations and constraints are kept in
+    separate tables. A save only touches the rows which differ from the
+    last saved or loaded version of a calculation. Every change of the UB
+    matrix or lattice is appended to a history table with its time stamp.
+    load() returns the same dictionary as the version 2 json format, so
+    calculations are decoded by the encoder.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS calculations (
+            id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL,
+            lattice TEXT, system TEXT,
+            a REAL, b REAL, c REAL, alpha REAL, beta REAL, gamma REAL,
+            tau REAL, sigma REAL,
+            u TEXT, ub TEXT, or0 TEXT, or1 TEXT,
+            reference TEXT, surface TEXT, domains TEXT,
+            modified REAL NOT NULL, user TEXT);
+        CREATE TABLE IF NOT EXISTS reflections (
+            calc_id INTEGER NOT NULL, idx INTEGER NOT NULL,
+            tag TEXT, h REAL, k REAL, l REAL, pos TEXT, energy REAL, time TEXT,
+            PRIMARY KEY (calc_id, idx));
+        CREATE TABLE IF NOT EXISTS orientations (
+            calc_id INTEGER NOT NULL, idx INTEGER NOT NULL,
+            tag TEXT, h REAL, k REAL, l REAL, x REAL, y REAL, z REAL, pos TEXT, time TEXT,
+            PRIMARY KEY (calc_id, idx));
+        CREATE TABLE IF NOT EXISTS constraints (
+            calc_id INTEGER NOT NULL, idx INTEGER NOT NULL,
+            name TEXT NOT NULL, value TEXT,
+            PRIMARY KEY (calc_id, idx));
+        CREATE TABLE IF NOT EXISTS ub_history (
+            calc_id INTEGER NOT NULL, time REAL NOT NULL, ub TEXT);
+        CREATE TABLE IF NOT EXISTS lattice_history (
+            calc_id INTEGER NOT NULL, time REAL NOT NULL,
+            lattice TEXT, system TEXT,
+            a REAL, b REAL, c REAL, alpha REAL, beta REAL, gamma REAL);
+        CREATE INDEX IF NOT EXISTS calculations_lattice ON calculations (lattice);
+        CREATE INDEX IF NOT EXISTS ub_history_calc ON ub_history (calc_id, time);
+        CREATE INDEX IF NOT EXISTS lattice_history_calc ON lattice_history (calc_id, time);
+        """
+
+    _ROW_TABLES = {
+        'reflections': ('tag', 'h', 'k', 'l', 'pos', 'energy', 'time'),
+        'orientations': ('tag', 'h', 'k', 'l', 'x', 'y', 'z', 'pos', 'time'),
+        'constraints': ('name', 'value'),
+    }
+
+    def __init__(self, filename, encoder):
+        try:
+            import sqlite3
+        except ImportError:
+            raise IOError("The sqlite3 module is required to store UB calculations in " +
+                          filename)
+        self.filename = filename
+        self.description = filename
+        self.directory = os.path.dirname(os.path.abspath(filename))
+        self.encoder = encoder
+        self._conn = sqlite3.connect(filename)
+        self._conn.executescript(self._SCHEMA)
+        # Last saved or loaded rows and history values, by calculation id
+        self._rows = {}
+        self._last_ub = {}
+        self._last_lattice = {}
+
+    def _calc_id(self, name):
+        row = self._conn.execute("SELECT id FROM calculations WHERE name = ?",
+                                 (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def _encode_rows(self, d):
+        reflist, orientlist = d['reflist'], d['orientlist']
+        rows = {}
+        rows['reflections'] = [
+            (tag, h, k, l, json.dumps(pos), energy, time) for tag, (h, k, l), pos, energy, time in
+            zip(reflist['tag'], reflist['hkl'], reflist['pos'], reflist['energy'], reflist['time'])]
+        rows['orientations'] = [
+            (tag, h, k, l, x, y, z, json.dumps(pos), time) for tag, (h, k, l), (x, y, z), pos, time in
+            zip(orientlist['tag'], orientlist['hkl'], orientlist['xyz'], orientlist['pos'],
+                orientlist['time'])]
+        rows['constraints'] = [(con, json.dumps(value)) for con, value in
+                               sorted(d.get('constraints', {}).items())]
+        return rows
+
+    def _read_rows(self, table, calc_id):
+        columns = self._ROW_TABLES[table]
+        return [tuple(row) for row in self._conn.execute(
+            "SELECT %s FROM %s WHERE calc_id = ? ORDER BY idx" % (', '.join(columns), table),
+            (calc_id,))]
+
+    def _sync_rows(self, table, calc_id, rows):
+        old = self._rows.get((table, calc_id))
+        if old is None:
+            old = self._read_rows(table, calc_id)
+        columns = self._ROW_TABLES[table]
+        changed = [(calc_id, idx) + row for idx, row in enumerate(rows)
+                   if idx >= len(old) or old[idx] != row]
+        if changed:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO %s (calc_id, idx, %s) VALUES (%s)" %
+                (table, ', '.join(columns), ', '.join('?' * (len(columns) + 2))), changed)
+        if len(old) > len(rows):
+            self._conn.execute("DELETE FROM %s WHERE calc_id = ? AND idx >= ?" % table,
+                               (calc_id, len(rows)))
+        self._rows[(table, calc_id)] = rows
+
+    def _last_history(self, cache, table, columns, calc_id):
+        if calc_id not in cache:
+            row = self._conn.execute(
+                "SELECT %s FROM %s WHERE calc_id = ? ORDER BY time DESC, rowid DESC LIMIT 1" %
+                (', '.join(columns), table), (calc_id,)).fetchone()
+            cache[calc_id] = None if row is None else tuple(row)
+        return cache[calc_id]
+
+    def save(self, state, name):
+        encoder = self.encoder()
+        d = _to_native(encoder, encoder.default(state))
+        crystal = d['crystal'] or [None] * 8
+        ub = getattr(state, 'UB', None)
+        ub = None if ub is None else json.dumps(ub.tolist())
+        now = time.time()
+        values = tuple(crystal) + (d['tau'], d['sigma'], json.dumps(d['u']), json.dumps(d['ub']),
+                                   json.dumps(d['or0']), json.dumps(d['or1']),
+                                   json.dumps(d['reference']), json.dumps(d['surface']),
+                                   json.dumps(d['domains']), now, _current_user())
+        try:
+            self._save_rows(name, d, crystal, ub, now, values)
+        except:
+            # Rolled back, so the cached rows may not match the database
+            self._rows.clear()
+            self._last_ub.clear()
+            self._last_lattice.clear()
+            raise
+
+    def _save_rows(self, name, d, crystal, ub, now, values):
+        with self._conn:
+            calc_id = self._calc_id(name)
+            if calc_id is None:
+                calc_id = self._conn.execute(
+                    "INSERT INTO calculations (name, lattice, system, a, b, c, alpha, beta, gamma, "
+                    "tau, sigma, u, ub, or0, or1, reference, surface, domains, modified, user) "
+                    "VALUES (%s)" % ', '.join('?' * 20), (name,) + values).lastrowid
+            else:
+                self._conn.execute(
+                    "UPDATE calculations SET lattice=?, system=?, a=?, b=?, c=?, alpha=?, beta=?, "
+                    "gamma=?, tau=?, sigma=?, u=?, ub=?, or0=?, or1=?, reference=?, surface=?, "
+                    "domains=?, modified=?, user=? WHERE id=?", values + (calc_id,))
+            for table, rows in self._encode_rows(d).items():
+                self._sync_rows(table, calc_id, rows)
+            lattice = tuple(crystal)
+            if d['crystal'] and self._last_history(
+                    self._last_lattice, 'lattice_history',
+                    ('lattice', 'system', 'a', 'b', 'c', 'alpha', 'beta', 'gamma'), calc_id) != lattice:
+                self._conn.execute("INSERT INTO lattice_history VALUES (%s)" % ', '.join('?' * 10),
+                                   (calc_id, now) + lattice)
+                self._last_lattice[calc_id] = lattice
+            if ub is not None and self._last_history(
+                    self._last_ub, 'ub_history', ('ub',), calc_id) != (ub,):
+                self._conn.execute("INSERT INTO ub_history VALUES (?, ?, ?)", (calc_id, now, ub))
+                self._last_ub[calc_id] = (ub,)
+
+    def load(self, name):
+        calc_id = self._calc_id(name)
+        if calc_id is None:
+            raise IOError("No UB calculation called '%s' in %s" % (name, self.filename))
+        row = self._conn.execute(
+            "SELECT lattice, system, a, b, c, alpha, beta, gamma, tau, sigma, u, ub, or0, or1, "
+            "reference, surface, domains FROM calculations WHERE id = ?", (calc_id,)).fetchone()
+        crystal = list(row[:8])
+        rows = dict((table, self._read_rows(table, calc_id)) for table in self._ROW_TABLES)
+        for table, table_rows in rows.items():
+            self._rows[(table, calc_id)] = table_rows
+        refs, orients = rows['reflections'], rows['orientations']
+        d = {'version': self.encoder.VERSION,
+             'name': name,
+             'crystal': crystal if crystal[0] is not None else None,
+             'reflist': {'count': len(refs),
+                         'tag': [r[0] for r in refs],
+                         'hkl': [list(r[1:4]) for r in refs],
+                         'pos': [json.loads(r[4]) for r in refs],
+                         'energy': [r[5] for r in refs],
+                         'time': [r[6] for r in refs]},
+             'orientlist': {'count': len(orients),
+                            'tag': [r[0] for r in orients],
+                            'hkl': [list(r[1:4]) for r in orients],
+                            'xyz': [list(r[4:7]) for r in orients],
+                            'pos': [json.loads(r[7]) for r in orients],
+                            'time': [r[8] for r in orients]},
+             'tau': row[8],
+             'sigma': row[9]}
+        for key, text in zip(('u', 'ub', 'or0', 'or1', 'reference', 'surface', 'domains'),
+                             row[10:]):
+            d[key] = json.loads(text)
+        if rows['constraints']:
+            d['constraints'] = dict((con, json.loads(value)) for con, value in rows['constraints'])
+        return d
+
+    def flush(self):
+        pass
+
+    def list(self):  # @ReservedAssignment
+        return [e['name'] for e in self.list_entries()]
+
+    def list_entries(self):
+        """Return summaries of the stored calculations, most recent first"""
+        return [{'name': name, 'mtime': modified, 'lattice': lattice, 'nref': nref, 'user': user}
+                for name, modified, lattice, nref, user in self._conn.execute(
+                    "SELECT name, modified, lattice, "
+                    "(SELECT COUNT(*) FROM reflections WHERE calc_id = calculations.id), user "
+                    "FROM calculations ORDER BY modified DESC")]
+
+    def list_metadata(self):
+        return [_format_entry(e) for e in self.list_entries()]
+
+    def query(self, lattice=None, user=None, since=None):
+        """Return names of calculations, most recent first, for a lattice
+        (sample) name, last saved by a user, or modified since a datetime"""
+        conditions, args = [], []
+        if lattice is not None:
+            conditions.append("lattice = ?")
+            args.append(lattice)
+        if user is not None:
+            conditions.append("user = ?")
+            args.append(user)
+        if since is not None:
+            conditions.append("modified >= ?")
+            args.append(time.mktime(since.timetuple()) + since.microsecond * 1e-6)
+        where = (" WHERE " + " AND ".join(conditions)) if conditions else ""
+        return [row[0] for row in self._conn.execute(
+            "SELECT name FROM calculations%s ORDER BY modified DESC" % where, args)]
+
+    def ub_history(self, name):
+        """Return (datetime, UB as nested lists) for every UB matrix change"""
+        return [(datetime.datetime.fromtimestamp(t), json.loads(ub)) for t, ub in
+                self._conn.execute("SELECT time, ub FROM ub_history WHERE calc_id = ? "
+                                   "ORDER BY time, rowid", (self._calc_id(name),))]
+
+    def lattice_history(self, name):
+        """Return (datetime, (name, system, a, b, c, alpha, beta, gamma)) for
+        every lattice change"""
+        return [(datetime.datetime.fromtimestamp(row[0]), tuple(row[1:])) for row in
+                self._conn.execute("SELECT time, lattice, system, a, b, c, alpha, beta, gamma "
+                                   "FROM lattice_history WHERE calc_id = ? ORDER BY time, rowid",
+                                   (self._calc_id(name),))]
 
     def remove(self, name):
-        os.remove(self.filepath(name))
+        calc_id = self._calc_id(name)
+        if calc_id is None:
+            raise IOError("No UB calculation called '%s' in %s" % (name, self.filename))
+        with self._conn:
+            for table in ('reflections', 'orientations', 'constraints', 'ub_history',
+                          'lattice_history'):
+                self._conn.execute("DELETE FROM %s WHERE calc_id = ?" % table, (calc_id,))
+            self._conn.execute("DELETE FROM calculations WHERE id = ?", (calc_id,))
+        for key in [key for key in self._rows if key[1] == calc_id]:
+            del self._rows[key]
+        self._last_ub.pop(calc_id, None)
+        self._last_lattice.pop(calc_id, None)
+
+
+class UBCalculationJournalPersister(object):
+    """Stores UB calculations as append-only journals of changes.
+
+    Every calculation has its own subdirectory holding snapshots of the
+    full state and, for each snapshot, a journal of the changes made since.
+    A save appends one record per changed item, describing a new value or a
+    splice of the reflection or orientation lists, so the amount written
+    does not grow with the size of the calculation. After snapshot_interval
+    records a new snapshot is written and a new journal started. Old
+    snapshots and journals are kept, so a calculation can be restored as it
+    was at any earlier time with load_at().
+    """
+
+    _ROW_COLUMNS = {'reflist': ('tag', 'hkl', 'pos', 'energy', 'time'),
+                    'orientlist': ('tag', 'hkl', 'xyz', 'pos', 'time')}
+
+    def __init__(self, directory, encoder, snapshot_interval=100):
+        check_directory_appropriate(directory)
+        self.directory = directory
+        self.description = directory
+        self.encoder = encoder
+        self.snapshot_interval = snapshot_interval
+        self._current = {}  # name -> latest state, as written to the journal
+
+    def _calcdir(self, name):
+        return os.path.join(self.directory, name)
+
+    def _segments(self, name):
+        """Return the sequence numbers of all snapshots, oldest first"""
+        try:
+            files = os.listdir(self._calcdir(name))
+        except OSError:
+            return []
+        return sorted(int(f[len('snapshot-'):-len('.json')]) for f in files
+                      if f.startswith('snapshot-') and f.endswith('.json'))
+
+    def _snapshot_path(self, name, seq):
+        return os.path.join(self._calcdir(name), 'snapshot-%08d.json' % seq)
+
+    def _journal_path(self, name, seq):
+        return os.path.join(self._calcdir(name), 'journal-%08d.jsonl' % seq)
+
+    def _split(self, d):
+        state = {'top': dict((k, v) for k, v in d.items() if k not in self._ROW_COLUMNS)}
+        for key, names in self._ROW_COLUMNS.items():
+            state[key] = [list(row) for row in zip(*[d[key][n] for n in names])]
+        return state
+
+    def _join(self, state):
+        d = dict((k, v) for k, v in state['top'].items() if v is not None or k != 'constraints')
+        for key, names in self._ROW_COLUMNS.items():
+            rows = state[key]
+            d[key] = dict((n, [row[i] for row in rows]) for i, n in enumerate(names))
+            d[key]['count'] = len(rows)
+        return d
 
+    def _write_snapshot(self, name, state, seq):
+        calcdir = self._calcdir(name)
+        if not os.path.isdir(calcdir):
+            os.mkdir(calcdir)
+        path = self._snapshot_path(name, seq)
+        fd, tmppath = tempfile.mkstemp(prefix='.snapshot.', suffix='.tmp', dir=calcdir)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'seq': seq, 'time': time.time(), 'top': state['top'],
+                           'reflist': state['reflist'], 'orientlist': state['orientlist']},
+                          f, separators=(',', ':'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmppath, path)
+        except:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+        state['segment'] = seq
+        state['seq'] = seq
+
+    @staticmethod
+    def _apply(state, record):
+        if record['op'] == 'set':
+            state['top'][record['key']] = record['value']
+        elif record['op'] == 'splice':
+            start = record['start']
+            state[record['key']][start:start + record['delete']] = record['insert']
+        state['seq'] = record['seq']
+
+    @staticmethod
+    def _splice(old, new):
+        """Return start, number of deleted rows and inserted rows changing
+        old into new, or None if they are equal"""
+        start = 0
+        n = min(len(old), len(new))
+        while start < n and old[start] == new[start]:
+            start += 1
+        if start == len(old) == len(new):
+            return None
+        end = 0
+        while end < n - start and old[-1 - end] == new[-1 - end]:
+            end += 1
+        return start, len(old) - start - end, new[start:len(new) - end]
+
+    def _read(self, name, until=None):
+        """Replay snapshot and journal up to a time stamp in seconds"""
+        segments = self._segments(name)
+        if not segments:
+            raise IOError("No UB calculation called '%s' in %s" % (name, self.directory))
+        for seq in reversed(segments):
+            with open(self._snapshot_path(name, seq)) as f:
+                snapshot = json.load(f)
+            if until is None or snapshot['time'] <= until:
+                break
+        else:
+            raise IOError("UB calculation '%s' did not exist at that time" % name)
+        state = {'top': snapshot['top'], 'reflist': snapshot['reflist'],
+                 'orientlist': snapshot['orientlist'], 'seq': seq, 'segment': seq}
+        for record in self._records(name, seq):
+            if until is not None and record['time'] > until:
+                break
+            self._apply(state, record)
+        return state
+
+    def _records(self, name, segment):
+        try:
+            f = open(self._journal_path(name, segment))
+        except IOError:
+            return
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    return  # Partly written last record
+                yield record
+
+    def save(self, state, name):
+        encoder = self.encoder()
+        new = self._split(_to_native(encoder, encoder.default(state)))
+        if name not in self._current:
+            try:
+                self._current[name] = self._read(name)
+            except IOError:
+                self._write_snapshot(name, new, 0)
+                self._current[name] = new
+                return
+        current = self._current[name]
+        now = time.time()
+        records = []
+        for key in sorted(set(new['top']) | set(current['top'])):
+            value = new['top'].get(key)
+            if value != current['top'].get(key):
+                records.append({'op': 'set', 'key': key, 'value': value})
+        for key in sorted(self._ROW_COLUMNS):
+            splice = self._splice(current[key], new[key])
+            if splice is not None:
+                start, delete, insert = splice
+                records.append({'op': 'splice', 'key': key, 'start': start,
+                                'delete': delete, 'insert': insert})
+        if not records:
+            return
+        lines = []
+        for record in records:
+            record['seq'] = current['seq'] + 1
+            record['time'] = now
+            self._apply(current, record)
+            lines.append(json.dumps(record, separators=(',', ':')) + '\n')
+        with open(self._journal_path(name, current['segment']), 'a') as f:
+            f.write(''.join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        if current['seq'] - current['segment'] >= self.snapshot_interval:
+            self._write_snapshot(name, current, current['seq'])
+
+    def load(self, name):
+        self._current[name] = self._read(name)
+        return self._join(self._current[name])
+
+    def load_at(self, name, when):
+        """Return the state of a calculation as it was at a datetime"""
+        until = time.mktime(when.timetuple()) + when.microsecond * 1e-6
+        return self._join(self._read(name, until))
+
+    def history(self, name):
+        """Return (datetime, operation, item) for every change of a calculation"""
+        result = []
+        for segment in self._segments(name):
+            with open(self._snapshot_path(name, segment)) as f:
+                snapshot_time = json.load(f)['time']
+            if segment == 0:
+                result.append((datetime.datetime.fromtimestamp(snapshot_time), 'new', None))
+            for record in self._records(name, segment):
+                result.append((datetime.datetime.fromtimestamp(record['time']),
+                               record['op'], record['key']))
+        return result
+
+    def flush(self):
+        pass
+
+    def _mtime(self, name):
+        segment = self._segments(name)[-1]
+        paths = [self._snapshot_path(name, segment), self._journal_path(name, segment)]
+        return max(os.path.getmtime(p) for p in paths if os.path.exists(p))
+
+    def list(self):  # @ReservedAssignment
+        names = [f for f in os.listdir(self.directory) if self._segments(f)]
+        names.sort(key=self._mtime, reverse=True)
+        return names
+
+    def list_metadata(self):
+        return [datetime.datetime.fromtimestamp(self._mtime(name)).strftime('%d %b %Y (%H:%M)')
+                for name in self.list()]
+
+    def remove(self, name):
+        if not self._segments(name):
+            raise IOError("No UB calculation called '%s' in %s" % (name, self.directory))
+        shutil.rmtree(self._calcdir(name))
+        self._current.pop(name, None)
 
 
 class UBCalculationPersister(object):
@@ -136,6 +1231,9 @@ class UBCalculationPersister(object):
         else:
             return []
 
+    def flush(self):
+        pass
+
     def remove(self, name):
         if self.shelf is not None:
             del self.shelf[name]
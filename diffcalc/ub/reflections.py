@@ -75,6 +75,20 @@ class ReflectionList:
                 position = YouPosition(*position)
         self._reflist += [_Reflection(h, k, l, position, energy, tag, time.__repr__())]
 
+    def add_reflections(self, reflections, time):
+        """adds (h, k, l, position, energy, tag) reflections all at once,
+        positions in degrees
+        """
+        new_reflist = []
+        for h, k, l, position, energy, tag in reflections:
+            if type(position) in (list, tuple):
+                try:
+                    position = self._geometry.create_position(*position)
+                except AttributeError:
+                    position = YouPosition(*position)
+            new_reflist.append(_Reflection(h, k, l, position, energy, tag, time.__repr__()))
+        self._reflist += new_reflist
+
     def edit_reflection(self, idx, h, k, l, position, energy, tag, time):
         """num starts at 1"""
         try:
@@ -142,3 +156,63 @@ class ReflectionList:
             values = (n, energy / self._multiplier, h, k, l) + externalAngles + (tag,)
             lines.append(format % values)
         return lines
+
+
+def _is_number(field):
+    try:
+        float(field)
+    except ValueError:
+        return False
+    return True
+
+
+def read_reflections(filename, naxes):
+    """Read reflections from a CSV, whitespace delimited or NPY file.
+
+    Each row holds h, k, l, naxes diffractometer angles, energy and an
+    optional tag. Blank lines, lines starting with '#' and a first line with
+    no numeric fields are skipped. NPY files must contain a numeric (N, naxes + 4) array.
+
+    Returns a list of (row number, h, k, l, angles, energy, tag) tuples and a
+    list of (row number, reason) pairs for the rows that could not be read.
+    """
+    ncols = naxes + 4
+    rows = []
+    rejected = []
+    if filename.lower().endswith('.npy'):
+        import numpy as np
+        try:
+            data = np.atleast_2d(np.load(filename).astype(float))
+        except (ValueError, TypeError), e:
+            raise DiffcalcException("Could not read reflections from %s: %s" % (filename, e))
+        if data.shape[1] != ncols:
+            raise DiffcalcException("Expected %d columns in %s but found %d" %
+                                    (ncols, filename, data.shape[1]))
+        for n, row in enumerate(data.tolist()):
+            rows.append((n + 1,) + tuple(row[:3]) + (tuple(row[3:-1]), row[-1], None))
+        return rows, rejected
+
+    with open(filename) as f:
+        lines = f.readlines()
+    first = True
+    for n, line in enumerate(lines):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = [e.strip() for e in line.split(',')] if ',' in line else line.split()
+        if first:
+            first = False
+            if not any(_is_number(e) for e in fields):
+                continue  # header line
+        try:
+            values = [float(e) for e in fields[:ncols]]
+        except ValueError:
+            rejected.append((n + 1, 'non-numeric value'))
+            continue
+        if len(fields) not in (ncols, ncols + 1) or len(values) != ncols:
+            rejected.append((n + 1, 'expected %d or %d columns but found %d' %
+                             (ncols, ncols + 1, len(fields))))
+            continue
+        tag = fields[ncols] if len(fields) > ncols and fields[ncols] else None
+        rows.append((n + 1,) + tuple(values[:3]) + (tuple(values[3:-1]), values[-1], tag))
+    return rows, rejected
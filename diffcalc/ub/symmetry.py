@@ -0,0 +1,120 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""
+Laue class symmetry operations acting on Miller indices.
+
+Operations are integer 3x3 matrices applied to column hkl vectors. Hexagonal
+and trigonal classes assume the hexagonal setting with gamma = 120 deg and
+monoclinic classes assume b as the unique axis.
+"""
+
+from diffcalc.util import DiffcalcException
+
+_INVERSION = ((-1, 0, 0), (0, -1, 0), (0, 0, -1))
+_2_C = ((-1, 0, 0), (0, -1, 0), (0, 0, 1))
+_2_B = ((-1, 0, 0), (0, 1, 0), (0, 0, -1))
+_2_A = ((1, 0, 0), (0, -1, 0), (0, 0, -1))
+_4_C = ((0, -1, 0), (1, 0, 0), (0, 0, 1))
+_3_C = ((-1, -1, 0), (1, 0, 0), (0, 0, 1))
+_6_C = ((1, 1, 0), (-1, 0, 0), (0, 0, 1))
+_2_110 = ((0, 1, 0), (1, 0, 0), (0, 0, -1))
+_3_111 = ((0, 0, 1), (1, 0, 0), (0, 1, 0))
+
+LAUE_GENERATORS = {
+    '-1': (_INVERSION,),
+    '2/m': (_INVERSION, _2_B),
+    'mmm': (_INVERSION, _2_C, _2_B),
+    '4/m': (_INVERSION, _4_C),
+    '4/mmm': (_INVERSION, _4_C, _2_A),
+    '-3': (_INVERSION, _3_C),
+    '-3m': (_INVERSION, _3_C, _2_110),
+    '6/m': (_INVERSION, _6_C),
+    '6/mmm': (_INVERSION, _6_C, _2_110),
+    'm-3': (_INVERSION, _2_C, _2_B, _3_111),
+    'm-3m': (_INVERSION, _4_C, _2_B, _3_111),
+}
+
+# Diffraction patterns obey Friedel's law, so every point group maps onto the
+# Laue class obtained by adding an inversion centre.
+POINT_GROUP_LAUE = {
+    '1': '-1', '-1': '-1',
+    '2': '2/m', 'm': '2/m', '2/m': '2/m',
+    '222': 'mmm', 'mm2': 'mmm', 'mmm': 'mmm',
+    '4': '4/m', '-4': '4/m', '4/m': '4/m',
+    '422': '4/mmm', '4mm': '4/mmm', '-42m': '4/mmm', '-4m2': '4/mmm',
+    '4/mmm': '4/mmm',
+    '3': '-3', '-3': '-3',
+    '32': '-3m', '3m': '-3m', '-3m': '-3m',
+    '6': '6/m', '-6': '6/m', '6/m': '6/m',
+    '622': '6/mmm', '6mm': '6/mmm', '-6m2': '6/mmm', '-62m': '6/mmm',
+    '6/mmm': '6/mmm',
+    '23': 'm-3', 'm-3': 'm-3',
+    '432': 'm-3m', '-43m': 'm-3m', 'm-3m': 'm-3m',
+}
+
+
+def _matmul(a, b):
+    return tuple(tuple(sum(a[i][k] * b[k][j] for k in range(3))
+                       for j in range(3)) for i in range(3))
+
+
+def get_laue_class(group):
+    """Return the Laue class name for a point group or Laue class name."""
+    try:
+        return POINT_GROUP_LAUE[str(group).replace(' ', '')]
+    except KeyError:
+        raise DiffcalcException(
+            "Unknown point group or Laue class '%s'. Try one of: %s" %
+            (group, ', '.join(sorted(LAUE_GENERATORS.keys()))))
+
+
+def get_symmetry_operations(group):
+    """Return all symmetry operations of the Laue class of a point group.
+
+    The group is closed by repeated multiplication of its generators.
+    """
+    generators = LAUE_GENERATORS[get_laue_class(group)]
+    identity = ((1, 0, 0), (0, 1, 0), (0, 0, 1))
+    operations = set([identity])
+    new_ops = [identity]
+    while new_ops:
+        found = []
+        for op in new_ops:
+            for gen in generators:
+                prod = _matmul(gen, op)
+                if prod not in operations:
+                    operations.add(prod)
+                    found.append(prod)
+        new_ops = found
+    return sorted(operations, reverse=True)
+
+
+def get_equivalent_reflections(hkl, group):
+    """Return the unique reflections symmetry-equivalent to hkl.
+
+    The input reflection is always the first item of the returned list.
+    """
+    h, k, l = hkl
+    res = [tuple(hkl)]
+    for op in get_symmetry_operations(group):
+        hkl_eq = tuple(op[i][0] * h + op[i][1] * k + op[i][2] * l
+                       for i in range(3))
+        if hkl_eq not in res:
+            res.append(hkl_eq)
+    return res
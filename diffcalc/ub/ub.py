@@ -18,9 +18,12 @@
 
 from diffcalc import settings
 from diffcalc.ub.calc import UBCalculation
+from diffcalc.ub.reflections import read_reflections
 
 from math import asin, pi
 from datetime import datetime
+from fnmatch import fnmatch
+from functools import wraps
 
 try:
     from numpy import matrix
@@ -30,20 +33,23 @@ except ImportError:
 
 from diffcalc.util import getInputWithDefault as promptForInput, \
     promptForNumber, promptForList, isnum, bold, SMALL, DiffcalcException
-from diffcalc.util import command
+from diffcalc.util import command, xyz_rotation
 
 TORAD = pi / 180
 TODEG = 180 / pi
 
+LISTUB_PAGE_SIZE = 20
+
 
 # When using ipython magic, these functions must not be imported to the top
 # level namespace. Doing so will stop them from being called with magic.
 
 __all__ = ['addorient', 'addref', 'c2th', 'hklangle', 'calcub', 'delorient', 'delref', 'editorient',
-           'editref', 'listub', 'loadub', 'newub', 'orientub', 'saveubas', 'setlat',
+           'editref', 'listub', 'loadub', 'newub', 'orientub', 'saveub', 'saveubas', 'setlat',
            'addmiscut', 'setmiscut', 'setu', 'setub', 'showorient', 'showref', 'swaporient',
            'swapref', 'trialub', 'fitub', 'checkub', 'ub', 'ubcalc', 'rmub', 'clearorient',
-           'clearref', 'lastub', 'refineub', 'surfnphi', 'surfnhkl']
+           'clearref', 'lastub', 'restoreub', 'refineub', 'surfnphi', 'surfnhkl', 'fitmiscut',
+           'adddomain', 'deldomain', 'importref']
 
 if settings.include_sigtau:
     __all__.append('sigtau')
@@ -59,6 +65,17 @@ ubcalc = UBCalculation(settings.ubcalc_persister,
                        settings.include_reference)
 
 
+def reloads_external_changes(f):
+    """Reload the current UB calculation before running a command if it has
+    been saved by another process in the meantime."""
+    @wraps(f)
+    def wrapper(*args, **kwds):
+        ubcalc.check_external_changes()
+        return f(*args, **kwds)
+
+    return wrapper
+
+
 
 ### UB state ###
 
@@ -121,6 +138,22 @@ def lastub():
         print(msg)
         print("*" * len(msg))
 
+@command
+def restoreub(name_or_num, when):
+    """restoreub 'name'|num 'YYYY-MM-DD HH:MM[:SS]' -- restore ub calculation as it was at a time
+    """
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            when = datetime.strptime(when, fmt)
+            break
+        except ValueError:
+            pass
+    else:
+        raise DiffcalcException("Time '%s' not in YYYY-MM-DD HH:MM[:SS] format" % when)
+    if not isinstance(name_or_num, basestring):
+        name_or_num = ubcalc.listub()[int(name_or_num)]
+    ubcalc.load(name_or_num, when)
+
 @command
 def rmub(name_or_num):
     """rmub 'name'|num -- remove existing ub calculation
@@ -131,9 +164,12 @@ def rmub(name_or_num):
         ubcalc.remove(ubcalc.listub()[int(name_or_num)])
 
 @command
-def listub():
+def listub(pattern=None, page=None):
     """listub -- list the ub calculations available to load.
+    listub {'pattern'} {page} -- list calculations matching name pattern or details, 20 per page
     """
+    if isinstance(pattern, int):
+        pattern, page = None, pattern
     if hasattr(ubcalc._persister, 'description'):
         print "UB calculations in: " + ubcalc._persister.description
     else:
@@ -145,27 +181,49 @@ def listub():
         ub_metadata = ubcalc.listub_metadata()
     except AttributeError:
         ub_metadata = [''] * len(ubnames)
+    rows = zip(range(len(ubnames)), ubnames, ub_metadata)
+    if pattern is not None:
+        rows = [row for row in rows if fnmatch(row[1], pattern) or pattern in row[2]]
+    npages = max(1, (len(rows) + LISTUB_PAGE_SIZE - 1) // LISTUB_PAGE_SIZE)
+    if page is not None:
+        if not 1 <= page <= npages:
+            raise DiffcalcException("Page must be between 1 and %d" % npages)
+        rows = rows[(page - 1) * LISTUB_PAGE_SIZE:page * LISTUB_PAGE_SIZE]
     try:
-        wdt_names = max([len(nm) for nm in ubnames])
+        wdt_names = max([len(row[1]) for row in rows])
     except Exception:
         wdt_names = 30
     fmt_names = ' '.join(["%3i) ",
                           "%%-%is " % wdt_names,
                           "%s"])
-    for n, name, data in zip(range(len(ubnames)), ubnames, ub_metadata):
+    for n, name, data in rows:
         print fmt_names % (n, name, data)
+    if page is not None:
+        print
+        print "Page %d of %d" % (page, npages)
+
+@command
+@reloads_external_changes
+def saveub():
+    """saveub -- write the current ub calculation to storage now
+    """
+    ubcalc.save()
+    ubcalc.flush()
 
 @command
+@reloads_external_changes
 def saveubas(name):
     """saveubas 'name' -- save the ub calculation with a new name
     """
     if isinstance(name, basestring):
         # just trying might cause confusion here
         ubcalc.saveas(name)
+        ubcalc.flush()
     else:
         raise TypeError()
 
 @command
+@reloads_external_changes
 def ub():
     """ub -- show the complete state of the ub calculation
     """
@@ -176,6 +234,7 @@ def ub():
 ### UB lattice ###
 
 @command
+@reloads_external_changes
 def setlat(name=None, *args):
     """
     setlat  -- interactively enter lattice parameters (Angstroms and Deg)
@@ -240,6 +299,7 @@ def setlat(name=None, *args):
 
 
 @command
+@reloads_external_changes
 def c2th(hkl, en=None):
     """
     c2th [h k l]  -- calculate two-theta angle for reflection
@@ -260,6 +320,7 @@ def c2th(hkl, en=None):
     
 
 @command
+@reloads_external_changes
 def hklangle(hkl1, hkl2):
     """
     hklangle [h1 k1 l1] [h2 k2 l2]  -- calculate angle between [h1 k1 l1] and [h2 k2 l2] planes
@@ -269,6 +330,7 @@ def hklangle(hkl1, hkl2):
 ### Surface and reference vector stuff ###
 
 @command
+@reloads_external_changes
 def sigtau(sigma=None, tau=None):
     """sigtau {sigma tau} -- sets or displays sigma and tau"""
     if sigma is None and tau is None:
@@ -287,6 +349,7 @@ def sigtau(sigma=None, tau=None):
 
 
 @command
+@reloads_external_changes
 def setnphi(xyz=None):
     """setnphi {[x y z]} -- sets or displays n_phi reference vector"""
     if xyz is None:
@@ -296,6 +359,7 @@ def setnphi(xyz=None):
         ubcalc.print_reference()
 
 @command
+@reloads_external_changes
 def setnhkl(hkl=None):
     """setnhkl {[h k l]} -- sets or displays n_hkl reference vector"""
     if hkl is None:
@@ -306,6 +370,7 @@ def setnhkl(hkl=None):
  
  
 @command
+@reloads_external_changes
 def surfnphi(xyz=None):
     """surfnphi {[x y z]} -- sets or displays surface normal vector in lab space"""
     if xyz is None:
@@ -315,6 +380,7 @@ def surfnphi(xyz=None):
         ubcalc.print_surface()
 
 @command
+@reloads_external_changes
 def surfnhkl(hkl=None):
     """surfnhkl {[h k l]} -- sets or displays surface normal vector in reciprocal space"""
     if hkl is None:
@@ -336,6 +402,7 @@ def _to_column_vector_triple(o):
 ### UB refelections ###
 
 @command
+@reloads_external_changes
 def showref():
     """showref -- shows full reflection list"""
     if ubcalc._state.reflist:
@@ -344,6 +411,7 @@ def showref():
         print "<<< No reflections stored >>>"
 
 @command
+@reloads_external_changes
 def addref(*args):
     """
     addref -- add reflection interactively
@@ -414,6 +482,34 @@ def addref(*args):
         raise TypeError("Too many parameters specified for addref command.")
 
 @command
+@reloads_external_changes
+def importref(filename, tolerance=1.):
+    """importref 'filename' {tolerance} -- add reflections from a CSV, whitespace delimited or NPY file with h k l (p1, .., pN) energy {tag} rows
+    
+    Rows with measured 2theta angle differing from the lattice by more than
+    tolerance degrees are rejected (default: 1 deg). Use tolerance None to skip
+    the lattice check.
+    """
+    multiplier = settings.hardware.energyScannableMultiplierToGetKeV
+    naxes = len(settings.hardware.get_axes_names())
+    rows, rejected = read_reflections(filename, naxes)
+    pos_list = [settings.geometry.physical_angles_to_internal_position(angles)  # @UndefinedVariable
+                for _, _, _, _, angles, _, _ in rows]
+    rejected_rows = ubcalc.add_reflections([row[1:4] for row in rows],
+                                           pos_list,
+                                           [row[5] * multiplier for row in rows],
+                                           [row[6] for row in rows],
+                                           datetime.now(),
+                                           tolerance)
+    rejected.extend((rows[idx][0], reason) for idx, reason in rejected_rows)
+    print "Imported %d reflections from %s" % (len(rows) - len(rejected_rows), filename)
+    if rejected:
+        print "Rejected %d rows:" % len(rejected)
+        for n, reason in sorted(rejected):
+            print "   row %d: %s" % (n, reason)
+
+@command
+@reloads_external_changes
 def editref(idx):
     """editref {num | 'tag'} -- interactively edit a reflection.
     """
@@ -458,12 +554,14 @@ def editref(idx):
                                 datetime.now())
 
 @command
+@reloads_external_changes
 def delref(idx):
     """delref {num | 'tag'} -- deletes a reflection
     """
     ubcalc.del_reflection(idx)
     
 @command
+@reloads_external_changes
 def clearref():
     """clearref -- deletes all the reflections
     """
@@ -471,6 +569,7 @@ def clearref():
         ubcalc.del_reflection(1)   
 
 @command
+@reloads_external_changes
 def swapref(idx1=None, idx2=None):
     """
     swapref -- swaps first two reflections used for calculating U matrix
@@ -485,6 +584,7 @@ def swapref(idx1=None, idx2=None):
 
 ### U calculation from crystal orientation
 @command
+@reloads_external_changes
 def showorient():
     """showorient -- shows full list of crystal orientations"""
     if ubcalc._state.orientlist:
@@ -493,6 +593,7 @@ def showorient():
         print "<<< No crystal orientations stored >>>"
 
 @command
+@reloads_external_changes
 def addorient(*args):
     """
     addorient -- add crystal orientation interactively
@@ -561,6 +662,7 @@ def addorient(*args):
         raise TypeError("Invalid number of parameters specified for addorient command.")
 
 @command
+@reloads_external_changes
 def editorient(idx):
     """editorient num | 'tag' -- interactively edit a crystal orientation.
     """
@@ -602,12 +704,14 @@ def editorient(idx):
                                 datetime.now())
 
 @command
+@reloads_external_changes
 def delorient(idx):
     """delorient num | 'tag' -- deletes a crystal orientation
     """
     ubcalc.del_orientation(idx)
     
 @command
+@reloads_external_changes
 def clearorient():
     """clearorient -- deletes all the crystal orientations
     """
@@ -615,6 +719,7 @@ def clearorient():
         ubcalc.del_orientation(1)
 
 @command
+@reloads_external_changes
 def swaporient(idx1=None, idx2=None):
     """
     swaporient -- swaps first two crystal orientations used for calculating U matrix
@@ -631,6 +736,7 @@ def swaporient(idx1=None, idx2=None):
 ### UB calculations ###
 
 @command
+@reloads_external_changes
 def setu(U=None):
     """setu {[[..][..][..]]} -- manually set U matrix
     """
@@ -644,6 +750,7 @@ def setu(U=None):
         raise TypeError("U must be given as 3x3 list or tuple")
 
 @command
+@reloads_external_changes
 def setub(UB=None):
     """setub {[[..][..][..]]} -- manually set UB matrix"""
     if UB is None:
@@ -672,6 +779,7 @@ def _promptFor3x3MatrixDefaultingToIdentity():
     return [row1, row2, row3]
 
 @command
+@reloads_external_changes
 def calcub(idx1=None, idx2=None):
     """
     calcub -- (re)calculate U matrix from the first two reflections and/or orientations.
@@ -680,12 +788,14 @@ def calcub(idx1=None, idx2=None):
     ubcalc.calculate_UB(idx1, idx2)
 
 @command
+@reloads_external_changes
 def trialub(idx=1):
     """trialub -- (re)calculate U matrix from reflection with index or tag idx only (check carefully). Default: use first reflection.
     """
     ubcalc.calculate_UB(idx)
 
 @command
+@reloads_external_changes
 def orientub(idx1=None, idx2=None):
     """
     DEPRECATED. Please use 'calcub' command.
@@ -719,6 +829,7 @@ def checkub():
     print s
 
 @command
+@reloads_external_changes
 def refineub(*args):
     """
     refineub {[h k l]} {pos} -- refine unit cell dimensions and U matrix to match diffractometer angles for a given hkl value
@@ -787,6 +898,7 @@ def refineub(*args):
         ubcalc.set_miscut(None, 0, True)
 
 @command
+@reloads_external_changes
 def fitub(*args):
     """fitub ref1, ref2, ref3... -- fit UB matrix to match list of provided reference reflections."""
     new_umatrix, new_lattice = ubcalc.fit_ub_matrix(*args)
@@ -811,6 +923,36 @@ def fitub(*args):
         ubcalc.set_U_manually(new_umatrix, False)
 
 @command
+@reloads_external_changes
+def fitmiscut(*args):
+    """fitmiscut {ref1, ref2, ref3...} -- fit miscut angle and azimuth to match reference reflections (default: all)"""
+    if len(args) == 0:
+        args = range(1, ubcalc.get_number_reflections() + 1)
+    hkls = []
+    positions = []
+    for idx in args:
+        try:
+            hkl_vals, pos, _, _, _ = ubcalc.get_reflection(idx)
+        except IndexError:
+            raise DiffcalcException("Cannot read reflection data for index %s" % str(idx))
+        hkls.append(hkl_vals)
+        positions.append(pos)
+    mc_angle, mc_angle_err, mc_azimuth, mc_azimuth_err, mc_axis = \
+        ubcalc.fit_miscut(hkls, positions)
+    lines = ["Fitted miscut parameters:",]
+    lines.append("      angle:".ljust(9) + "% 9.5f +/- %.5f" % (mc_angle, mc_angle_err))
+    lines.append("    azimuth:".ljust(9) + "% 9.5f +/- %.5f" % (mc_azimuth, mc_azimuth_err))
+    lines.append("       axis:".ljust(9) + "% 9.5f % 9.5f % 9.5f" % tuple(mc_axis))
+    print '\n'.join(lines)
+    if mc_angle < SMALL:
+        print "No miscut detected for the given reflections"
+        return
+    reply = promptForInput('Apply miscut parameters?', 'y')
+    if reply in ('y', 'Y', 'yes'):
+        ubcalc.set_miscut(mc_axis, mc_angle * TORAD, True)
+
+@command
+@reloads_external_changes
 def addmiscut(*args):
     """addmiscut angle {[x y z]} -- apply miscut to U matrix using a specified miscut angle in degrees and a rotation axis"""
     
@@ -828,6 +970,7 @@ def addmiscut(*args):
         ubcalc.set_miscut(xyz, rad_angle, True)
 
 @command
+@reloads_external_changes
 def setmiscut(*args):
     """setmiscut angle {[x y z]} -- manually set U matrix using a specified miscut angle in degrees and a rotation axis (default: [0 1 0])"""
     
@@ -844,12 +987,39 @@ def setmiscut(*args):
             xyz = args.pop(0)
         ubcalc.set_miscut(xyz, rad_angle, False)
 
+@command
+@reloads_external_changes
+def adddomain(name, *args):
+    """adddomain 'name' angle {[x y z]} -- add a domain rotated from the U matrix by an angle in degrees about an axis (default: [0 0 1])
+    adddomain 'name' {[[..][..][..]]} -- add a domain using a domain rotation matrix applied to the U matrix
+    """
+    if len(args) == 0:
+        rot = _promptFor3x3MatrixDefaultingToIdentity()
+        if rot is None:
+            return  # an error will have been printed or thrown
+    elif _is3x3TupleOrList(args[0]) or _is3x3Matrix(args[0]):
+        rot = args[0]
+    elif isnum(args[0]):
+        xyz = args[1] if len(args) > 1 else (0, 0, 1)
+        rot = xyz_rotation(xyz, float(args[0]) * TORAD)
+    else:
+        raise TypeError("Domain must be given as an angle and axis or a 3x3 rotation matrix")
+    ubcalc.add_domain(name, rot)
+
+@command
+@reloads_external_changes
+def deldomain(name):
+    """deldomain 'name' -- delete a domain"""
+    ubcalc.remove_domain(name)
+
 commands_for_help = ['State',
                      newub,
                      loadub,
                      lastub,
+                     restoreub,
                      listub,
                      rmub,
+                     saveub,
                      saveubas,
                      ub,
                      'Lattice',
@@ -876,6 +1046,7 @@ commands_for_help.extend([
                      'Reflections',
                      showref,
                      addref,
+                     importref,
                      editref,
                      delref,
                      clearref,
@@ -896,8 +1067,12 @@ commands_for_help.extend([
                      orientub,
                      trialub,
                      refineub,
+                     fitmiscut,
                      addmiscut,
-                     setmiscut])
+                     setmiscut,
+                     'Domains',
+                     adddomain,
+                     deldomain])
 
 
 
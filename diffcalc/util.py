@@ -838,3 +838,75 @@ def solve_l_fixed_q(l, qval, B, coeff):
             raise DiffcalcException("Couldn't find solution for l=%f with the given hkl constraints" % l)
     else:
         raise DiffcalcException("Value of l is fixed to a constant by the constraint on hkl")
+
+
+class FixedQSolver(object):
+    '''Solver for all hkl values with one fixed index and a given scattering
+    vector amplitude that match linear hkl constraint a*h + b*k + c*l = d.
+
+    All terms depending on the UB matrix and the constraint coefficients are
+    computed once. Single points are then solved with a handful of scalar
+    operations and arrays of points with a few numpy array operations.'''
+
+    def __init__(self, B, coeff, index):
+        if isinstance(index, basestring):
+            index = 'hkl'.index(index)
+        coeff = [float(e) for e in coeff]
+        free = [i for i in range(3) if i != index]
+        # Solve the hkl constraint for the free index with the larger coefficient
+        dep = max(free, key=lambda i: abs(coeff[i]))
+        par = free[0] if free[1] == dep else free[1]
+        if abs(coeff[dep]) < SMALL:
+            raise DiffcalcException("Value of %s is fixed to a constant by the constraint on hkl"
+                                    % 'hkl'[index])
+        # Solutions lie on the line hkl = p_c + x * p_x + t * v, with x the
+        # fixed index value, and |B * hkl|**2 = qval gives a quadratic in t
+        p_c = [0., 0., 0.]
+        p_c[dep] = coeff[3] / coeff[dep]
+        p_x = [0., 0., 0.]
+        p_x[index] = 1.
+        p_x[dep] = -coeff[index] / coeff[dep]
+        v = [0., 0., 0.]
+        v[par] = 1.
+        v[dep] = -coeff[par] / coeff[dep]
+        M = (B.T * B).tolist()
+
+        def dotM(u, w):
+            return sum(u[i] * M[i][j] * w[j] for i in range(3) for j in range(3))
+
+        self.index = index
+        self._p_c, self._p_x, self._v = p_c, p_x, v
+        self._qa = dotM(v, v)
+        self._qb0, self._qb1 = dotM(v, p_c), dotM(v, p_x)
+        self._qc0, self._qc1, self._qc2 = dotM(p_c, p_c), 2 * dotM(p_c, p_x), dotM(p_x, p_x)
+
+    def solve(self, x, qval):
+        '''Return (N,3) arrays of both hkl solutions and (N,) mask of the
+        index and qval values with real solutions. Requires numpy.'''
+        import numpy as np
+        x, qval = np.broadcast_arrays(np.atleast_1d(np.asarray(x, dtype=float)),
+                                      np.atleast_1d(np.asarray(qval, dtype=float)))
+        qb = self._qb0 + self._qb1 * x
+        qc = self._qc0 + (self._qc1 + self._qc2 * x) * x - qval
+        discriminant = qb * qb - self._qa * qc
+        valid = discriminant >= 0
+        sqrt_disc = np.sqrt(np.where(valid, discriminant, 0.))
+        hkl0 = np.array(self._p_c) + x[:, np.newaxis] * np.array(self._p_x)
+        v = np.array(self._v)
+        return (hkl0 + ((-qb + sqrt_disc) / self._qa)[:, np.newaxis] * v,
+                hkl0 + ((-qb - sqrt_disc) / self._qa)[:, np.newaxis] * v,
+                valid)
+
+    def solutions(self, x, qval):
+        '''Find list of both hkl values for a single index and qval value'''
+        qb = self._qb0 + self._qb1 * x
+        qc = self._qc0 + (self._qc1 + self._qc2 * x) * x - qval
+        try:
+            sqrt_disc = sqrt(qb * qb - self._qa * qc)
+        except ValueError:
+            raise DiffcalcException("Couldn't find solution for %s=%f with the given hkl constraints"
+                                    % ('hkl'[self.index], x))
+        res = []
+        for t in ((-qb + sqrt_disc) / self._qa, (-qb - sqrt_disc) / self._qa):
+            res.append(tuple(p0 + x * px + t * vi for p0, px, vi in zip(self._p_c, self._p_x, self._v)))
+        return res
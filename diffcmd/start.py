@@ -36,7 +36,8 @@ DIFFCALC_VAR = os.path.join(os.path.expanduser('~'), '.diffcalc', module_name)
 if not os.path.exists(DIFFCALC_VAR):
     print "Making diffcalc var folder:'%s'" % DIFFCALC_VAR
     os.makedirs(DIFFCALC_VAR)
-diffcalc.settings.ubcalc_persister = UBCalculationJSONPersister(DIFFCALC_VAR, UBCalcStateEncoder)
+diffcalc.settings.ubcalc_persister = UBCalculationJSONPersister(DIFFCALC_VAR, UBCalcStateEncoder,
+                                                                write_interval=1.)
 
 # configure debug
 diffcalc.util.DEBUG = debug
@@ -60,7 +60,8 @@ if GDA:
     if not os.path.exists(diffcalc_persistance_path):
         print "Making diffcalc var folder:'%s'" % diffcalc_persistance_path
         os.makedirs(diffcalc_persistance_path)
-    settings.ubcalc_persister = UBCalculationJSONPersister(diffcalc_persistance_path, YouStateEncoder)
+    settings.ubcalc_persister = UBCalculationJSONPersister(diffcalc_persistance_path, YouStateEncoder,
+                                                           write_interval=1.)
 # else: should have been set if outside GDA
 
 
@@ -19,7 +19,7 @@ import types
 from math import sin, cos, acos, atan2, sqrt, pi
 
 from diffcalc.gdasupport.scannable.parametrised_hkl import ParametrisedHKLScannable
-from diffcalc.util import DiffcalcException, TORAD, TODEG, SMALL
+from diffcalc.util import DiffcalcException, TORAD, TODEG, SMALL, FixedQSolver
 
 try:
     from numpy import matrix
@@ -66,9 +66,26 @@ conic_hkl = ParametrisedHKLScannable('conic', ('rlu', 'az'))
 conic_hkl.parameter_to_hkl = __polar_to_hkl
 conic_hkl.hkl_to_parameter = __hkl_to_polar
 
+# Solvers by (hkl constraint, solved index) for the UB matrix they were made for
+__fixed_q_solvers = {'UB': None, 'solvers': {}}
+
+def __fixed_q_solver(UB, coeff, index):
+    # Solvers are reused while the UB matrix stays the same
+    ub_key = tuple(tuple(row) for row in UB.tolist())
+    if __fixed_q_solvers['UB'] != ub_key:
+        __fixed_q_solvers['UB'] = ub_key
+        __fixed_q_solvers['solvers'] = {}
+    solvers = __fixed_q_solvers['solvers']
+    key = (tuple(coeff), index)
+    try:
+        return solvers[key]
+    except KeyError:
+        solver = solvers[key] = FixedQSolver(UB, coeff, index)
+        return solver
+
 def __conic_h_to_hkl(self, params):
     from diffcalc.dc import dcyou as _dc
-    from diffcalc.util import norm3, solve_h_fixed_q
+    from diffcalc.util import norm3
     import __main__
 
     try:
@@ -78,7 +95,7 @@ def __conic_h_to_hkl(self, params):
     h, k, l = __main__.hkl.getPosition()[:3]
     hkl_nphi = _dc._ub.ubcalc._UB * matrix([[h], [k], [l]])
     qval = norm3(hkl_nphi)**2
-    hkl = solve_h_fixed_q(h_param, qval, _dc._ub.ubcalc._UB, (a, b, c, d))
+    hkl = __fixed_q_solver(_dc._ub.ubcalc._UB, (a, b, c, d), 'h').solutions(h_param, qval)
     return hkl
 
 def __hkl_to_conic_h(self, hkl):
@@ -97,7 +114,7 @@ conic_h.hkl_to_parameter = types.MethodType(__hkl_to_conic_h, conic_h)
 
 def __conic_k_to_hkl(self, params):
     from diffcalc.dc import dcyou as _dc
-    from diffcalc.util import norm3, solve_k_fixed_q
+    from diffcalc.util import norm3
     import __main__
 
     try:
@@ -107,7 +124,7 @@ def __conic_k_to_hkl(self, params):
     h, k, l = __main__.hkl.getPosition()[:3]
     hkl_nphi = _dc._ub.ubcalc._UB * matrix([[h], [k], [l]])
     qval = norm3(hkl_nphi)**2
-    hkl = solve_k_fixed_q(k_param, qval, _dc._ub.ubcalc._UB, (a, b, c, d))
+    hkl = __fixed_q_solver(_dc._ub.ubcalc._UB, (a, b, c, d), 'k').solutions(k_param, qval)
     return hkl
 
 def __hkl_to_conic_k(self, hkl):
@@ -126,7 +143,7 @@ conic_k.hkl_to_parameter = types.MethodType(__hkl_to_conic_k, conic_k)
 
 def __conic_l_to_hkl(self, params):
     from diffcalc.dc import dcyou as _dc
-    from diffcalc.util import norm3, solve_l_fixed_q
+    from diffcalc.util import norm3
     import __main__
 
     try:
@@ -136,7 +153,7 @@ def __conic_l_to_hkl(self, params):
     h, k, l = __main__.hkl.getPosition()[:3]
     hkl_nphi = _dc._ub.ubcalc._UB * matrix([[h], [k], [l]])
     qval = norm3(hkl_nphi)**2
-    hkl = solve_l_fixed_q(l_param, qval, _dc._ub.ubcalc._UB, (a, b, c, d))
+    hkl = __fixed_q_solver(_dc._ub.ubcalc._UB, (a, b, c, d), 'l').solutions(l_param, qval)
     return hkl
 
 def __hkl_to_conic_l(self, hkl):
@@ -155,7 +172,7 @@ conic_l.hkl_to_parameter = types.MethodType(__hkl_to_conic_l, conic_l)
 
 def __conic_th_to_hkl(self, params):
     from diffcalc.dc import dcyou as _dc
-    from diffcalc.util import norm3, solve_h_fixed_q, solve_k_fixed_q
+    from diffcalc.util import norm3
     import __main__
 
     try:
@@ -175,10 +192,10 @@ def __conic_th_to_hkl(self, params):
     qval = norm3(hkl_nphi)**2
     if th > 45.:
         k = k0 + r * sin_th
-        hkl = solve_k_fixed_q(k, qval, _dc._ub.ubcalc._UB, (a, b, c, d))
+        hkl = __fixed_q_solver(_dc._ub.ubcalc._UB, (a, b, c, d), 'k').solutions(k, qval)
     else:
         h = h0 + r * cos_th
-        hkl = solve_h_fixed_q(h, qval, _dc._ub.ubcalc._UB, (a, b, c, d))
+        hkl = __fixed_q_solver(_dc._ub.ubcalc._UB, (a, b, c, d), 'h').solutions(h, qval)
     return hkl
 
 def __hkl_to_conic_th(self, hkl):